@@ -1,10 +1,118 @@
+import atexit
+import bisect
+import copy
+import gzip
+import hashlib
+import io
 import json
+import logging
+import math
 import os
+import queue
+import re
+import signal
 import sqlite3
-from flask import Flask, render_template, jsonify, request
+import threading
+import time
+import zlib
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from flask import Blueprint, Flask, Response, current_app, g, has_request_context, render_template, jsonify, request, stream_with_context, url_for
+from werkzeug.routing import BaseConverter
+from werkzeug.wsgi import get_input_stream
 
-app = Flask(__name__)
+class BoardIdConverter(BaseConverter):
+    regex = r'[A-Za-z0-9_-]{1,64}'
+
+bp = Blueprint('fleet', __name__)
+logger = logging.getLogger(__name__)
+# Defaults for create_app(); its config can override DB_FILE, DB_SHARDS, the
+# DB_POOL_SIZE/DB_BUSY_TIMEOUT/DB_MMAP_SIZE pool settings and SEED_STATE
 DB_FILE = 'game.db'
+# Optional list of SQLite files to spread boards across. When empty every
+# board lives in DB_FILE. Boards are placed by a hash of their id, so
+# changing the number of shards moves boards between files.
+DB_SHARDS = []
+# Connections kept open per database file, seconds to wait for a lock or a
+# free connection, and bytes of each file to memory-map
+DB_POOL_SIZE = 8
+DB_BUSY_TIMEOUT = 5.0
+DB_MMAP_SIZE = 256 * 1024 * 1024
+# Store row and history JSON zlib-compressed against a preset dictionary.
+# Rows written either way stay readable whatever this is set to.
+STORAGE_COMPRESSION = False
+# Gzip/deflate JSON and HTML responses of at least COMPRESS_MIN_SIZE bytes
+COMPRESS_RESPONSES = True
+COMPRESS_MIN_SIZE = 1024
+# Largest request body accepted once decompressed
+MAX_DECOMPRESSED_BODY = 64 * 1024 * 1024
+# Largest save or patch body; bigger ones get 413 before any JSON is parsed
+MAX_SAVE_BODY = 32 * 1024 * 1024
+DEFAULT_BOARD = 'default'
+BOARD_PAGE_LIMIT = 500
+# Most main goals and most islands returned by one /api/entities call
+ENTITY_PAGE_LIMIT = 5000
+# Most hits returned by one /api/search call
+SEARCH_PAGE_LIMIT = 200
+# Most KPIs returned by one /api/kpis call
+KPI_PAGE_LIMIT = 1000
+# Default window of /api/kpis?status=upcoming
+UPCOMING_DAYS = 14
+# Boards read per query by /api/export, and committed per transaction by
+# /api/import unless the request passes ?batch=
+EXPORT_PAGE_SIZE = 100
+IMPORT_BATCH_SIZE = 100
+# Seconds a cached /api/load body is served without asking SQLite whether
+# the board changed. Saves made by this process refresh it immediately;
+# the interval only bounds staleness from other processes.
+STATE_CACHE_TTL = 1.0
+# Serialized boards kept for /api/load, least recently used dropped first
+# once there are more than STATE_CACHE_SIZE or their bodies pass
+# STATE_CACHE_BYTES together
+STATE_CACHE_SIZE = 256
+STATE_CACHE_BYTES = 256 * 1024 * 1024
+# Every board revision is logged as a delta against the previous one, with a
+# full snapshot every HISTORY_SNAPSHOT_INTERVAL revisions. Compaction keeps at
+# least the last HISTORY_KEEP revisions readable (None keeps everything).
+HISTORY_SNAPSHOT_INTERVAL = 50
+HISTORY_KEEP = 1000
+# Write-behind mode: saves update an in-memory copy and return at once; a
+# background thread commits the latest state of each board every
+# WRITE_BEHIND_INTERVAL seconds, or sooner once WRITE_BEHIND_MAX_DIRTY boards
+# are waiting. Meant for a single server process.
+WRITE_BEHIND = False
+WRITE_BEHIND_INTERVAL = 1.0
+WRITE_BEHIND_MAX_DIRTY = 100
+# Admission control for saves and patches; a rate of 0 turns that limit off.
+# Each client address and each board has a token bucket refilled at
+# *_WRITE_RATE writes per second and holding up to *_WRITE_BURST. At most
+# MAX_PENDING_WRITES writes (0: unlimited) may wait for or hold the database
+# writer. Writes over any limit are answered 429 with Retry-After at once.
+CLIENT_WRITE_RATE = 0
+CLIENT_WRITE_BURST = 20
+BOARD_WRITE_RATE = 0
+BOARD_WRITE_BURST = 20
+MAX_PENDING_WRITES = 0
+# Buckets tracked before idle (refilled) ones are dropped
+ADMISSION_MAX_KEYS = 10000
+# Recent change events kept per board for /api/stream clients that reconnect,
+# and seconds between keep-alive comments on idle streams (each also checks
+# for revisions other workers stored)
+STREAM_BACKLOG = 64
+STREAM_HEARTBEAT = 15.0
+# Boards whose recent events are kept; boards without subscribers are
+# forgotten least recently used first, and their clients reload on reconnect
+STREAM_CHANNELS = 1000
+# Streams open at once per process (0: no limit). On thread-pooled servers
+# each one holds a worker thread, so --production keeps this below --threads
+# and turns further clients away with 503; the browser then polls /api/load
+# instead. With --gevent a stream is a greenlet and there is no default cap.
+MAX_STREAMS = 0
+# Embed the board's state in the index page so first paint needs no /api/load
+INLINE_INITIAL_STATE = False
+# Seconds browsers may keep a fingerprinted (?v=<hash>) static file
+ASSET_MAX_AGE = 365 * 24 * 3600
 
 # Rich Initial State with Strategy Data
 DEFAULT_STATE = {
@@ -81,50 +189,3518 @@ DEFAULT_STATE = {
     ]
 }
 
-def init_db():
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute('''CREATE TABLE IF NOT EXISTS gamestate (
-            id INTEGER PRIMARY KEY,
-            data TEXT
-        )''')
-        # Insert default row if empty
-        cursor = conn.cursor()
-        cursor.execute("SELECT count(*) FROM gamestate")
-        if cursor.fetchone()[0] == 0:
-            cursor.execute("INSERT INTO gamestate (id, data) VALUES (1, ?)", (json.dumps(DEFAULT_STATE),))
-        conn.commit()
-
-init_db()
-
-@app.route('/')
+# --- Storage ---
+#
+# Each board is a row in `gamestate`, looked up by its unique `key`. Its
+# teams, deployments, main goals, islands and KPIs live in their own tables,
+# keyed by the entity's id (see _entity_keys) with its position in `pos`, so
+# inserting or removing an entity only renumbers the rows after it. Deployments
+# and KPIs are keyed within their team or island. Every row keeps the entity's JSON
+# in `data` so documents round-trip exactly; the other columns are copies of
+# the fields worth indexing. Nested lists that moved into a child table are
+# left as an empty list in the parent's JSON and filled back in when the
+# document is assembled. gamestate.size is the length of the board's
+# canonical_json(), so patches can enforce MAX_SAVE_BODY without assembling it.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS gamestate (
+    id INTEGER PRIMARY KEY,
+    data TEXT,
+    rev INTEGER NOT NULL DEFAULT 0,
+    layout INTEGER NOT NULL DEFAULT 1,
+    key TEXT,
+    title TEXT,
+    updated_at TEXT,
+    content_hash TEXT,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS teams (
+    state_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    id TEXT,
+    name TEXT,
+    total_ships INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (state_id, key)
+);
+CREATE INDEX IF NOT EXISTS idx_teams_id ON teams (state_id, id);
+CREATE INDEX IF NOT EXISTS idx_teams_pos ON teams (state_id, pos);
+CREATE TABLE IF NOT EXISTS deployments (
+    state_id INTEGER NOT NULL,
+    team_key TEXT NOT NULL,
+    key TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    deployment_id TEXT,
+    team_id TEXT,
+    island_id TEXT,
+    kpi_ids TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (state_id, team_key, key)
+);
+CREATE INDEX IF NOT EXISTS idx_deployments_island ON deployments (state_id, island_id);
+CREATE INDEX IF NOT EXISTS idx_deployments_id ON deployments (state_id, deployment_id);
+CREATE TABLE IF NOT EXISTS main_goals (
+    state_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    id TEXT,
+    title TEXT,
+    description TEXT,
+    x REAL,
+    y REAL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (state_id, key)
+);
+CREATE INDEX IF NOT EXISTS idx_main_goals_id ON main_goals (state_id, id);
+CREATE INDEX IF NOT EXISTS idx_main_goals_pos ON main_goals (state_id, pos);
+CREATE TABLE IF NOT EXISTS islands (
+    state_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    id TEXT,
+    title TEXT,
+    description TEXT,
+    x REAL,
+    y REAL,
+    main_goal_ids TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (state_id, key)
+);
+CREATE INDEX IF NOT EXISTS idx_islands_id ON islands (state_id, id);
+CREATE INDEX IF NOT EXISTS idx_islands_pos ON islands (state_id, pos);
+CREATE TABLE IF NOT EXISTS kpis (
+    state_id INTEGER NOT NULL,
+    island_key TEXT NOT NULL,
+    key TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    id TEXT,
+    island_id TEXT,
+    description TEXT,
+    deadline TEXT,
+    completed INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (state_id, island_key, key)
+);
+CREATE INDEX IF NOT EXISTS idx_kpis_id ON kpis (state_id, id);
+CREATE INDEX IF NOT EXISTS idx_kpis_due ON kpis (completed, deadline);
+CREATE INDEX IF NOT EXISTS idx_kpis_board_due ON kpis (state_id, completed, deadline);
+CREATE TABLE IF NOT EXISTS history (
+    state_id INTEGER NOT NULL,
+    rev INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (state_id, rev)
+);
+CREATE INDEX IF NOT EXISTS idx_history_ts ON history (state_id, ts);
+'''
+
+# Map entities get an R-tree over (board, x, y), keyed by the entity row's
+# rowid and kept in sync by triggers. The board is a dimension of its own so
+# a viewport query only visits that board's entries.
+SPATIAL_TABLES = ('main_goals', 'islands')
+_HAS_POINT = "typeof(new.x) IN ('integer', 'real') AND typeof(new.y) IN ('integer', 'real')"
+SPATIAL_SCHEMA = ''.join(f'''
+CREATE VIRTUAL TABLE IF NOT EXISTS {table}_rtree USING rtree(id, min_state, max_state, min_x, max_x, min_y, max_y);
+CREATE TRIGGER IF NOT EXISTS {table}_rtree_insert AFTER INSERT ON {table} WHEN {_HAS_POINT} BEGIN
+    INSERT INTO {table}_rtree VALUES (new.rowid, new.state_id, new.state_id, new.x, new.x, new.y, new.y);
+END;
+CREATE TRIGGER IF NOT EXISTS {table}_rtree_update AFTER UPDATE OF x, y ON {table} BEGIN
+    DELETE FROM {table}_rtree WHERE id = old.rowid;
+    INSERT INTO {table}_rtree SELECT new.rowid, new.state_id, new.state_id, new.x, new.x, new.y, new.y
+        WHERE {_HAS_POINT};
+END;
+CREATE TRIGGER IF NOT EXISTS {table}_rtree_delete AFTER DELETE ON {table} BEGIN
+    DELETE FROM {table}_rtree WHERE id = old.rowid;
+END;
+''' for table in SPATIAL_TABLES)
+
+# Full-text index behind /api/search. Each main goal, island and KPI row has
+# one entry with rowid = source rowid * 3 + offset; board holds 'b<state_id>'
+# so searching a single board is an index lookup too.
+# (table, kind, title column, offset)
+SEARCH_SOURCES = (('main_goals', 'mainGoal', 'title', 0), ('islands', 'island', 'title', 1),
+                  ('kpis', 'kpi', None, 2))
+SEARCH_COLUMNS = 'rowid, title, description, board, kind, state_id, entity_id, island_id'
+
+def _search_values(table, kind, title, offset):
+    return (f"new.rowid * 3 + {offset}, {f'new.{title}' if title else 'NULL'}, new.description, "
+            f"'b' || new.state_id, '{kind}', new.state_id, new.id, {'new.island_id' if table == 'kpis' else 'NULL'}")
+
+SEARCH_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+    title, description, board, kind UNINDEXED, state_id UNINDEXED, entity_id UNINDEXED, island_id UNINDEXED,
+    prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+);
+''' + ''.join(f'''
+CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table} BEGIN
+    INSERT INTO search_index ({SEARCH_COLUMNS}) VALUES ({_search_values(table, kind, title, offset)});
+END;
+CREATE TRIGGER IF NOT EXISTS {table}_search_update
+AFTER UPDATE OF id, {'island_id' if table == 'kpis' else 'title'}, description ON {table}
+WHEN old.id IS NOT new.id OR old.description IS NOT new.description
+  OR {'old.island_id IS NOT new.island_id' if table == 'kpis' else 'old.title IS NOT new.title'} BEGIN
+    DELETE FROM search_index WHERE rowid = old.rowid * 3 + {offset};
+    INSERT INTO search_index ({SEARCH_COLUMNS}) VALUES ({_search_values(table, kind, title, offset)});
+END;
+CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table} BEGIN
+    DELETE FROM search_index WHERE rowid = old.rowid * 3 + {offset};
+END;
+''' for table, kind, title, offset in SEARCH_SOURCES)
+
+# Which teams work on which KPIs, from the kpiIds of each deployment. Rows
+# belong to the deployment row that produced them.
+ASSIGNMENT_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS kpi_assignments (
+    deployment_rowid INTEGER NOT NULL,
+    state_id INTEGER NOT NULL,
+    team_id TEXT,
+    kpi_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_kpi_assignments_deployment ON kpi_assignments (deployment_rowid);
+CREATE INDEX IF NOT EXISTS idx_kpi_assignments_kpi ON kpi_assignments (state_id, kpi_id);
+CREATE INDEX IF NOT EXISTS idx_kpi_assignments_team ON kpi_assignments (state_id, team_id);
+CREATE TRIGGER IF NOT EXISTS deployments_assign_insert AFTER INSERT ON deployments BEGIN
+    INSERT INTO kpi_assignments SELECT new.rowid, new.state_id, new.team_id, value FROM json_each(new.kpi_ids);
+END;
+CREATE TRIGGER IF NOT EXISTS deployments_assign_update AFTER UPDATE OF team_id, kpi_ids ON deployments
+WHEN old.team_id IS NOT new.team_id OR old.kpi_ids IS NOT new.kpi_ids BEGIN
+    DELETE FROM kpi_assignments WHERE deployment_rowid = old.rowid;
+    INSERT INTO kpi_assignments SELECT new.rowid, new.state_id, new.team_id, value FROM json_each(new.kpi_ids);
+END;
+CREATE TRIGGER IF NOT EXISTS deployments_assign_delete AFTER DELETE ON deployments BEGIN
+    DELETE FROM kpi_assignments WHERE deployment_rowid = old.rowid;
+END;
+'''
+
+# When each KPI was completed. A KPI's row is replaced when it moves to
+# another island, so times are keyed by KPI id instead and only recorded the
+# first time a row shows that KPI completed. write_state drops the times of
+# KPIs that are no longer completed.
+COMPLETION_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS kpi_completions (
+    state_id INTEGER NOT NULL,
+    kpi_id TEXT NOT NULL,
+    completed_at TEXT NOT NULL,
+    PRIMARY KEY (state_id, kpi_id)
+);
+CREATE INDEX IF NOT EXISTS idx_kpi_completions_at ON kpi_completions (completed_at);
+CREATE INDEX IF NOT EXISTS idx_kpi_completions_board_at ON kpi_completions (state_id, completed_at);
+CREATE TRIGGER IF NOT EXISTS kpis_completion_insert AFTER INSERT ON kpis
+WHEN new.completed IS 1 AND new.id IS NOT NULL BEGIN
+    INSERT OR IGNORE INTO kpi_completions VALUES (new.state_id, new.id, CURRENT_TIMESTAMP);
+END;
+CREATE TRIGGER IF NOT EXISTS kpis_completion_update AFTER UPDATE OF id, completed ON kpis
+WHEN new.completed IS 1 AND new.id IS NOT NULL AND (old.completed IS NOT 1 OR old.id IS NOT new.id) BEGIN
+    INSERT OR IGNORE INTO kpi_completions VALUES (new.state_id, new.id, CURRENT_TIMESTAMP);
+END;
+'''
+
+# Aggregates behind /api/matrix, maintained by triggers as deployment and KPI
+# rows change: ships per (team, island) and KPI counts per island. Missing
+# ids are stored as ''. Emptied rows are deleted by their full key, never by
+# a board-wide scan, so each trigger costs the same however big the board.
+MATRIX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS matrix_cells (
+    state_id INTEGER NOT NULL,
+    team_id TEXT NOT NULL,
+    island_id TEXT NOT NULL,
+    ships INTEGER NOT NULL,
+    PRIMARY KEY (state_id, team_id, island_id)
+);
+CREATE TABLE IF NOT EXISTS island_kpi_stats (
+    state_id INTEGER NOT NULL,
+    island_id TEXT NOT NULL,
+    kpis INTEGER NOT NULL,
+    completed INTEGER NOT NULL,
+    PRIMARY KEY (state_id, island_id)
+);
+CREATE TRIGGER IF NOT EXISTS deployments_matrix_insert AFTER INSERT ON deployments BEGIN
+    INSERT INTO matrix_cells VALUES (new.state_id, coalesce(new.team_id, ''), coalesce(new.island_id, ''), 1)
+        ON CONFLICT (state_id, team_id, island_id) DO UPDATE SET ships = ships + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS deployments_matrix_delete AFTER DELETE ON deployments BEGIN
+    UPDATE matrix_cells SET ships = ships - 1
+        WHERE state_id = old.state_id AND team_id = coalesce(old.team_id, '') AND island_id = coalesce(old.island_id, '');
+    DELETE FROM matrix_cells WHERE state_id = old.state_id AND team_id = coalesce(old.team_id, '')
+        AND island_id = coalesce(old.island_id, '') AND ships <= 0;
+END;
+CREATE TRIGGER IF NOT EXISTS deployments_matrix_update AFTER UPDATE OF team_id, island_id ON deployments
+WHEN old.team_id IS NOT new.team_id OR old.island_id IS NOT new.island_id BEGIN
+    UPDATE matrix_cells SET ships = ships - 1
+        WHERE state_id = old.state_id AND team_id = coalesce(old.team_id, '') AND island_id = coalesce(old.island_id, '');
+    INSERT INTO matrix_cells VALUES (new.state_id, coalesce(new.team_id, ''), coalesce(new.island_id, ''), 1)
+        ON CONFLICT (state_id, team_id, island_id) DO UPDATE SET ships = ships + 1;
+    DELETE FROM matrix_cells WHERE state_id = old.state_id AND team_id = coalesce(old.team_id, '')
+        AND island_id = coalesce(old.island_id, '') AND ships <= 0;
+END;
+CREATE TRIGGER IF NOT EXISTS kpis_stats_insert AFTER INSERT ON kpis BEGIN
+    INSERT INTO island_kpi_stats VALUES (new.state_id, coalesce(new.island_id, ''), 1, new.completed IS 1)
+        ON CONFLICT (state_id, island_id) DO UPDATE SET kpis = kpis + 1, completed = completed + (new.completed IS 1);
+END;
+CREATE TRIGGER IF NOT EXISTS kpis_stats_delete AFTER DELETE ON kpis BEGIN
+    UPDATE island_kpi_stats SET kpis = kpis - 1, completed = completed - (old.completed IS 1)
+        WHERE state_id = old.state_id AND island_id = coalesce(old.island_id, '');
+    DELETE FROM island_kpi_stats WHERE state_id = old.state_id AND island_id = coalesce(old.island_id, '') AND kpis <= 0;
+END;
+CREATE TRIGGER IF NOT EXISTS kpis_stats_complete AFTER UPDATE OF completed ON kpis
+WHEN old.island_id IS new.island_id AND old.completed IS NOT new.completed BEGIN
+    UPDATE island_kpi_stats SET completed = completed - (old.completed IS 1) + (new.completed IS 1)
+        WHERE state_id = new.state_id AND island_id = coalesce(new.island_id, '');
+END;
+CREATE TRIGGER IF NOT EXISTS kpis_stats_move AFTER UPDATE OF island_id ON kpis
+WHEN old.island_id IS NOT new.island_id BEGIN
+    UPDATE island_kpi_stats SET kpis = kpis - 1, completed = completed - (old.completed IS 1)
+        WHERE state_id = old.state_id AND island_id = coalesce(old.island_id, '');
+    INSERT INTO island_kpi_stats VALUES (new.state_id, coalesce(new.island_id, ''), 1, new.completed IS 1)
+        ON CONFLICT (state_id, island_id) DO UPDATE SET kpis = kpis + 1, completed = completed + (new.completed IS 1);
+    DELETE FROM island_kpi_stats WHERE state_id = old.state_id AND island_id = coalesce(old.island_id, '') AND kpis <= 0;
+END;
+'''
+
+# Totals behind the /api/matrix rollups, so polling never sums rows: ships
+# per team and per island, and KPI counts and ships per main goal over the
+# islands that list it. A deployment or KPI row shifts the goals of every
+# island carrying its island id; an island row adds or removes its island's
+# current numbers. `islands` counts the (island, goal) links behind a goal.
+_SHIP_TOTALS = (('team_ships', 'team_id'), ('island_ships', 'island_id'))
+
+def _islands_of(row):
+    """FROM clause pairing each island with the deployment/KPI row's island id with its goals."""
+    # Two branches rather than an OR, so both stay lookups on idx_islands_id
+    return (f"FROM (SELECT main_goal_ids FROM islands WHERE state_id = {row}.state_id AND id = coalesce({row}.island_id, '') "
+            f"UNION ALL SELECT main_goal_ids FROM islands WHERE state_id = {row}.state_id AND id IS NULL "
+            f"AND coalesce({row}.island_id, '') = '') i, json_each(i.main_goal_ids) g WHERE true")
+
+def _shift_goals(row, **deltas):
+    """Add each delta (an SQL expression) to the columns of the row's islands' goals."""
+    links = _islands_of(row)
+    columns = ', '.join(deltas)
+    values = ', '.join(f"main_goal_stats.{column} + ({delta}) * count(*)" for column, delta in deltas.items())
+    return f"""
+    UPDATE main_goal_stats SET ({columns}) = (SELECT {values}
+            {links} AND g.value = main_goal_stats.goal_id)
+        WHERE state_id = {row}.state_id AND goal_id IN (SELECT g.value {links});"""
+
+def _island_numbers(row):
+    """FROM clause giving each goal an island row lists with that island's current numbers."""
+    return f"""FROM json_each({row}.main_goal_ids) g
+        LEFT JOIN island_kpi_stats s ON s.state_id = {row}.state_id AND s.island_id = coalesce({row}.id, '')
+        LEFT JOIN island_ships c ON c.state_id = {row}.state_id AND c.island_id = coalesce({row}.id, '')"""
+
+def _add_island(row):
+    """Add an island row's numbers to its goals."""
+    return f"""
+    INSERT INTO main_goal_stats SELECT {row}.state_id, g.value, 1, coalesce(s.kpis, 0), coalesce(s.completed, 0),
+            coalesce(c.ships, 0) {_island_numbers(row)} WHERE true
+        ON CONFLICT (state_id, goal_id) DO UPDATE SET islands = islands + 1, kpis = kpis + excluded.kpis,
+            completed = completed + excluded.completed, ships = ships + excluded.ships;"""
+
+def _remove_island(row):
+    """Take an island row's numbers off its goals."""
+    return f"""
+    UPDATE main_goal_stats SET (islands, kpis, completed, ships) = (SELECT main_goal_stats.islands - count(*),
+            main_goal_stats.kpis - sum(coalesce(s.kpis, 0)), main_goal_stats.completed - sum(coalesce(s.completed, 0)),
+            main_goal_stats.ships - sum(coalesce(c.ships, 0)) {_island_numbers(row)} WHERE g.value = main_goal_stats.goal_id)
+        WHERE state_id = {row}.state_id AND goal_id IN (SELECT value FROM json_each({row}.main_goal_ids));
+    DELETE FROM main_goal_stats WHERE state_id = {row}.state_id
+        AND goal_id IN (SELECT value FROM json_each({row}.main_goal_ids)) AND islands <= 0;"""
+
+def _count_ships(row, step):
+    """Count a deployment row's ship in (step > 0) or out of its team and island totals."""
+    if step > 0:
+        return ''.join(f"""
+    INSERT INTO {table} VALUES ({row}.state_id, coalesce({row}.{column}, ''), 1)
+        ON CONFLICT (state_id, {column}) DO UPDATE SET ships = ships + 1;""" for table, column in _SHIP_TOTALS)
+    return ''.join(f"""
+    UPDATE {table} SET ships = ships - 1 WHERE state_id = {row}.state_id AND {column} = coalesce({row}.{column}, '');
+    DELETE FROM {table} WHERE state_id = {row}.state_id AND {column} = coalesce({row}.{column}, '') AND ships <= 0;""" for table, column in _SHIP_TOTALS)
+
+MATRIX_TOTALS_SCHEMA = ''.join(f'''
+CREATE TABLE IF NOT EXISTS {table} (
+    state_id INTEGER NOT NULL,
+    {column} TEXT NOT NULL,
+    ships INTEGER NOT NULL,
+    PRIMARY KEY (state_id, {column})
+);''' for table, column in _SHIP_TOTALS) + f'''
+CREATE TABLE IF NOT EXISTS main_goal_stats (
+    state_id INTEGER NOT NULL,
+    goal_id TEXT NOT NULL,
+    islands INTEGER NOT NULL,
+    kpis INTEGER NOT NULL,
+    completed INTEGER NOT NULL,
+    ships INTEGER NOT NULL,
+    PRIMARY KEY (state_id, goal_id)
+);
+CREATE TRIGGER IF NOT EXISTS deployments_totals_insert AFTER INSERT ON deployments BEGIN{_count_ships('new', 1)}{_shift_goals('new', ships=1)}
+END;
+CREATE TRIGGER IF NOT EXISTS deployments_totals_delete AFTER DELETE ON deployments BEGIN{_count_ships('old', -1)}{_shift_goals('old', ships=-1)}
+END;
+CREATE TRIGGER IF NOT EXISTS deployments_totals_update AFTER UPDATE OF team_id, island_id ON deployments
+WHEN old.team_id IS NOT new.team_id OR old.island_id IS NOT new.island_id BEGIN{_count_ships('old', -1)}{_shift_goals('old', ships=-1)}{_count_ships('new', 1)}{_shift_goals('new', ships=1)}
+END;
+CREATE TRIGGER IF NOT EXISTS kpis_totals_insert AFTER INSERT ON kpis BEGIN{_shift_goals('new', kpis=1, completed='new.completed IS 1')}
+END;
+CREATE TRIGGER IF NOT EXISTS kpis_totals_delete AFTER DELETE ON kpis BEGIN{_shift_goals('old', kpis=-1, completed='-(old.completed IS 1)')}
+END;
+CREATE TRIGGER IF NOT EXISTS kpis_totals_complete AFTER UPDATE OF completed ON kpis
+WHEN old.island_id IS new.island_id AND old.completed IS NOT new.completed BEGIN{_shift_goals('new', completed='(new.completed IS 1) - (old.completed IS 1)')}
+END;
+CREATE TRIGGER IF NOT EXISTS kpis_totals_move AFTER UPDATE OF island_id ON kpis
+WHEN old.island_id IS NOT new.island_id BEGIN{_shift_goals('old', kpis=-1, completed='-(old.completed IS 1)')}{_shift_goals('new', kpis=1, completed='new.completed IS 1')}
+END;
+CREATE TRIGGER IF NOT EXISTS islands_totals_insert AFTER INSERT ON islands BEGIN{_add_island('new')}
+END;
+CREATE TRIGGER IF NOT EXISTS islands_totals_delete AFTER DELETE ON islands BEGIN{_remove_island('old')}
+END;
+CREATE TRIGGER IF NOT EXISTS islands_totals_update AFTER UPDATE OF id, main_goal_ids ON islands
+WHEN old.id IS NOT new.id OR old.main_goal_ids IS NOT new.main_goal_ids BEGIN{_remove_island('old')}{_add_island('new')}
+END;
+'''
+
+# Preset dictionary for compressed rows: the key names and punctuation that
+# every entity repeats. Rows record the dictionary version in their first
+# byte, so never edit this one; add a new version instead.
+ZLIB_DICTIONARY_V1 = (
+    b'{"id": "t", "name": "", "icon": "", "color": "#", "totalShips": , "deployed": []}'
+    b'{"deploymentId": "dep_", "islandId": "p", "kpiIds": ["k'
+    b'{"id": "mg", "title": "", "x": , "y": , "icon": "", "desc": ""}'
+    b'{"id": "p", "mainGoalId": "mg", "mainGoalIds": ["mg", "x": , "y": , "title": "", "icon": "", '
+    b'"desc": "", "kpis": [], "expanded": false}'
+    b'{"id": "k", "desc": "", "deadline": "20", "completed": false, "assigned": []}'
+    b'{"op":"replace","path":"/islands/","value":{"op":"add","path":"/teams/'
+)
+
+def _dump_row(obj, compress=False, **kwargs):
+    """Serialize obj for a data column, zlib-compressed if compress is set."""
+    text = json.dumps(obj, **kwargs)
+    if not compress:
+        return text
+    compressor = zlib.compressobj(6, zdict=ZLIB_DICTIONARY_V1)
+    return b'\x01' + compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+def _load_row(value):
+    """Inverse of _dump_row; plain TEXT rows are read as-is."""
+    if isinstance(value, bytes):
+        if value[:1] != b'\x01':
+            raise ValueError("Unknown row encoding")
+        value = zlib.decompressobj(zdict=ZLIB_DICTIONARY_V1).decompress(value[1:])
+    return json.loads(value)
+
+# Top-level collections and the table each one is stored in
+COLLECTIONS = [('teams', 'teams'), ('mainGoals', 'main_goals'), ('islands', 'islands')]
+
+def _scalar(item, key):
+    """Return item[key] if it can be stored in an index column, else None."""
+    if isinstance(item, dict):
+        value = item.get(key)
+        if value is None or isinstance(value, (str, int, float)):
+            return value
+    return None
+
+def _split(item, key):
+    """Separate a nested list from item.
+
+    Returns (shell, children) where shell is item with the list emptied.
+    Anything that isn't a list under key stays in the shell untouched.
+    """
+    if isinstance(item, dict) and isinstance(item.get(key), list):
+        shell = dict(item)
+        shell[key] = []
+        return shell, item[key]
+    return item, []
+
+def _goal_ids(island):
+    """The main goals an island belongs to, reading the legacy mainGoalId too."""
+    if not isinstance(island, dict):
+        return []
+    ids = island.get('mainGoalIds')
+    if not ids and isinstance(island.get('mainGoalId'), str):
+        return [island['mainGoalId']]
+    return [i for i in ids if isinstance(i, str)] if isinstance(ids, list) else []
+
+def _kpi_ids(dep):
+    """The KPIs a deployment works on, reading the legacy kpiId too."""
+    if not isinstance(dep, dict):
+        return []
+    ids = dep.get('kpiIds')
+    if not ids and isinstance(dep.get('kpiId'), str):
+        return [dep['kpiId']]
+    return [i for i in ids if isinstance(i, str)] if isinstance(ids, list) else []
+
+def _entity_keys(items, id_key):
+    """Row keys for a list of entities: each entity's id, or '#<position>' for
+    entities whose id is missing, repeated or itself starts with '#'."""
+    keys, seen = [], set()
+    for pos, item in enumerate(items):
+        entity_id = _scalar(item, id_key)
+        if isinstance(entity_id, str) and not entity_id.startswith('#') and entity_id not in seen:
+            seen.add(entity_id)
+            keys.append(entity_id)
+        else:
+            keys.append(f'#{pos}')
+    return keys
+
+def _team_rows(rows, key, pos, team, compress=False):
+    shell, deployed = _split(team, 'deployed')
+    rows['teams'][(key,)] = {
+        'pos': pos, 'id': _scalar(team, 'id'), 'name': _scalar(team, 'name'),
+        'total_ships': _scalar(team, 'totalShips'), 'data': _dump_row(shell, compress)}
+    for dep_pos, (dep_key, dep) in enumerate(zip(_entity_keys(deployed, 'deploymentId'), deployed)):
+        rows['deployments'][(key, dep_key)] = {
+            'pos': dep_pos, 'deployment_id': _scalar(dep, 'deploymentId'), 'team_id': _scalar(team, 'id'),
+            # Legacy deployments are bare island ids
+            'island_id': dep if isinstance(dep, str) else _scalar(dep, 'islandId'),
+            'kpi_ids': json.dumps(_kpi_ids(dep)), 'data': _dump_row(dep, compress)}
+
+def _main_goal_rows(rows, key, pos, goal, compress=False):
+    rows['main_goals'][(key,)] = {
+        'pos': pos, 'id': _scalar(goal, 'id'), 'title': _scalar(goal, 'title'),
+        'description': _scalar(goal, 'desc'), 'x': _scalar(goal, 'x'), 'y': _scalar(goal, 'y'),
+        'data': _dump_row(goal, compress)}
+
+def _island_rows(rows, key, pos, island, compress=False):
+    shell, kpis = _split(island, 'kpis')
+    rows['islands'][(key,)] = {
+        'pos': pos, 'id': _scalar(island, 'id'), 'title': _scalar(island, 'title'),
+        'description': _scalar(island, 'desc'), 'x': _scalar(island, 'x'), 'y': _scalar(island, 'y'),
+        'main_goal_ids': json.dumps(_goal_ids(island)), 'data': _dump_row(shell, compress)}
+    for kpi_pos, (kpi_key, kpi) in enumerate(zip(_entity_keys(kpis, 'id'), kpis)):
+        rows['kpis'][(key, kpi_key)] = {
+            'pos': kpi_pos, 'id': _scalar(kpi, 'id'), 'island_id': _scalar(island, 'id'),
+            'description': _scalar(kpi, 'desc'), 'deadline': _scalar(kpi, 'deadline'),
+            'completed': int(isinstance(kpi, dict) and kpi.get('completed') is True),
+            'data': _dump_row(kpi, compress)}
+
+# Per top-level table: the function that adds an entity's rows, and the
+# table, parent key column and document key of its children
+ENTITY_ROWS = {'teams': _team_rows, 'main_goals': _main_goal_rows, 'islands': _island_rows}
+CHILD_TABLES = {'teams': ('deployments', 'team_key', 'deployed'), 'islands': ('kpis', 'island_key', 'kpis')}
+
+def _state_rows(state, compress=False):
+    """Flatten a state document into its skeleton and per-table rows."""
+    rows = {table: {} for table in TABLE_KEYS}
+    skeleton = state
+    for key, table in COLLECTIONS:
+        skeleton, entities = _split(skeleton, key)
+        for pos, (entity_key, entity) in enumerate(zip(_entity_keys(entities, 'id'), entities)):
+            ENTITY_ROWS[table](rows, entity_key, pos, entity, compress)
+    return _dump_row(skeleton, compress), rows
+
+TABLE_KEYS = {
+    'teams': ('key',),
+    'deployments': ('team_key', 'key'),
+    'main_goals': ('key',),
+    'islands': ('key',),
+    'kpis': ('island_key', 'key'),
+}
+
+def _sync_table(conn, table, state_id, rows, scope=None):
+    """Bring table in line with rows, touching only rows that changed.
+
+    Index columns are compared as well as data, since some come from the
+    parent entity (a deployment's team_id) and change without the row's data.
+    Updates set only the columns that differ, so renumbering a row fires
+    none of the triggers on its other columns. scope, a (column, values)
+    pair, limits the rows looked at (and deleted if missing from rows) to
+    those with one of values in column. Returns the old columns of every
+    row it deleted or changed beyond its position.
+    """
+    key_cols = TABLE_KEYS[table]
+    where = ' AND '.join(f"{col}=?" for col in ('state_id',) + key_cols)
+    if scope is None:
+        cursor = conn.execute(f"SELECT * FROM {table} WHERE state_id=?", (state_id,))
+    else:
+        column, values = scope
+        cursor = conn.execute(f"SELECT * FROM {table} WHERE state_id=? AND {column} IN "
+                              "(SELECT value FROM json_each(?))", (state_id, json.dumps(values)))
+    names = [column[0] for column in cursor.description]
+    existing = {}
+    for row in cursor:
+        old = dict(zip(names, row))
+        del old['state_id']
+        existing[tuple(old.pop(col) for col in key_cols)] = old
+    replaced = []
+    for key, values in rows.items():
+        old = existing.pop(key, None)
+        if old is None:
+            all_cols = ('state_id',) + key_cols + tuple(values)
+            conn.execute(
+                f"INSERT INTO {table} ({', '.join(all_cols)}) VALUES ({', '.join('?' * len(all_cols))})",
+                (state_id,) + key + tuple(values.values()))
+            continue
+        changes = {col: value for col, value in values.items() if old[col] != value}
+        if not changes:
+            continue
+        conn.execute(
+            f"UPDATE {table} SET {', '.join(f'{col}=?' for col in changes)} WHERE {where}",
+            tuple(changes.values()) + (state_id,) + key)
+        if set(changes) != {'pos'}:
+            replaced.append(old)
+    for key, old in existing.items():
+        conn.execute(f"DELETE FROM {table} WHERE {where}", (state_id,) + key)
+        replaced.append(old)
+    return replaced
+
+def canonical_json(state):
+    """state serialized with sorted keys and no whitespace."""
+    return json.dumps(state, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+def canonical_hash(state):
+    """Hash of the state that ignores key order and whitespace."""
+    return hashlib.sha1(canonical_json(state)).hexdigest()
+
+def _write_rows(conn, state_id, rows, scopes=None):
+    """_sync_table every table, or with scopes ({table: scope}) just the tables and rows in it."""
+    for table in TABLE_KEYS:
+        if scopes is not None and table not in scopes:
+            continue
+        replaced = _sync_table(conn, table, state_id, rows[table], None if scopes is None else scopes[table])
+        if table == 'kpis':
+            # Only KPIs a replaced or deleted row showed completed can have
+            # lost their completion; +k.completed keeps the probe on idx_kpis_id
+            dropped = sorted(set(old['id'] for old in replaced if old['completed'] == 1) - {None})
+            if dropped:
+                conn.execute(
+                    "DELETE FROM kpi_completions WHERE state_id=? AND kpi_id IN (SELECT value FROM json_each(?)) "
+                    "AND NOT EXISTS (SELECT 1 FROM kpis k WHERE k.state_id = kpi_completions.state_id "
+                    "AND k.id = kpi_completions.kpi_id AND +k.completed IS 1)",
+                    (state_id, json.dumps(dropped)))
+
+def write_state(conn, state_id, state, content_hash=None, size=None):
+    """Store state under state_id, writing only the rows that differ.
+
+    content_hash is canonical_hash(state) if the caller has it; None records
+    that the hash is unknown. size is len(canonical_json(state)), worked out
+    here unless given. Does not commit and does not touch the revision
+    counter.
+    """
+    skeleton, rows = _state_rows(state, _compresses(conn))
+    _write_rows(conn, state_id, rows)
+    if size is None:
+        size = len(canonical_json(state))
+    conn.execute(
+        "UPDATE gamestate SET data=?, layout=1, title=?, updated_at=CURRENT_TIMESTAMP, content_hash=?, size=? "
+        "WHERE id=?", (skeleton, _scalar(state, 'projectTitle'), content_hash, size, state_id))
+
+def read_state(conn, state_id):
+    """Assemble the document for state_id, or None if it doesn't exist."""
+    row = conn.execute("SELECT data FROM gamestate WHERE id=?", (state_id,)).fetchone()
+    if row is None:
+        return None
+    state = _load_row(row[0])
+    if not isinstance(state, dict):
+        return state
+
+    def load(table):
+        return conn.execute(f"SELECT key, data FROM {table} WHERE state_id=? ORDER BY pos", (state_id,))
+
+    # Only collections stored as lists were moved out, so only those are refilled
+    if state.get('teams') == []:
+        teams = {key: _load_row(data) for key, data in load('teams')}
+        for team_key, data in conn.execute(
+                "SELECT team_key, data FROM deployments WHERE state_id=? ORDER BY pos", (state_id,)):
+            teams[team_key]['deployed'].append(_load_row(data))
+        state['teams'] = list(teams.values())
+    if state.get('mainGoals') == []:
+        state['mainGoals'] = [_load_row(data) for _, data in load('main_goals')]
+    if state.get('islands') == []:
+        islands = {key: _load_row(data) for key, data in load('islands')}
+        for island_key, data in conn.execute(
+                "SELECT island_key, data FROM kpis WHERE state_id=? ORDER BY pos", (state_id,)):
+            islands[island_key]['kpis'].append(_load_row(data))
+        state['islands'] = list(islands.values())
+    return state
+
+def _in_box(item, bbox):
+    if not isinstance(item, dict):
+        return False
+    x, y = item.get('x'), item.get('y')
+    if not all(isinstance(v, (int, float)) for v in (x, y)):
+        return False
+    min_x, min_y, max_x, max_y = bbox
+    return min_x <= x <= max_x and min_y <= y <= max_y
+
+def _deployment_entry(team_id, dep):
+    # Legacy deployments are bare island ids
+    entry = {"islandId": dep} if isinstance(dep, str) else dict(dep)
+    entry['teamId'] = team_id
+    return entry
+
+def read_entities(conn, state_id, bbox, limit, after=(-1, -1)):
+    """Main goals and islands inside bbox, plus deployments to those islands.
+
+    Each list holds at most limit entities, in board order, starting after
+    the (main goal, island) positions in after; truncated says whether more
+    matched, and next is the after of the following page. Islands come with
+    their KPIs.
+    """
+    min_x, min_y, max_x, max_y = bbox
+    result = {}
+    islands = {}
+    for key, table, start in (('mainGoals', 'main_goals', after[0]), ('islands', 'islands', after[1])):
+        # R-tree bounds are 32-bit floats, so the row's own board and position decide
+        rows = conn.execute(f"""
+            SELECT t.pos, t.key, t.data FROM {table}_rtree r JOIN {table} t ON t.rowid = r.id
+            WHERE r.min_state <= ?1 AND r.max_state >= ?1
+              AND r.max_x >= ?2 AND r.min_x <= ?4 AND r.max_y >= ?3 AND r.min_y <= ?5
+              AND t.state_id = ?1 AND t.x BETWEEN ?2 AND ?4 AND t.y BETWEEN ?3 AND ?5 AND t.pos > ?7
+            ORDER BY t.pos LIMIT ?6""", (state_id, min_x, min_y, max_x, max_y, limit + 1, start)).fetchall()
+        result['truncated'] = result.get('truncated', False) or len(rows) > limit
+        result[key] = []
+        for pos, row_key, data in rows[:limit]:
+            entity = _load_row(data)
+            result[key].append((pos, entity))
+            if table == 'islands':
+                islands[row_key] = entity
+    result['next'] = _entities_cursor(result, after)
+
+    for island_key, data in conn.execute(
+            "SELECT island_key, data FROM kpis WHERE state_id=? AND island_key IN (SELECT value FROM json_each(?)) "
+            "ORDER BY pos", (state_id, json.dumps(list(islands)))):
+        if isinstance(islands[island_key].get('kpis'), list):
+            islands[island_key]['kpis'].append(_load_row(data))
+    island_ids = [island.get('id') for island in islands.values()]
+    result['deployments'] = [
+        _deployment_entry(team_id, _load_row(data))
+        for team_id, data in conn.execute(
+            "SELECT d.team_id, d.data FROM deployments d JOIN teams t ON t.state_id = d.state_id AND t.key = d.team_key "
+            "WHERE d.state_id=? AND d.island_id IN (SELECT value FROM json_each(?)) ORDER BY t.pos, d.pos",
+            (state_id, json.dumps(island_ids)))]
+    result['mainGoals'] = [goal for _, goal in result['mainGoals']]
+    result['islands'] = [island for _, island in result['islands']]
+    return result
+
+def _entities_cursor(result, after):
+    """The after= of the page following result's (pos, entity) lists, or None on the last page."""
+    if not result['truncated']:
+        return None
+    last = [entities[-1][0] if entities else start
+            for entities, start in zip((result['mainGoals'], result['islands']), after)]
+    return f"{last[0]},{last[1]}"
+
+def entities_in(state, bbox, limit, after=(-1, -1)):
+    """read_entities() for a state held in memory."""
+    result = {'truncated': False}
+    for key, start in (('mainGoals', after[0]), ('islands', after[1])):
+        items = state.get(key) if isinstance(state.get(key), list) else []
+        matches = [(pos, item) for pos, item in enumerate(items) if pos > start and _in_box(item, bbox)]
+        result['truncated'] = result['truncated'] or len(matches) > limit
+        result[key] = matches[:limit]
+    result['next'] = _entities_cursor(result, after)
+    result['mainGoals'] = [goal for _, goal in result['mainGoals']]
+    result['islands'] = [island for _, island in result['islands']]
+    island_ids = set(island.get('id') for island in result['islands']) - {None}
+    result['deployments'] = []
+    for team in state.get('teams') or []:
+        if not isinstance(team, dict) or not isinstance(team.get('deployed'), list):
+            continue
+        for dep in team['deployed']:
+            island_id = dep if isinstance(dep, str) else _scalar(dep, 'islandId')
+            if island_id in island_ids:
+                result['deployments'].append(_deployment_entry(_scalar(team, 'id'), dep))
+    return result
+
+def _matrix_result(teams, cells, islands, goals):
+    """Shape /api/matrix output from (id, ...) tuples in board order.
+
+    teams holds (id, totalShips, deployed), cells (teamId, islandId, ships)
+    and islands/goals (id, kpis, completed, ships); '' ids come back as None.
+    """
+    def ratio(kpis, completed):
+        return round(completed / kpis, 4) if kpis else None
+
+    def progress(rows):
+        return [{"id": item_id, "kpis": kpis, "completed": completed,
+                 "ratio": ratio(kpis, completed), "ships": ships}
+                for item_id, kpis, completed, ships in rows]
+    return {
+        "teams": [{"id": team_id, "totalShips": total, "deployed": deployed,
+                   "free": total - deployed if isinstance(total, (int, float)) else None}
+                  for team_id, total, deployed in teams],
+        "cells": [{"teamId": team_id or None, "islandId": island_id or None, "ships": ships}
+                  for team_id, island_id, ships in cells],
+        "islands": progress(islands),
+        "mainGoals": progress(goals),
+    }
+
+def read_matrix(conn, state_id):
+    """Team x island allocation and KPI progress from the aggregate tables.
+
+    Every number is read off a maintained total; the deployments and KPIs
+    themselves are never read and nothing is summed here.
+    """
+    teams = conn.execute("""
+        SELECT t.id, t.total_ships, coalesce(c.ships, 0) FROM teams t
+        LEFT JOIN team_ships c ON c.state_id = t.state_id AND c.team_id = coalesce(t.id, '')
+        WHERE t.state_id=? ORDER BY t.pos""", (state_id,)).fetchall()
+    cells = conn.execute("SELECT team_id, island_id, ships FROM matrix_cells WHERE state_id=? "
+                         "ORDER BY team_id, island_id", (state_id,)).fetchall()
+    islands = conn.execute("""
+        SELECT i.id, coalesce(s.kpis, 0), coalesce(s.completed, 0), coalesce(c.ships, 0) FROM islands i
+        LEFT JOIN island_kpi_stats s ON s.state_id = i.state_id AND s.island_id = coalesce(i.id, '')
+        LEFT JOIN island_ships c ON c.state_id = i.state_id AND c.island_id = coalesce(i.id, '')
+        WHERE i.state_id=? ORDER BY i.pos""", (state_id,)).fetchall()
+    goals = conn.execute("""
+        SELECT m.id, coalesce(s.kpis, 0), coalesce(s.completed, 0), coalesce(s.ships, 0) FROM main_goals m
+        LEFT JOIN main_goal_stats s ON s.state_id = m.state_id AND s.goal_id = m.id
+        WHERE m.state_id=? ORDER BY m.pos""", (state_id,)).fetchall()
+    return _matrix_result(teams, cells, islands, goals)
+
+def matrix_of(state):
+    """read_matrix() for a state held in memory."""
+    def items(parent, key):
+        value = parent.get(key) if isinstance(parent, dict) else None
+        return value if isinstance(value, list) else []
+
+    cells = {}
+    for team in items(state, 'teams'):
+        for dep in items(team, 'deployed'):
+            island_id = dep if isinstance(dep, str) else _scalar(dep, 'islandId')
+            key = (_scalar(team, 'id') or '', island_id or '')
+            cells[key] = cells.get(key, 0) + 1
+    team_ships, island_ships = {}, {}
+    for (team_id, island_id), count in cells.items():
+        team_ships[team_id] = team_ships.get(team_id, 0) + count
+        island_ships[island_id] = island_ships.get(island_id, 0) + count
+    kpi_stats = {}
+    for island in items(state, 'islands'):
+        kpis = items(island, 'kpis')
+        done = sum(1 for kpi in kpis if isinstance(kpi, dict) and kpi.get('completed') is True)
+        total, completed = kpi_stats.get(_scalar(island, 'id') or '', (0, 0))
+        kpi_stats[_scalar(island, 'id') or ''] = (total + len(kpis), completed + done)
+    islands, by_goal = [], {}
+    for island in items(state, 'islands'):
+        key = _scalar(island, 'id') or ''
+        stats = kpi_stats[key] + (island_ships.get(key, 0),)
+        islands.append((_scalar(island, 'id'),) + stats)
+        for goal_id in _goal_ids(island):
+            by_goal[goal_id] = tuple(a + b for a, b in zip(by_goal.get(goal_id, (0, 0, 0)), stats))
+    teams = [(_scalar(team, 'id'), _scalar(team, 'totalShips'), team_ships.get(_scalar(team, 'id') or '', 0))
+             for team in items(state, 'teams')]
+    goals = [(_scalar(goal, 'id'),) + by_goal.get(_scalar(goal, 'id'), (0, 0, 0))
+             for goal in items(state, 'mainGoals')]
+    return _matrix_result(teams, [key + (count,) for key, count in sorted(cells.items())], islands, goals)
+
+def search_expression(text):
+    """FTS5 query matching entries with a word starting with each term in text."""
+    terms = re.findall(r'\w+', text)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+def read_search(conn, expression, limit, state_id=None):
+    """Best matches for expression, optionally within one board.
+
+    Returns (score, board key, hit) tuples, lowest (best) score first. Title
+    matches weigh ten times as much as description matches.
+    """
+    if state_id is not None:
+        expression = f'board : b{state_id} AND {{title description}} : ({expression})'
+    else:
+        expression = f'{{title description}} : ({expression})'
+    rows = conn.execute("""
+        SELECT bm25(search_index, 10.0, 1.0, 0.0) AS score, gamestate.key, kind, entity_id, island_id,
+               search_index.title, search_index.description
+        FROM search_index JOIN gamestate ON gamestate.id = search_index.state_id
+        WHERE search_index MATCH ? ORDER BY score LIMIT ?""", (expression, limit))
+    return [(score, key, {"kind": kind, "id": entity_id, "islandId": island_id, "title": title,
+                          "desc": description})
+            for score, key, kind, entity_id, island_id, title, description in rows]
+
+def read_kpis(conn, completed, start, end, limit, state_id=None, team_id=None):
+    """Open KPIs whose deadline is in [start, end), or completed KPIs whose
+    completion time is.
+
+    Rows come off the (completed, deadline) or completion time indexes in
+    that order, each with its board, island, main goals and the teams
+    deployed on it. Returns at most limit + 1 rows so callers can tell
+    whether there are more.
+    """
+    if completed:
+        # Drive the join from kpi_completions so the completed_at range comes
+        # off its indexes in order; +k.completed keeps kpis on idx_kpis_id
+        source = "kpi_completions c CROSS JOIN kpis k ON k.state_id = c.state_id AND k.id = c.kpi_id"
+        where = ["+k.completed = 1", "c.completed_at >= ?", "c.completed_at < ?"]
+        when, order, board = "c.completed_at", "c.completed_at", "c.state_id"
+    else:
+        source = "kpis k"
+        where = ["k.completed = 0", "k.deadline >= ?", "k.deadline < ?"]
+        when, order, board = "NULL", "k.deadline", "k.state_id"
+    params = [start, end]
+    if state_id is not None:
+        where.append(f"{board} = ?")
+        params.append(state_id)
+    if team_id is not None:
+        where.append("k.id IN (SELECT kpi_id FROM kpi_assignments a WHERE a.state_id = k.state_id AND a.team_id = ?)")
+        params.append(team_id)
+    rows = conn.execute(f"""
+        SELECT g.key, k.id, k.description, k.deadline, k.completed, {when}, i.id, i.title,
+            (SELECT json_group_array(json_object('id', m.id, 'title', m.title))
+             FROM json_each(i.main_goal_ids) j JOIN main_goals m ON m.state_id = k.state_id AND m.id = j.value),
+            (SELECT json_group_array(json_object('id', t.id, 'name', t.name))
+             FROM (SELECT DISTINCT team_id FROM kpi_assignments a WHERE a.state_id = k.state_id AND a.kpi_id = k.id) a
+             JOIN teams t ON t.state_id = k.state_id AND t.id = a.team_id)
+        FROM {source}
+        JOIN gamestate g ON g.id = k.state_id
+        JOIN islands i ON i.state_id = k.state_id AND i.key = k.island_key
+        WHERE {' AND '.join(where)}
+        ORDER BY {order}, k.state_id, i.pos, k.pos LIMIT ?""", params + [limit + 1])
+    return [{"board": key, "id": kpi_id, "desc": description, "deadline": deadline, "completed": bool(done),
+             "completedAt": completed_at, "island": {"id": island_id, "title": island_title},
+             "mainGoals": json.loads(goals), "teams": json.loads(teams)}
+            for key, kpi_id, description, deadline, done, completed_at, island_id, island_title, goals, teams in rows]
+
+class FleetConnection(sqlite3.Connection):
+    """A pooled connection; rows written through it are compressed if compress is set."""
+    compress = False
+
+def _compresses(conn):
+    # Plain sqlite3 connections write uncompressed rows
+    return getattr(conn, 'compress', False)
+
+class ConnectionPool(object):
+    """Reusable connections to one SQLite file.
+
+    Connections run in WAL mode so readers never wait for the writer, and
+    are handed out LIFO so a quiet server keeps reusing a warm one.
+    """
+
+    def __init__(self, path, size, busy_timeout=5.0, mmap_size=0, compress=False):
+        self.path = path
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self.mmap_size = mmap_size
+        self.compress = compress
+        self.pid = os.getpid()
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False,
+                               factory=FleetConnection)
+        conn.compress = self.compress
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        return conn
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            can_open = self.opened < self.size
+            if can_open:
+                self.opened += 1
+        if can_open:
+            try:
+                return self._open()
+            except Exception:
+                with self.lock:
+                    self.opened -= 1
+                raise
+        try:
+            return self.idle.get(timeout=self.busy_timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"No free connection to {self.path}")
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; commits on success, rolls back on error."""
+        conn = self.acquire()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+def find_board(conn, board_id):
+    """Return (state_id, rev) for board_id, or None if it doesn't exist."""
+    return conn.execute("SELECT id, rev FROM gamestate WHERE key=?", (board_id,)).fetchone()
+
+def stored_hash(conn, state_id):
+    """canonical_hash() of the board's current state, or None if unknown."""
+    return conn.execute("SELECT content_hash FROM gamestate WHERE id=?", (state_id,)).fetchone()[0]
+
+def create_board(conn, board_id):
+    cursor = conn.execute("INSERT INTO gamestate (key, data, layout) VALUES (?, '{}', 1)", (board_id,))
+    return cursor.lastrowid
+
+# body is None for entries that only record that a newer revision exists
+CachedState = namedtuple('CachedState', 'rev body etag checked_at')
+
+class BoardStore(object):
+    """The database files behind one app, with their pools and caches.
+
+    Nothing is opened until a board is first used. Each file then gets its
+    schema (and migrations) once, and the file holding DEFAULT_BOARD is
+    seeded with seed_state. The remaining arguments configure row
+    compression, the write-behind buffer, change streams and admission
+    control; each defaults to the module setting it replaces.
+    """
+
+    def __init__(self, db_file=DB_FILE, shards=(), pool_size=DB_POOL_SIZE, busy_timeout=DB_BUSY_TIMEOUT,
+                 mmap_size=DB_MMAP_SIZE, seed_state=None, compression=STORAGE_COMPRESSION,
+                 flush_interval=WRITE_BEHIND_INTERVAL, max_streams=MAX_STREAMS, write_limits=None,
+                 max_pending_writes=MAX_PENDING_WRITES):
+        self.files = list(shards) or [db_file]
+        self.pool_size = pool_size
+        self.busy_timeout = busy_timeout
+        self.mmap_size = mmap_size
+        self.compression = compression
+        self.seed_state = DEFAULT_STATE if seed_state is None else seed_state
+        self.pools = {}
+        self.ready = set()
+        self.lock = threading.Lock()
+        self.state_cache = {}
+        self.state_cache_bytes = 0
+        self.state_cache_lock = threading.Lock()
+        self.write_behind = WriteBehindBuffer(self, flush_interval)
+        self.changes = ChangeBroker(max_streams)
+        self.admission = AdmissionControl(write_limits, max_pending_writes)
+
+    def shard_for(self, board_id):
+        # crc32 is stable across processes, unlike hash()
+        return self.files[zlib.crc32(board_id.encode('utf-8')) % len(self.files)]
+
+    def _pool(self, path):
+        pool = self.pools.get(path)
+        # Connections must not be shared with a forked worker process
+        if pool is None or pool.pid != os.getpid():
+            with self.lock:
+                pool = self.pools.get(path)
+                if pool is None or pool.pid != os.getpid():
+                    pool = ConnectionPool(path, self.pool_size, self.busy_timeout, self.mmap_size, self.compression)
+                    if path not in self.ready:
+                        self._init_file(pool)
+                        self.ready.add(path)
+                    self.pools[path] = pool
+        return pool
+
+    def connect_path(self, path):
+        """Borrow a pooled connection; commits on success, rolls back on error."""
+        return self._pool(path).connection()
+
+    def connect(self, board_id):
+        return self.connect_path(self.shard_for(board_id))
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                if pool.pid == os.getpid():
+                    pool.close()
+            self.pools.clear()
+
+    def _init_file(self, pool):
+        with pool.connection() as conn:
+            conn.executescript(SCHEMA + SPATIAL_SCHEMA + MATRIX_SCHEMA + MATRIX_TOTALS_SCHEMA + SEARCH_SCHEMA + ASSIGNMENT_SCHEMA
+                               + COMPLETION_SCHEMA)
+            # Hold the write lock so workers starting together migrate once
+            conn.execute("BEGIN IMMEDIATE")
+            # Databases from before revisions, normalized storage and boards
+            # only have id and data, which holds the whole document
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(gamestate)")]
+            if 'key' not in columns:
+                conn.execute("ALTER TABLE gamestate ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+                conn.execute("ALTER TABLE gamestate ADD COLUMN layout INTEGER NOT NULL DEFAULT 0")
+                conn.execute("ALTER TABLE gamestate ADD COLUMN key TEXT")
+                conn.execute("ALTER TABLE gamestate ADD COLUMN title TEXT")
+                conn.execute("ALTER TABLE gamestate ADD COLUMN updated_at TEXT")
+                conn.execute("ALTER TABLE gamestate ADD COLUMN content_hash TEXT")
+                conn.execute("ALTER TABLE gamestate ADD COLUMN size INTEGER")
+                # The single-fleet row becomes the default board
+                conn.execute("UPDATE gamestate SET key = CASE id WHEN 1 THEN ? ELSE 'board-' || id END",
+                             (DEFAULT_BOARD,))
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_gamestate_key ON gamestate (key)")
+            for state_id, data in conn.execute("SELECT id, data FROM gamestate WHERE layout=0").fetchall():
+                write_state(conn, state_id, _load_row(data) if data else self.seed_state)
+            if self.shard_for(DEFAULT_BOARD) == pool.path and find_board(conn, DEFAULT_BOARD) is None:
+                write_state(conn, create_board(conn, DEFAULT_BOARD), self.seed_state,
+                            canonical_hash(self.seed_state))
+            # Seeded and migrated boards start at a revision no save logged;
+            # snapshot it so ?rev= and ?at= can still reach it
+            for state_id, rev in conn.execute("SELECT id, rev FROM gamestate g WHERE NOT EXISTS "
+                                              "(SELECT 1 FROM history h WHERE h.state_id = g.id)").fetchall():
+                record_history(conn, state_id, rev, read_state(conn, state_id), None)
+
+    # --- Serialized state cache ---
+
+    def _remember(self, cache_key, entry):
+        """Store entry unless the cache already knows about a newer revision."""
+        with self.state_cache_lock:
+            current = self.state_cache.get(cache_key)
+            if current is not None and current.rev > entry.rev:
+                return
+            if current is not None:
+                self._forget(cache_key)
+            self.state_cache[cache_key] = entry
+            self.state_cache_bytes += len(entry.body or b'')
+            while self.state_cache and (len(self.state_cache) > STATE_CACHE_SIZE
+                                        or self.state_cache_bytes > STATE_CACHE_BYTES):
+                self._forget(next(iter(self.state_cache)))
+
+    def _forget(self, cache_key):
+        entry = self.state_cache.pop(cache_key)
+        self.state_cache_bytes -= len(entry.body or b'')
+
+    def invalidate_cached_state(self, board_id, rev):
+        self._remember((self.shard_for(board_id), board_id), CachedState(rev, None, None, 0))
+
+    def cached_state(self, board_id):
+        """Return the CachedState for board_id, or None if the board doesn't exist."""
+        pending = self.write_behind.serialized(board_id)
+        if pending is not None:
+            return pending
+        cache_key = (self.shard_for(board_id), board_id)
+        with self.state_cache_lock:
+            entry = self.state_cache.get(cache_key)
+            if entry is not None:
+                # Re-inserting moves the entry to the most recently used end
+                del self.state_cache[cache_key]
+                self.state_cache[cache_key] = entry
+        now = time.monotonic()
+        if entry is not None and entry.body is not None and now - entry.checked_at < STATE_CACHE_TTL:
+            return entry
+
+        state = None
+        with timed('db'), self.connect(board_id) as conn:
+            # Read the revision and the rows from the same snapshot
+            conn.execute("BEGIN")
+            board = find_board(conn, board_id)
+            if board is None:
+                return None
+            state_id, rev = board
+            if entry is None or entry.body is None or entry.rev != rev:
+                state = read_state(conn, state_id)
+        if state is None:
+            entry = entry._replace(checked_at=now)
+        else:
+            with timed('serialize'):
+                body = current_app.json.dumps(state).encode('utf-8')
+                entry = CachedState(rev, body, hashlib.sha1(body).hexdigest(), now)
+        self._remember(cache_key, entry)
+        return entry
+
+def get_store():
+    """The BoardStore of the app handling the current request."""
+    return current_app.extensions['fleet']
+
+# --- JSON Patch (RFC 6902) ---
+
+class PatchError(ValueError):
+    pass
+
+class PatchConflict(PatchError):
+    """A 'test' operation did not match the stored document."""
+
+class RevisionConflict(Exception):
+    """The client's base revision is no longer the current one."""
+
+    def __init__(self, rev):
+        super().__init__(f"Board is at revision {rev}")
+        self.rev = rev
+
+class Unchanged(Exception):
+    """The saved state is identical to the board's current revision."""
+
+    def __init__(self, rev):
+        super().__init__(f"Board is already at this state (revision {rev})")
+        self.rev = rev
+
+def _parse_pointer(path):
+    if not isinstance(path, str):
+        raise PatchError(f"Invalid JSON pointer: {path!r}")
+    if path == '':
+        return []
+    if not path.startswith('/'):
+        raise PatchError(f"Invalid JSON pointer: {path!r}")
+    return [token.replace('~1', '/').replace('~0', '~') for token in path[1:].split('/')]
+
+def _list_index(container, token, allow_end=False):
+    if allow_end and token == '-':
+        return len(container)
+    if not token.isdigit() or (token != '0' and token.startswith('0')):
+        raise PatchError(f"Invalid array index: {token!r}")
+    index = int(token)
+    limit = len(container) if allow_end else len(container) - 1
+    if index > limit:
+        raise PatchError(f"Array index out of range: {index}")
+    return index
+
+def _get_child(container, token):
+    if isinstance(container, dict):
+        if token not in container:
+            raise PatchError(f"Path not found: {token!r}")
+        return container[token]
+    if isinstance(container, list):
+        return container[_list_index(container, token)]
+    raise PatchError(f"Cannot traverse into {type(container).__name__}")
+
+def _resolve(doc, tokens):
+    for token in tokens:
+        doc = _get_child(doc, token)
+    return doc
+
+def _add(doc, tokens, value):
+    if not tokens:
+        return value
+    parent = _resolve(doc, tokens[:-1])
+    key = tokens[-1]
+    if isinstance(parent, dict):
+        parent[key] = value
+    elif isinstance(parent, list):
+        parent.insert(_list_index(parent, key, allow_end=True), value)
+    else:
+        raise PatchError(f"Cannot add to {type(parent).__name__}")
+    return doc
+
+def _remove(doc, tokens):
+    if not tokens:
+        raise PatchError("Cannot remove the document root")
+    parent = _resolve(doc, tokens[:-1])
+    key = tokens[-1]
+    if isinstance(parent, dict):
+        if key not in parent:
+            raise PatchError(f"Path not found: {key!r}")
+        return parent.pop(key)
+    if isinstance(parent, list):
+        return parent.pop(_list_index(parent, key))
+    raise PatchError(f"Cannot remove from {type(parent).__name__}")
+
+def _copied(value, budget):
+    """Deep copy value, charging its serialized size to budget, a one-item list of bytes left."""
+    if budget is not None:
+        budget[0] -= len(json.dumps(value, separators=(',', ':')))
+        if budget[0] < 0:
+            raise StateTooLarge("Patch adds too much data")
+    return copy.deepcopy(value)
+
+def apply_patch(doc, ops, limit=None):
+    """Apply a list of RFC 6902 operations to doc and return the result.
+
+    doc is modified in place, so pass a copy if the original must survive a
+    failed patch. limit caps the bytes the values added, replaced and copied
+    may take together, so a few 'copy' ops can't double the document over
+    and over; StateTooLarge is raised once they pass it.
+    """
+    if not isinstance(ops, list):
+        raise PatchError("Patch must be a list of operations")
+    budget = None if limit is None else [limit]
+    for op in ops:
+        if not isinstance(op, dict) or 'op' not in op or 'path' not in op:
+            raise PatchError(f"Malformed operation: {op!r}")
+        name = op['op']
+        tokens = _parse_pointer(op['path'])
+        if name in ('add', 'replace', 'test') and 'value' not in op:
+            raise PatchError(f"'{name}' requires a value")
+        if name == 'add':
+            doc = _add(doc, tokens, _copied(op['value'], budget))
+        elif name == 'remove':
+            _remove(doc, tokens)
+        elif name == 'replace':
+            if tokens:
+                _remove(doc, tokens)
+            doc = _add(doc, tokens, _copied(op['value'], budget))
+        elif name in ('move', 'copy'):
+            source = _parse_pointer(op.get('from'))
+            if name == 'move':
+                if tokens[:len(source)] == source and tokens != source:
+                    raise PatchError("Cannot move a value into one of its children")
+                value = _remove(doc, source)
+            else:
+                value = _copied(_resolve(doc, source), budget)
+            doc = _add(doc, tokens, value)
+        elif name == 'test':
+            if _resolve(doc, tokens) != op['value']:
+                raise PatchConflict(f"Test failed at {op['path']!r}")
+        else:
+            raise PatchError(f"Unknown operation: {name!r}")
+    return doc
+
+def _escape_token(token):
+    return token.replace('~', '~0').replace('/', '~1')
+
+def diff_states(before, after, path='', ops=None):
+    """Return JSON Patch operations that turn before into after."""
+    if ops is None:
+        ops = []
+    if isinstance(before, dict) and isinstance(after, dict):
+        for key in before:
+            child = f"{path}/{_escape_token(key)}"
+            if key not in after:
+                ops.append({"op": "remove", "path": child})
+            else:
+                diff_states(before[key], after[key], child, ops)
+        for key in after:
+            if key not in before:
+                ops.append({"op": "add", "path": f"{path}/{_escape_token(key)}", "value": after[key]})
+    elif isinstance(before, list) and isinstance(after, list):
+        common = min(len(before), len(after))
+        for i in range(common):
+            diff_states(before[i], after[i], f"{path}/{i}", ops)
+        for value in after[common:]:
+            ops.append({"op": "add", "path": f"{path}/-", "value": value})
+        for i in range(len(before) - 1, common - 1, -1):
+            ops.append({"op": "remove", "path": f"{path}/{i}"})
+    # Compare types too, otherwise True == 1 would hide a change
+    elif type(before) is not type(after) or before != after:
+        ops.append({"op": "replace", "path": path, "value": after})
+    return ops
+
+# --- Save validation ---
+
+class InvalidState(ValueError):
+    """A saved state doesn't have the shape of DEFAULT_STATE.
+
+    path holds the JSON pointer tokens of the offending value; they are
+    collected while the error unwinds so valid states never build paths.
+    """
+
+    def __init__(self, message, path=()):
+        super().__init__(message)
+        self.message = message
+        self.path = list(path)
+
+    def __str__(self):
+        pointer = ''.join(f'/{_escape_token(str(token))}' for token in self.path)
+        return f"{pointer or '/'} {self.message}"
+
+class BodyTooLarge(ValueError):
+    pass
+
+class StateTooLarge(ValueError):
+    """A patch would grow the board past MAX_SAVE_BODY."""
+
+def check_state_size(size):
+    if size > MAX_SAVE_BODY:
+        raise StateTooLarge(f"Patched state would be {size} bytes, over the {MAX_SAVE_BODY} byte limit")
+
+# name: (allowed types, extra test or None, error message)
+SCALAR_TYPES = {
+    'string': ((str,), None, 'must be a string'),
+    'number': ((int, float), math.isfinite, 'must be a finite number'),
+    'count': ((int,), lambda v: v >= 0, 'must be a non-negative integer'),
+    'boolean': ((bool,), None, 'must be true or false'),
+    'array': ((list,), None, 'must be an array'),
+}
+_MISSING = object()
+_TYPE_NAMES = {str: 'a string', int: 'a number', float: 'a number', bool: 'a boolean',
+               list: 'an array', dict: 'an object'}
+
+def _base_types(spec):
+    if isinstance(spec, str):
+        return SCALAR_TYPES[spec][0]
+    return (list,) if isinstance(spec, list) else (dict,)
+
+def compile_schema(spec):
+    """Turn spec into a check(value) function that raises InvalidState.
+
+    spec is a name from SCALAR_TYPES, [item_spec] for an array, a dict for
+    an object (keys ending in '!' are required, the others optional, and
+    unknown keys are allowed), or a tuple of alternatives with different
+    JSON types. Scalars inside objects and arrays are checked inline, so
+    a valid state costs one call per object rather than one per value.
+    Types are compared exactly, which keeps booleans out of numbers.
+    """
+    if isinstance(spec, str):
+        types, test, message = SCALAR_TYPES[spec]
+
+        def check(value):
+            if type(value) not in types or (test is not None and not test(value)):
+                raise InvalidState(message)
+    elif isinstance(spec, list):
+        item = spec[0]
+        if isinstance(item, str):
+            types, test, message = SCALAR_TYPES[item]
+
+            def check(value):
+                if type(value) is not list:
+                    raise InvalidState('must be an array')
+                for i, element in enumerate(value):
+                    if type(element) not in types or (test is not None and not test(element)):
+                        raise InvalidState(message, [i])
+        else:
+            check_item = compile_schema(item)
+
+            def check(value):
+                if type(value) is not list:
+                    raise InvalidState('must be an array')
+                for i, element in enumerate(value):
+                    try:
+                        check_item(element)
+                    except InvalidState as e:
+                        e.path.insert(0, i)
+                        raise
+    elif isinstance(spec, dict):
+        required = tuple(key[:-1] for key in spec if key.endswith('!'))
+        scalars = tuple((key.rstrip('!'),) + SCALAR_TYPES[field]
+                        for key, field in spec.items() if isinstance(field, str))
+        nested = tuple((key.rstrip('!'), compile_schema(field))
+                       for key, field in spec.items() if not isinstance(field, str))
+
+        def check(value):
+            if type(value) is not dict:
+                raise InvalidState('must be an object')
+            for key in required:
+                if key not in value:
+                    raise InvalidState('is required', [key])
+            for key, types, test, message in scalars:
+                field = value.get(key, _MISSING)
+                if field is not _MISSING and (type(field) not in types or (test is not None and not test(field))):
+                    raise InvalidState(message, [key])
+            for key, check_field in nested:
+                field = value.get(key, _MISSING)
+                if field is not _MISSING:
+                    try:
+                        check_field(field)
+                    except InvalidState as e:
+                        e.path.insert(0, key)
+                        raise
+    else:
+        by_type = {}
+        for option in spec:
+            check_option = compile_schema(option)
+            for base in _base_types(option):
+                by_type[base] = check_option
+        message = 'must be ' + ' or '.join(dict.fromkeys(_TYPE_NAMES[base] for base in by_type))
+
+        def check(value):
+            check_option = by_type.get(type(value))
+            if check_option is None:
+                raise InvalidState(message)
+            check_option(value)
+    return check
+
+KPI_SCHEMA = {'id!': 'string', 'desc': 'string', 'deadline': 'string', 'completed': 'boolean', 'assigned': 'array'}
+DEPLOYMENT_SCHEMA = ({'islandId!': 'string', 'deploymentId': 'string', 'kpiIds': ['string'], 'kpiId': 'string'},
+                     'string')
+TEAM_SCHEMA = {'id!': 'string', 'name': 'string', 'icon': 'string', 'color': 'string',
+               'totalShips': 'count', 'deployed': [DEPLOYMENT_SCHEMA]}
+MAIN_GOAL_SCHEMA = {'id!': 'string', 'title': 'string', 'desc': 'string', 'icon': 'string',
+                    'x': 'number', 'y': 'number'}
+ISLAND_SCHEMA = {'id!': 'string', 'title': 'string', 'desc': 'string', 'icon': 'string',
+                 'x': 'number', 'y': 'number', 'mainGoalId': 'string', 'mainGoalIds': ['string'],
+                 'expanded': 'boolean', 'kpis': ([KPI_SCHEMA], 'string')}
+STATE_SCHEMA = {
+    'projectTitle': 'string',
+    'teams!': [TEAM_SCHEMA],
+    'mainGoals': [MAIN_GOAL_SCHEMA],
+    'islands!': [ISLAND_SCHEMA],
+}
+_check_state = compile_schema(STATE_SCHEMA)
+# For patches that check only the entities they reach
+_check_entity = {'teams': compile_schema(TEAM_SCHEMA), 'mainGoals': compile_schema(MAIN_GOAL_SCHEMA),
+                 'islands': compile_schema(ISLAND_SCHEMA)}
+
+def _items(parent, key):
+    value = parent.get(key) if isinstance(parent, dict) else None
+    return value if isinstance(value, list) else []
+
+def _island_kpis(island):
+    # Legacy islands keep their KPIs as free text, with nothing to refer to
+    return {_scalar(kpi, 'id') for kpi in _items(island, 'kpis') if type(kpi) is dict}
+
+def _deployment_dangling(t, d, dep, island_kpis):
+    """Yield (path, message, reference) for each reference of deployment d of team t that doesn't resolve.
+
+    island_kpis(island_id) returns the island's KPI ids, or None if there
+    is no such island.
+    """
+    if type(dep) is not str and type(dep) is not dict:
+        return
+    island_id = dep if type(dep) is str else _scalar(dep, 'islandId')
+    kpis = island_kpis(island_id)
+    if kpis is None:
+        path = ['teams', t, 'deployed', d] + ([] if type(dep) is str else ['islandId'])
+        yield path, f"refers to unknown island {island_id!r}", (island_id, None)
+        return
+    for kpi_id in _kpi_ids(dep):
+        if kpi_id not in kpis:
+            yield (['teams', t, 'deployed', d],
+                   f"refers to KPI {kpi_id!r}, which island {island_id!r} doesn't have", (island_id, kpi_id))
+
+def _dangling_references(state):
+    """Yield (path, message, reference) for each deployment reference that doesn't resolve.
+
+    Tolerates any document, so it can also look at boards stored before
+    states were validated.
+    """
+    island_kpis = {_scalar(island, 'id'): _island_kpis(island) for island in _items(state, 'islands')}
+    for t, team in enumerate(_items(state, 'teams')):
+        for d, dep in enumerate(_items(team, 'deployed')):
+            yield from _deployment_dangling(t, d, dep, island_kpis.get)
+
+def dangling_references(state):
+    """Count of each (island id, KPI id or None) reference in state that doesn't resolve."""
+    counts = {}
+    for _, _, reference in _dangling_references(state):
+        counts[reference] = counts.get(reference, 0) + 1
+    return counts
+
+def _check_references(state, existing=None):
+    """Every deployment must target an existing island and KPIs of that island.
+
+    existing is the dangling_references() of the state a patch started from;
+    that many of each are let through, so a board stored with broken
+    references can still be patched as long as the patch adds none.
+    """
+    _refuse_dangling(_dangling_references(state), existing)
+
+def _refuse_dangling(dangling, existing):
+    """Raise InvalidState for the first of dangling beyond the counts in existing."""
+    allowed = dict(existing or {})
+    for path, message, reference in dangling:
+        if allowed.get(reference, 0) > 0:
+            allowed[reference] -= 1
+            continue
+        raise InvalidState(message, path)
+
+def validate_state(state, references=True, existing=None):
+    """Raise InvalidState unless state is shaped like DEFAULT_STATE and its references resolve.
+
+    references=False checks only the shape, for imports of boards saved
+    before references were enforced. existing is passed on to
+    _check_references for patched states.
+    """
+    _check_state(state)
+    if references:
+        _check_references(state, existing)
+
+def read_json_body(limit):
+    """Parse the request body as JSON, raising BodyTooLarge as soon as it passes limit bytes.
+
+    A declared Content-Length over the limit is refused before anything is
+    read; chunked bodies are cut off once the bytes read so far exceed it.
+    """
+    if request.content_length is not None and request.content_length > limit:
+        raise BodyTooLarge(request.content_length)
+    stream = request.stream
+    chunks = []
+    size = 0
+    while True:
+        chunk = stream.read(64 * 1024)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            raise BodyTooLarge(size)
+        chunks.append(chunk)
+    return _loads(b''.join(chunks))
+
+def _reject_constant(name):
+    raise ValueError(f"{name} is not valid JSON")
+
+def _finite_float(text):
+    value = float(text)
+    if not math.isfinite(value):
+        raise ValueError(f"{text} is out of range")
+    return value
+
+def _loads(data):
+    """json.loads, with bodies nested too deeply to parse reported as ValueError.
+
+    NaN, Infinity and numbers too large for a float are refused too: they
+    would be stored and served back as bare NaN/Infinity, which browsers
+    can't parse.
+    """
+    try:
+        return json.loads(data, parse_constant=_reject_constant, parse_float=_finite_float)
+    except RecursionError:
+        raise ValueError("JSON nested too deeply")
+
+# --- Revision history ---
+
+def record_history(conn, state_id, rev, state, delta, base_rev=None):
+    """Append revision rev to the board's history.
+
+    delta holds the operations that produced it from base_rev (rev - 1 by
+    default), or None if unknown. A full snapshot is stored instead every
+    HISTORY_SNAPSHOT_INTERVAL revisions and whenever base_rev isn't in the
+    log; state may be None to have it read back from the board's rows then.
+    """
+    base_rev = rev - 1 if base_rev is None else base_rev
+    has_previous = delta is not None and conn.execute(
+        "SELECT 1 FROM history WHERE state_id=? AND rev=?", (state_id, base_rev)).fetchone()
+    if has_previous and rev % HISTORY_SNAPSHOT_INTERVAL:
+        kind, data = 'delta', delta
+    else:
+        kind, data = 'snapshot', state if state is not None else read_state(conn, state_id)
+    conn.execute("INSERT INTO history (state_id, rev, ts, kind, data) VALUES (?, ?, ?, ?, ?)",
+                 (state_id, rev, time.time(), kind, _dump_row(data, _compresses(conn), separators=(',', ':'))))
+    if kind == 'snapshot':
+        compact_history(conn, state_id, rev)
+
+def compact_history(conn, state_id, latest_rev, keep=None):
+    """Drop history that isn't needed to rebuild the last `keep` revisions.
+
+    Everything before the newest snapshot that still precedes the window is
+    deleted, so the log never grows past keep + HISTORY_SNAPSHOT_INTERVAL
+    entries. Returns the number of entries removed.
+    """
+    keep = HISTORY_KEEP if keep is None else keep
+    if not keep:
+        return 0
+    floor = conn.execute(
+        "SELECT max(rev) FROM history WHERE state_id=? AND kind='snapshot' AND rev<=?",
+        (state_id, latest_rev - keep + 1)).fetchone()[0]
+    if floor is None:
+        return 0
+    return conn.execute("DELETE FROM history WHERE state_id=? AND rev<?", (state_id, floor)).rowcount
+
+def state_at_rev(conn, state_id, rev):
+    """Rebuild revision rev from its nearest snapshot, or None if it isn't logged."""
+    if conn.execute("SELECT 1 FROM history WHERE state_id=? AND rev=?", (state_id, rev)).fetchone() is None:
+        return None
+    snapshot = conn.execute(
+        "SELECT rev, data FROM history WHERE state_id=? AND kind='snapshot' AND rev<=? ORDER BY rev DESC LIMIT 1",
+        (state_id, rev)).fetchone()
+    if snapshot is None:
+        return None
+    state = _load_row(snapshot[1])
+    for data, in conn.execute(
+            "SELECT data FROM history WHERE state_id=? AND rev>? AND rev<=? ORDER BY rev",
+            (state_id, snapshot[0], rev)):
+        state = apply_patch(state, _load_row(data))
+    return state
+
+def rev_at_time(conn, state_id, ts):
+    """Return the revision that was current at unix time ts, or None."""
+    return conn.execute("SELECT max(rev) FROM history WHERE state_id=? AND ts<=?", (state_id, ts)).fetchone()[0]
+
+def commit_revision(conn, state_id, rev, state, delta, base_rev=None, content_hash=None, size=None):
+    """Store state as revision rev of the board. Does not commit."""
+    write_state(conn, state_id, state, content_hash, size)
+    conn.execute("UPDATE gamestate SET rev=? WHERE id=?", (rev, state_id))
+    record_history(conn, state_id, rev, state, delta, base_rev)
+
+def save_state(conn, board_id, state, content_hash, base_rev=None):
+    """Store state as the board's next revision, creating the board if needed.
+
+    Runs inside the caller's write transaction and returns (rev, delta).
+    Raises RevisionConflict if base_rev is given and stale, and Unchanged if
+    the board already holds state; the transaction may still need committing
+    then, to keep a backfilled content hash.
+    """
+    with timed('db'):
+        board = find_board(conn, board_id)
+        current = board[1] if board else 0
+        if base_rev is not None and base_rev != current:
+            raise RevisionConflict(current)
+        # Autosaves often resend what is already stored
+        if board and stored_hash(conn, board[0]) == content_hash:
+            raise Unchanged(current)
+        stored = read_state(conn, board[0]) if board else None
+    if board:
+        state_id = board[0]
+        with timed('diff'):
+            delta = diff_states(stored, state)
+        if delta == []:
+            # Same state, but stored before its hash was known; the caller's transaction keeps it
+            conn.execute("UPDATE gamestate SET content_hash=? WHERE id=?", (content_hash, state_id))
+            raise Unchanged(current)
+    else:
+        state_id, delta = create_board(conn, board_id), None
+    with timed('db'):
+        commit_revision(conn, state_id, current + 1, state, delta, content_hash=content_hash)
+    return current + 1, delta
+
+# --- Partial patches ---
+#
+# Most patches change a field or two of a single entity. Rather than
+# assembling, checking and rewriting the whole board, a PatchScope loads the
+# skeleton and just the top-level entities the ops reach, with their
+# children. Everything else stays a placeholder the ops never look inside,
+# so checks, size accounting and writes cost O(entities reached). Ops on the
+# root or on a whole collection, and boards whose ids aren't unique, fall
+# back to patching the whole document.
+
+class PartialPatchUnsupported(Exception):
+    """The patch has to be applied to the whole document."""
+
+# Stands in for a stored entity the patch doesn't reach
+_UNREACHED = object()
+_COLLECTION_KEYS = dict(COLLECTIONS)
+
+def _collections_named(ops):
+    """The top-level collections any pointer in ops starts in."""
+    named = set()
+    for op in ops if isinstance(ops, list) else ():
+        for field in ('path', 'from'):
+            pointer = op.get(field) if isinstance(op, dict) else None
+            if isinstance(pointer, str) and pointer.startswith('/'):
+                token = pointer[1:].split('/', 1)[0]
+                if token in _COLLECTION_KEYS:
+                    named.add(token)
+    return named
+
+def _patch_reach(ops, lengths):
+    """Replay ops on the order of the collections in lengths ({key: entity count}).
+
+    Returns (order, reached): order[key] lists the stored position of each
+    entity in the patched collection, None for added ones, and reached[key]
+    is the set of stored positions whose entity an op reads or changes.
+    Moving an entity within its collection reaches nothing; its row just
+    moves. Raises PartialPatchUnsupported for ops on the root or on a
+    whole collection, and for anything apply_patch would refuse, which
+    the whole-document patch then reports.
+    """
+    if not isinstance(ops, list):
+        raise PartialPatchUnsupported()
+    order = {key: list(range(n)) for key, n in lengths.items()}
+    reached = {key: set() for key in lengths}
+
+    def locate(pointer):
+        try:
+            tokens = _parse_pointer(pointer)
+        except PatchError:
+            raise PartialPatchUnsupported()
+        if tokens and tokens[0] not in _COLLECTION_KEYS:
+            return None
+        if len(tokens) < 2 or tokens[0] not in order:
+            raise PartialPatchUnsupported()
+        return tokens[0], tokens[1], len(tokens) == 2
+
+    def index(key, token, allow_end=False):
+        try:
+            return _list_index(order[key], token, allow_end)
+        except PatchError:
+            raise PartialPatchUnsupported()
+
+    def reach(key, token):
+        pos = order[key][index(key, token)]
+        if pos is not None:
+            reached[key].add(pos)
+
+    for op in ops:
+        if not isinstance(op, dict) or op.get('op') not in ('add', 'remove', 'replace', 'move', 'copy', 'test'):
+            raise PartialPatchUnsupported()
+        name = op['op']
+        target = locate(op.get('path'))
+        source = locate(op.get('from')) if name in ('move', 'copy') else None
+        if name == 'move' and source and target and source[2] and target[2] and source[0] == target[0]:
+            key = source[0]
+            pos = order[key].pop(index(key, source[1]))
+            order[key].insert(index(key, target[1], allow_end=True), pos)
+            continue
+        if source is not None:
+            reach(*source[:2])
+            if name == 'move' and source[2]:
+                order[source[0]].pop(index(*source[:2]))
+        if target is None:
+            continue
+        key, token, whole = target
+        if not whole or name in ('remove', 'replace', 'test'):
+            reach(key, token)
+        if whole and name in ('remove', 'replace'):
+            order[key].pop(index(key, token))
+        if whole and name != 'remove' and name != 'test':
+            order[key].insert(index(key, token, allow_end=True), None)
+    return order, reached
+
+class PatchScope(object):
+    """The skeleton of a board and the entities a patch reaches.
+
+    state is the document the patch is applied to: the skeleton with each
+    collection the ops name refilled, a copy of the stored entity where an
+    op reaches one and a stand-in everywhere else. `before` keeps the
+    reached entities as stored. Subclasses load them and answer for the
+    entities left out.
+    """
+
+    def __init__(self, skeleton, ops, entities):
+        """entities holds the stand-ins for each collection named by ops."""
+        self.lengths = {key: len(items) for key, items in entities.items()}
+        self.order, self.reached = _patch_reach(ops, self.lengths)
+        self.state = dict(skeleton)
+        self.before = {}
+        for key, items in entities.items():
+            self.before[key] = self._load(key, sorted(self.reached[key]))
+            self.state[key] = list(items)
+            for pos, entity in self.before[key].items():
+                self.state[key][pos] = copy.deepcopy(entity)
+
+    def patched(self, key):
+        """(position, entity) for each entity of collection key the patch reached or added."""
+        reached = self.reached[key]
+        return [(q, self.state[key][q]) for q, pos in enumerate(self.order[key]) if pos is None or pos in reached]
+
+    def check(self):
+        """validate_state() for the patched state, looking only at what the patch reached.
+
+        Raises InvalidState, or PartialPatchUnsupported if the patched ids
+        are no longer unique.
+        """
+        skeleton = dict(self.state)
+        for key in self.order:
+            skeleton[key] = []
+        _check_state(skeleton)
+        for key in self.order:
+            ids = []
+            for q, entity in self.patched(key):
+                try:
+                    _check_entity[key](entity)
+                except InvalidState as e:
+                    e.path[:0] = [key, q]
+                    raise
+                ids.append(entity['id'])
+            if (any(entity_id.startswith('#') for entity_id in ids) or len(set(ids)) != len(ids)
+                    or self._ids_taken(key, ids)):
+                raise PartialPatchUnsupported()
+        self._check_references()
+
+    def _check_references(self):
+        """_check_references() for the deployments whose references the patch can have broken.
+
+        Those are the deployments of the teams it reached and the ones
+        targeting an island it reached, before and after the patch.
+        """
+        before = {_scalar(island, 'id'): _island_kpis(island) for island in self.before.get('islands', {}).values()}
+        after = {island['id']: _island_kpis(island) for _, island in self.patched('islands')} \
+            if 'islands' in self.order else {}
+        teams = self.order.get('teams')
+        reached_teams = self.reached.get('teams', ())
+        others = [(pos, d, dep) for pos, d, dep in self._deployments_on((set(before) | set(after)) - {None})
+                  if pos not in reached_teams]
+
+        def resolve(islands):
+            def island_kpis(island_id):
+                return islands[island_id] if island_id in islands else self._island_kpis(island_id)
+            return island_kpis
+
+        existing = {}
+        old_deps = [(pos, d, dep) for pos, team in self.before.get('teams', {}).items()
+                    for d, dep in enumerate(_items(team, 'deployed'))]
+        for pos, d, dep in old_deps + others:
+            for _, _, reference in _deployment_dangling(pos, d, dep, resolve(before)):
+                existing[reference] = existing.get(reference, 0) + 1
+        new_deps = []
+        if teams is not None:
+            new_deps = [(q, d, dep) for q, team in self.patched('teams') for d, dep in enumerate(_items(team, 'deployed'))]
+            moved = {pos: q for q, pos in enumerate(teams) if pos is not None}
+            others = [(moved[pos], d, dep) for pos, d, dep in others]
+        _refuse_dangling((dangling for t, d, dep in sorted(new_deps + others, key=lambda dep: dep[:2])
+                          for dangling in _deployment_dangling(t, d, dep, resolve(after))), existing)
+
+    def _load(self, key, positions):
+        """{position: entity} of the stored entities of collection key at positions."""
+        raise NotImplementedError
+
+    def _ids_taken(self, key, ids):
+        """Whether an entity of collection key the patch didn't reach has one of ids."""
+        raise NotImplementedError
+
+    def _island_kpis(self, island_id):
+        """KPI ids of the last island with island_id the patch didn't reach, or None."""
+        raise NotImplementedError
+
+    def _deployments_on(self, island_ids):
+        """(stored team position, position, deployment) of each stored deployment targeting island_ids."""
+        raise NotImplementedError
+
+class StoredPatchScope(PatchScope):
+    """A PatchScope read from a board's rows, which write() then updates."""
+
+    def __init__(self, conn, state_id, ops):
+        row = conn.execute("SELECT data, size FROM gamestate WHERE id=?", (state_id,)).fetchone()
+        skeleton = _load_row(row[0]) if row is not None else None
+        if not isinstance(skeleton, dict) or row[1] is None:
+            raise PartialPatchUnsupported()
+        self.conn, self.state_id, self.skeleton, self.size = conn, state_id, skeleton, row[1]
+        self.keys = {}
+        entities = {}
+        for key in _collections_named(ops):
+            table = _COLLECTION_KEYS[key]
+            # Collections that aren't lists were never moved out of the
+            # skeleton; entities keyed by position would need new keys
+            if skeleton.get(key) != [] or conn.execute(
+                    f"SELECT 1 FROM {table} WHERE state_id=? AND key >= '#' AND key < '$'", (state_id,)).fetchone():
+                raise PartialPatchUnsupported()
+            count = conn.execute(f"SELECT count(*) FROM {table} WHERE state_id=?", (state_id,)).fetchone()[0]
+            entities[key] = [_UNREACHED] * count
+        super().__init__(skeleton, ops, entities)
+
+    def _load(self, key, positions):
+        table = _COLLECTION_KEYS[key]
+        self.keys[key] = {}
+        loaded = {}
+        for pos, entity_key, data in self.conn.execute(
+                f"SELECT pos, key, data FROM {table} WHERE state_id=? AND pos IN (SELECT value FROM json_each(?))",
+                (self.state_id, json.dumps(positions))):
+            self.keys[key][pos] = entity_key
+            loaded[entity_key] = _load_row(data)
+        if table in CHILD_TABLES:
+            child_table, parent_col, child_key = CHILD_TABLES[table]
+            for parent_key, data in self.conn.execute(
+                    f"SELECT {parent_col}, data FROM {child_table} WHERE state_id=? AND {parent_col} IN "
+                    "(SELECT value FROM json_each(?)) ORDER BY pos", (self.state_id, json.dumps(list(loaded)))):
+                loaded[parent_key][child_key].append(_load_row(data))
+        return {pos: loaded[entity_key] for pos, entity_key in self.keys[key].items()}
+
+    def _ids_taken(self, key, ids):
+        return any(pos not in self.reached[key] for pos, in self.conn.execute(
+            f"SELECT pos FROM {_COLLECTION_KEYS[key]} WHERE state_id=? AND id IN (SELECT value FROM json_each(?))",
+            (self.state_id, json.dumps(ids))))
+
+    def _island_kpis(self, island_id):
+        island = self.conn.execute("SELECT key, pos FROM islands WHERE state_id=? AND id=? ORDER BY pos DESC LIMIT 1",
+                                   (self.state_id, island_id)).fetchone()
+        if island is None or island[1] in self.reached.get('islands', ()):
+            return None
+        return {kpi_id for kpi_id, in self.conn.execute(
+            "SELECT id FROM kpis WHERE state_id=? AND island_key=?", (self.state_id, island[0]))}
+
+    def _deployments_on(self, island_ids):
+        return [(pos, d, _load_row(data)) for pos, d, data in self.conn.execute(
+            "SELECT t.pos, d.pos, d.data FROM deployments d JOIN teams t ON t.state_id = d.state_id "
+            "AND t.key = d.team_key WHERE d.state_id=? AND d.island_id IN (SELECT value FROM json_each(?))",
+            (self.state_id, json.dumps(sorted(island_ids))))]
+
+    def _patched_skeleton(self):
+        skeleton = dict(self.state)
+        for key in self.order:
+            skeleton[key] = []
+        return skeleton
+
+    def patched_size(self):
+        """len(canonical_json()) of the patched board, worked out from the stored size."""
+        size = self.size + len(canonical_json(self._patched_skeleton())) - len(canonical_json(self.skeleton))
+        for key in self.order:
+            # Entities in a list are separated by a comma each
+            size += max(len(self.order[key]) - 1, 0) - max(self.lengths[key] - 1, 0)
+            size += sum(len(canonical_json(entity)) for _, entity in self.patched(key))
+            size -= sum(len(canonical_json(entity)) for entity in self.before[key].values())
+        return size
+
+    def write(self, size):
+        """Store the patched entities, renumbering those they pushed along. Does not commit."""
+        rows = {table: {} for table in TABLE_KEYS}
+        scopes = {}
+        for key in self.order:
+            table = _COLLECTION_KEYS[key]
+            scope = list(self.keys[key].values())
+            for q, entity in self.patched(key):
+                ENTITY_ROWS[table](rows, entity['id'], q, entity, _compresses(self.conn))
+                scope.append(entity['id'])
+            scopes[table] = ('key', scope)
+            if table in CHILD_TABLES:
+                child_table, parent_col, _ = CHILD_TABLES[table]
+                scopes[child_table] = (parent_col, scope)
+            _renumber(self.conn, table, self.state_id, sorted(
+                (pos, q) for q, pos in enumerate(self.order[key])
+                if pos is not None and pos != q and pos not in self.reached[key]))
+        _write_rows(self.conn, self.state_id, rows, scopes)
+        skeleton = self._patched_skeleton()
+        self.conn.execute(
+            "UPDATE gamestate SET data=?, title=?, updated_at=CURRENT_TIMESTAMP, content_hash=NULL, size=? WHERE id=?",
+            (_dump_row(skeleton, _compresses(self.conn)), _scalar(skeleton, 'projectTitle'), size, self.state_id))
+
+class PendingPatchScope(PatchScope):
+    """A PatchScope over a document in memory, which it leaves untouched.
+
+    The patched state shares every entity the patch didn't reach with the
+    original.
+    """
+
+    def __init__(self, state, ops):
+        if not isinstance(state, dict):
+            raise PartialPatchUnsupported()
+        self.original = state
+        entities = {}
+        for key in _collections_named(ops):
+            items = state.get(key)
+            if not isinstance(items, list) or len({_scalar(item, 'id') for item in items}) != len(items):
+                raise PartialPatchUnsupported()
+            entities[key] = items
+        # Other top-level values are small, and ops may change them in place
+        super().__init__({key: value if key in _COLLECTION_KEYS else copy.deepcopy(value)
+                          for key, value in state.items()}, ops, entities)
+
+    def _load(self, key, positions):
+        return {pos: self.original[key][pos] for pos in positions}
+
+    def _ids_taken(self, key, ids):
+        reached = self.reached[key]
+        taken = {_scalar(item, 'id') for pos, item in enumerate(self.original[key]) if pos not in reached}
+        return not taken.isdisjoint(ids)
+
+    def _island_kpis(self, island_id):
+        if not hasattr(self, '_unreached_islands'):
+            reached = self.reached.get('islands', ())
+            self._unreached_islands = {_scalar(island, 'id'): _island_kpis(island)
+                                       for pos, island in enumerate(_items(self.original, 'islands'))
+                                       if pos not in reached}
+        return self._unreached_islands.get(island_id)
+
+    def _deployments_on(self, island_ids):
+        return [(pos, d, dep) for pos, team in enumerate(_items(self.original, 'teams'))
+                for d, dep in enumerate(_items(team, 'deployed'))
+                if (dep if type(dep) is str else _scalar(dep, 'islandId')) in island_ids]
+
+def _renumber(conn, table, state_id, moves):
+    """Move the rows at stored position p to q for each (p, q) in moves, sorted by p.
+
+    Runs of rows shifted by the same amount move in one statement, by way
+    of negative positions so that no statement picks up a row another one
+    already moved.
+    """
+    runs = []
+    for pos, new_pos in moves:
+        if runs and runs[-1][1] == pos - 1 and runs[-1][2] == new_pos - pos:
+            runs[-1][1] = pos
+        else:
+            runs.append([pos, pos, new_pos - pos])
+    for first, last, shift in runs:
+        conn.execute(f"UPDATE {table} SET pos = -1 - (pos + ?) WHERE state_id=? AND pos BETWEEN ? AND ?",
+                     (shift, state_id, first, last))
+    if runs:
+        conn.execute(f"UPDATE {table} SET pos = -1 - pos WHERE state_id=? AND pos < 0", (state_id,))
+
+def patch_state(conn, state_id, rev, ops):
+    """Apply ops to the board's revision rev and store the result as rev + 1.
+
+    Runs inside the caller's write transaction and does not commit. Only
+    the entities the ops reach are read, checked and written when a
+    PatchScope can hold them; otherwise the whole document is. Raises
+    PatchError, InvalidState or StateTooLarge.
+    """
+    try:
+        with timed('db'):
+            scope = StoredPatchScope(conn, state_id, ops)
+        apply_patch(scope.state, ops, MAX_SAVE_BODY)
+        with timed('validate'):
+            scope.check()
+        size = scope.patched_size()
+        check_state_size(size)
+        with timed('db'):
+            scope.write(size)
+            conn.execute("UPDATE gamestate SET rev=? WHERE id=?", (rev + 1, state_id))
+            record_history(conn, state_id, rev + 1, None, ops)
+        return
+    except PartialPatchUnsupported:
+        pass
+    with timed('db'):
+        state = read_state(conn, state_id)
+    existing = dangling_references(state)
+    state = apply_patch(state, ops, MAX_SAVE_BODY)
+    with timed('validate'):
+        validate_state(state, existing=existing)
+    size = len(canonical_json(state))
+    check_state_size(size)
+    with timed('db'):
+        commit_revision(conn, state_id, rev + 1, state, ops, size=size)
+
+# --- Write-behind buffer ---
+
+# entry caches the serialized body once a load asks for it; stored_rev is
+# the SQLite revision the buffered writes build on
+PendingWrite = namedtuple('PendingWrite', 'state rev entry content_hash stored_rev')
+
+class WriteBehindBuffer(object):
+    """Latest unsaved state per board, committed by a background thread.
+
+    While a board has a pending write, the in-memory copy is authoritative:
+    loads, saves and patches all go through it.
+    """
+
+    def __init__(self, store, interval=WRITE_BEHIND_INTERVAL):
+        self.store = store
+        self.interval = interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        # Bumped by each flush, so writes based on SQLite can tell it moved
+        self.flushes = 0
+        self.wake = threading.Event()
+        self.thread = None
+        self.stopping = False
+
+    def get(self, board_id):
+        return self.pending.get(board_id)
+
+    def _base(self, board_id):
+        """Return (seen, (state, rev, content_hash, stored_rev)) a write builds on.
+
+        Called without the lock, so that SQLite reads and patching don't
+        hold up other boards; seen lets _put check that nothing replaced
+        the base meanwhile. The base is None for a board that doesn't exist
+        yet.
+        """
+        seen = (self.flushes, self.pending.get(board_id))
+        pending = seen[1]
+        if pending is not None:
+            return seen, (pending.state, pending.rev, pending.content_hash, pending.stored_rev)
+        with self.store.connect(board_id) as conn:
+            conn.execute("BEGIN")
+            board = find_board(conn, board_id)
+            if board is None:
+                return seen, None
+            return seen, (read_state(conn, board[0]), board[1], stored_hash(conn, board[0]), board[1])
+
+    def _put(self, board_id, seen, write):
+        """Store write if the board's base is still the one _base saw.
+
+        Returns the number of dirty boards, or None if another save or a
+        flush got there first and the caller must start over.
+        """
+        with self.lock:
+            flushes, pending = seen
+            if self.flushes != flushes or self.pending.get(board_id) is not pending:
+                return None
+            self.pending[board_id] = write
+            return len(self.pending)
+
+    def save(self, board_id, state, base_rev=None, content_hash=None):
+        """Buffer state as the board's next revision.
+
+        Returns (rev, delta); delta is None for a new board. Raises
+        Unchanged if state is what the board already holds.
+        """
+        while True:
+            seen, base = self._base(board_id)
+            current_state, current, current_hash, stored_rev = base if base is not None else (None, 0, None, 0)
+            if base_rev is not None and base_rev != current:
+                raise RevisionConflict(current)
+            if content_hash is not None and content_hash == current_hash:
+                raise Unchanged(current)
+            delta = diff_states(current_state, state) if base is not None else None
+            if delta == []:
+                raise Unchanged(current)
+            dirty = self._put(board_id, seen, PendingWrite(state, current + 1, None, content_hash, stored_rev))
+            if dirty is not None:
+                break
+        self._schedule(dirty)
+        return current + 1, delta
+
+    def patch(self, board_id, base_rev, ops):
+        while True:
+            seen, base = self._base(board_id)
+            if base is None:
+                raise LookupError(board_id)
+            state, rev, _, stored_rev = base
+            if rev != base_rev:
+                raise RevisionConflict(rev)
+            # Patch a copy so a failing op leaves the pending state intact
+            try:
+                scope = PendingPatchScope(state, ops)
+                patched = apply_patch(scope.state, ops, MAX_SAVE_BODY)
+                with timed('validate'):
+                    scope.check()
+            except PartialPatchUnsupported:
+                existing = dangling_references(state)
+                patched = apply_patch(copy.deepcopy(state), ops, MAX_SAVE_BODY)
+                with timed('validate'):
+                    validate_state(patched, existing=existing)
+            data = canonical_json(patched)
+            check_state_size(len(data))
+            dirty = self._put(board_id, seen, PendingWrite(patched, rev + 1, None, hashlib.sha1(data).hexdigest(),
+                                                                 stored_rev))
+            if dirty is not None:
+                break
+        self._schedule(dirty)
+        return rev + 1
+
+    def serialized(self, board_id):
+        """Return a CachedState for the pending write, or None if there is none."""
+        pending = self.pending.get(board_id)
+        if pending is None:
+            return None
+        if pending.entry is None:
+            body = current_app.json.dumps(pending.state).encode('utf-8')
+            entry = CachedState(pending.rev, body, hashlib.sha1(body).hexdigest(), time.monotonic())
+            with self.lock:
+                if self.pending.get(board_id) is pending:
+                    self.pending[board_id] = pending._replace(entry=entry)
+            return entry
+        return pending.entry
+
+    def flush(self):
+        """Commit every pending board, one transaction per shard.
+
+        Returns the number of boards written.
+        """
+        with self.flush_lock:
+            batch = dict(self.pending)
+            by_shard = {}
+            for board_id, pending in batch.items():
+                by_shard.setdefault(self.store.shard_for(board_id), []).append((board_id, pending))
+            refused = set()
+            for path, boards in by_shard.items():
+                with self.store.connect_path(path) as conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    for board_id, pending in boards:
+                        if not self._commit(conn, board_id, pending):
+                            refused.add(board_id)
+            with self.lock:
+                self.flushes += 1
+                for board_id, pending in batch.items():
+                    # Hand the body over to the load cache before letting go
+                    if pending.entry is not None and board_id not in refused:
+                        self.store._remember((self.store.shard_for(board_id), board_id), pending.entry)
+                    else:
+                        self.store.invalidate_cached_state(board_id, pending.rev)
+                    if self.pending.get(board_id) is pending:
+                        del self.pending[board_id]
+            return len(batch) - len(refused)
+
+    def _commit(self, conn, board_id, pending):
+        """Write pending to SQLite, or return False if the board moved on without it.
+
+        The stored revision only changes behind the buffer's back when
+        another process writes the board; committing then would overwrite
+        that write, so the buffered one is dropped instead.
+        """
+        board = find_board(conn, board_id)
+        stored_rev = board[1] if board else 0
+        if stored_rev != pending.stored_rev:
+            logger.error("Dropped buffered revision %d of board %r: it was written elsewhere (now at %d)",
+                         pending.rev, board_id, stored_rev)
+            return False
+        if board:
+            state_id = board[0]
+            delta = diff_states(read_state(conn, state_id), pending.state)
+        else:
+            state_id, delta = create_board(conn, board_id), None
+        # Revisions coalesced in memory are never logged; the delta spans them
+        commit_revision(conn, state_id, pending.rev, pending.state, delta, base_rev=stored_rev,
+                        content_hash=pending.content_hash)
+        return True
+
+    def _schedule(self, dirty):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                    self.thread.start()
+                    atexit.register(self.stop)
+        if dirty >= WRITE_BEHIND_MAX_DIRTY:
+            self.wake.set()
+
+    def _run(self):
+        while not self.stopping:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Pending writes stay in memory and are retried next round
+                logger.exception("Write-behind flush failed")
+
+    def stop(self):
+        """Stop the flusher thread and write out whatever is still pending."""
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.stopping = False
+        self.flush()
+
+# --- Change stream ---
+
+ChangeEvent = namedtuple('ChangeEvent', 'rev ops')
+
+class ChangeChannel(object):
+    def __init__(self):
+        self.events = deque(maxlen=STREAM_BACKLOG)
+        self.cond = threading.Condition()
+        self.listeners = 0
+
+    @property
+    def rev(self):
+        return self.events[-1].rev if self.events else None
+
+    def since(self, after):
+        """Events newer than after, or a single reload event if some were dropped."""
+        if not self.events or self.events[-1].rev <= after:
+            return []
+        if self.events[0].rev > after + 1:
+            return [ChangeEvent(self.events[-1].rev, None)]
+        return [event for event in self.events if event.rev > after]
+
+class ChangeBroker(object):
+    """Fans out board changes to /api/stream subscribers in this process.
+
+    Subscribers block on their board's Condition rather than polling, so an
+    idle stream costs a parked thread, or a greenlet under --gevent. Channels
+    are kept in least recently used order, and past STREAM_CHANNELS the
+    oldest ones nobody is subscribed to are dropped.
+    """
+
+    def __init__(self, max_streams=MAX_STREAMS):
+        self.max_streams = max_streams
+        self.channels = {}
+        self.subscribers = 0
+        self.lock = threading.Lock()
+
+    def join(self, board_id):
+        """Count a new subscriber in, or return False if max_streams (0: no limit) are open."""
+        with self.lock:
+            if self.max_streams and self.subscribers >= self.max_streams:
+                return False
+            self.subscribers += 1
+            self._channel(board_id).listeners += 1
+            return True
+
+    def leave(self, board_id):
+        with self.lock:
+            self.subscribers -= 1
+            self._channel(board_id).listeners -= 1
+
+    def _channel(self, board_id):
+        # Re-inserting moves the channel to the most recently used end
+        channel = self.channels.pop(board_id, None) or ChangeChannel()
+        self.channels[board_id] = channel
+        if len(self.channels) > STREAM_CHANNELS:
+            idle = [key for key, other in self.channels.items() if not other.listeners and other is not channel]
+            for key in idle[:len(self.channels) - STREAM_CHANNELS]:
+                del self.channels[key]
+        return channel
+
+    def channel(self, board_id):
+        with self.lock:
+            return self._channel(board_id)
+
+    def publish(self, board_id, rev, ops):
+        """Announce revision rev; ops of None tells clients to reload."""
+        channel = self.channel(board_id)
+        with channel.cond:
+            channel.events.append(ChangeEvent(rev, ops))
+            channel.cond.notify_all()
+
+    def wait(self, board_id, after, timeout):
+        """Return events newer than after, waiting up to timeout for one."""
+        channel = self.channel(board_id)
+        with channel.cond:
+            events = channel.since(after)
+            if not events:
+                channel.cond.wait(timeout)
+                events = channel.since(after)
+            return events
+
+def _format_event(board_id, event):
+    payload = {"board": board_id, "rev": event.rev}
+    if event.ops is None:
+        payload["reload"] = True
+    else:
+        payload["ops"] = event.ops
+    return f"id: {event.rev}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n"
+
+def _parse_timestamp(value):
+    """Accept unix seconds or ISO 8601; naive times are taken as UTC."""
+    try:
+        return float(value)
+    except ValueError:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.timestamp()
+
+def load_past_state(board_id):
+    """Serve /api/load?rev=N or ?at=<timestamp> from the history log."""
+    try:
+        rev = int(request.args['rev']) if 'rev' in request.args else None
+        ts = _parse_timestamp(request.args['at']) if 'at' in request.args else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid rev or at"}), 400
+
+    with get_store().connect(board_id) as conn:
+        conn.execute("BEGIN")
+        board = find_board(conn, board_id)
+        if board is not None:
+            if rev is None:
+                rev = rev_at_time(conn, board[0], ts)
+            state = state_at_rev(conn, board[0], rev) if rev is not None else None
+            if state is not None:
+                response = jsonify(state)
+                response.headers['X-Fleet-Revision'] = str(rev)
+                return response
+    return jsonify({"status": "error", "message": "Revision not available"}), 404
+
+# --- Metrics ---
+
+# Prometheus metrics on /metrics and Server-Timing headers on /api/ responses.
+# Counts are per process. Boards past METRICS_MAX_BOARDS share one label.
+METRICS = True
+METRICS_MAX_BOARDS = 1000
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(10))
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape_label(v)}"' for k, v in pairs) + '}'
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name, self.help_text = name, help_text
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for labels, value in sorted(self.series.items()):
+                lines.append(f'{self.name}{_format_labels(labels)} {value}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name, self.help_text, self.buckets = name, help_text, buckets
+        # labels -> [count per bucket..., count above the last bucket, sum]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for labels, series in sorted(self.series.items()):
+                total = 0
+                for bound, count in zip(self.buckets + ('+Inf',), series):
+                    total += count
+                    lines.append(f'{self.name}_bucket{_format_labels(labels, [("le", bound)])} {total}')
+                lines.append(f'{self.name}_sum{_format_labels(labels)} {series[-1]}')
+                lines.append(f'{self.name}_count{_format_labels(labels)} {total}')
+        return lines
+
+request_duration = Histogram('fleet_http_request_duration_seconds',
+                             'Time spent handling requests.', LATENCY_BUCKETS)
+phase_duration = Histogram('fleet_request_phase_duration_seconds',
+                           'Time spent in each phase of a request (db, serialize, parse, validate, hash, diff, compress).',
+                           LATENCY_BUCKETS)
+request_size = Histogram('fleet_http_request_size_bytes', 'Request body sizes as received.', SIZE_BUCKETS)
+response_size = Histogram('fleet_http_response_size_bytes', 'Response body sizes as sent.', SIZE_BUCKETS)
+board_writes = Counter('fleet_board_writes_total', 'Successful saves and patches per board.')
+write_admissions = Counter('fleet_write_admissions_total',
+                           'Saves and patches admitted, or rejected by the client, board or queue limit.')
+METRIC_FAMILIES = [request_duration, phase_duration, request_size, response_size, board_writes, write_admissions]
+_metric_boards = set()
+
+@contextmanager
+def timed(phase):
+    """Add the time spent in the block to the current request's `phase`."""
+    # start_timer only sets up timings when metrics are on
+    if not has_request_context() or 'timings' not in g:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.timings[phase] = g.timings.get(phase, 0.0) + time.perf_counter() - started
+
+def count_write(board_id, kind):
+    if not current_app.config['METRICS']:
+        return
+    if board_id not in _metric_boards:
+        if len(_metric_boards) >= METRICS_MAX_BOARDS:
+            board_id = '_other'
+        else:
+            _metric_boards.add(board_id)
+    board_writes.inc((('board', board_id), ('kind', kind)))
+
+# --- Admission control ---
+
+class AdmissionControl(object):
+    """Token buckets per client and per board, and a cap on pending writes.
+
+    limits maps 'client' and 'board' to (writes per second, burst); a rate
+    of 0 turns that limit off, as does a max_pending of 0.
+    """
+
+    def __init__(self, limits=None, max_pending=MAX_PENDING_WRITES):
+        self.limits = limits or {'client': (CLIENT_WRITE_RATE, CLIENT_WRITE_BURST),
+                                 'board': (BOARD_WRITE_RATE, BOARD_WRITE_BURST)}
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        # (kind, key) -> (tokens, monotonic time they were counted)
+        self.buckets = {}
+        self.pending = 0
+
+    def _wait(self, key, rate, burst, now):
+        """Refill key's bucket; return 0 if it holds a token, else seconds until it will."""
+        tokens, counted = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - counted) * rate)
+        self.buckets[key] = (tokens, now)
+        return 0.0 if tokens >= 1 else (1 - tokens) / rate
+
+    def _forget_idle(self, now):
+        for key, (tokens, counted) in list(self.buckets.items()):
+            rate, burst = self.limits[key[0]]
+            if not rate or tokens + (now - counted) * rate >= burst:
+                del self.buckets[key]
+
+    def admit(self, client, board_id):
+        """Reserve a write slot, or return (reason, retry_after seconds).
+
+        Admitted callers must call release() when their write is done.
+        """
+        limits = [(key, rate, burst) for key, (rate, burst) in (
+            (('client', client), self.limits['client']),
+            (('board', board_id), self.limits['board'])) if rate]
+        now = time.monotonic()
+        with self.lock:
+            rejection = None
+            if self.max_pending and self.pending >= self.max_pending:
+                rejection = ('queue', 1.0)
+            for key, rate, burst in limits:
+                wait = self._wait(key, rate, burst, now)
+                if wait and rejection is None:
+                    rejection = (key[0], wait)
+            if rejection is None:
+                # Spend only once every bucket has agreed
+                for key, _, _ in limits:
+                    tokens, counted = self.buckets[key]
+                    self.buckets[key] = (tokens - 1, counted)
+                self.pending += 1
+                if len(self.buckets) > ADMISSION_MAX_KEYS:
+                    self._forget_idle(now)
+        return rejection
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+
+def admission_controlled(view):
+    """Mark a view whose requests go through the admission limits (see admit_request)."""
+    view.admission_controlled = True
+    return view
+
+@bp.before_app_request
+def start_timer():
+    if current_app.config['METRICS']:
+        g.timings = {}
+        g.started = time.perf_counter()
+        # Size on the wire, before decompress_request rewrites the length
+        g.request_size = request.content_length
+
+@bp.before_app_request
+def admit_request():
+    """Turn away writes over the admission limits before they touch the body or the database.
+
+    Registered ahead of decompress_request, so a rejected request's body is
+    never read, let alone inflated.
+    """
+    if not getattr(current_app.view_functions.get(request.endpoint), 'admission_controlled', False):
+        return None
+    admission = get_store().admission
+    rejection = admission.admit(request.remote_addr, request.view_args.get('board_id'))
+    if current_app.config['METRICS']:
+        write_admissions.inc((('result', 'admitted' if rejection is None else rejection[0]),))
+    if rejection is not None:
+        reason, retry_after = rejection
+        response = jsonify({"status": "throttled", "reason": reason, "retryAfter": round(retry_after, 3)})
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return response, 429
+    g.admitted = True
+    return None
+
+@bp.teardown_app_request
+def release_admission(exc):
+    if g.pop('admitted', False):
+        get_store().admission.release()
+
+@bp.after_app_request
+def record_metrics(response):
+    """Observe the request and add its phases as a Server-Timing header.
+
+    Registered before compress_response, so it runs after it and the
+    compression time and compressed size are included.
+    """
+    if 'started' not in g:
+        return response
+    elapsed = time.perf_counter() - g.started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    request_duration.observe((('route', route), ('method', request.method),
+                              ('status', response.status_code)), elapsed)
+    for phase, seconds in g.timings.items():
+        phase_duration.observe((('route', route), ('phase', phase)), seconds)
+    if g.get('request_size'):
+        request_size.observe((('route', route),), g.request_size)
+    if not response.is_streamed:
+        response_size.observe((('route', route),), response.calculate_content_length() or 0)
+    if request.path.startswith('/api/'):
+        parts = [f'{phase};dur={seconds * 1000:.2f}' for phase, seconds in g.timings.items()]
+        parts.append(f'total;dur={elapsed * 1000:.2f}')
+        response.headers['Server-Timing'] = ', '.join(parts)
+    return response
+
+# --- HTTP compression ---
+
+_compressed_bodies = {}
+_compressed_lock = threading.Lock()
+COMPRESSED_CACHE_SIZE = 64
+
+def _compress(body, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(body, 6)
+    return zlib.compress(body, 6)
+
+_SAVE_ENDPOINTS = ('fleet.save_game', 'fleet.patch_game')
+
+@bp.before_app_request
+def decompress_request():
+    """Accept gzip or deflate request bodies (Content-Encoding)."""
+    encoding = request.headers.get('Content-Encoding', 'identity').lower()
+    # Imports inflate their body as they read it
+    if encoding == 'identity' or request.endpoint == 'fleet.import_boards':
+        return None
+    if encoding not in ('gzip', 'deflate'):
+        return jsonify({"status": "error", "message": f"Unsupported Content-Encoding: {encoding}"}), 415
+
+    limit = MAX_DECOMPRESSED_BODY
+    # Saves and patches are refused past MAX_SAVE_BODY anyway, so stop there
+    if request.endpoint in _SAVE_ENDPOINTS:
+        limit = min(limit, MAX_SAVE_BODY)
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+    stream = get_input_stream(request.environ)
+    chunks = []
+    size = 0
+    try:
+        with timed('decompress'):
+            while True:
+                chunk = stream.read(64 * 1024)
+                if not chunk:
+                    break
+                # Inflate chunk by chunk so a small bomb can't exhaust memory
+                data = decoder.decompress(chunk, limit + 1 - size)
+                size += len(data)
+                if size > limit or decoder.unconsumed_tail:
+                    return jsonify({"status": "error", "message": "Request body too large"}), 413
+                chunks.append(data)
+    except zlib.error as e:
+        return jsonify({"status": "error", "message": f"Invalid {encoding} body: {e}"}), 400
+    if not decoder.eof:
+        return jsonify({"status": "error", "message": f"Truncated {encoding} body"}), 400
+
+    body = b''.join(chunks)
+    request.environ['wsgi.input'] = io.BytesIO(body)
+    request.environ['CONTENT_LENGTH'] = str(len(body))
+    request.environ.pop('HTTP_CONTENT_ENCODING', None)
+    request.environ.pop('wsgi.input_terminated', None)
+    return None
+
+@bp.after_app_request
+def compress_response(response):
+    """Gzip or deflate JSON and HTML bodies for clients that accept it."""
+    if (not COMPRESS_RESPONSES or response.direct_passthrough or response.is_streamed
+            or response.mimetype not in ('application/json', 'text/html')):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['gzip', 'deflate'])
+    if (encoding is None or response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or response.content_length is not None and response.content_length < COMPRESS_MIN_SIZE):
+        return response
+
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    etag, weak = response.get_etag()
+    # Keyed by the body itself: ETags are only unique within one resource
+    key = (hashlib.sha1(body).digest(), encoding) if etag and not weak else None
+    compressed = _compressed_bodies.get(key) if key else None
+    if compressed is None:
+        with timed('compress'):
+            compressed = _compress(body, encoding)
+        if key:
+            # Bodies with strong ETags are the ones served again, so keep their compressed form
+            with _compressed_lock:
+                if len(_compressed_bodies) >= COMPRESSED_CACHE_SIZE:
+                    _compressed_bodies.pop(next(iter(_compressed_bodies)))
+                _compressed_bodies[key] = compressed
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        # The encoded bytes differ from the identity ones
+        response.set_etag(etag, weak=True)
+    return response
+
+# --- Bulk export/import ---
+
+def export_lines(store, board_ids=None):
+    """Yield one NDJSON line per board: {"id", "rev", "state"}.
+
+    board_ids picks boards (missing ones are skipped); by default every
+    board is exported, shard by shard in id order. Ids are listed
+    EXPORT_PAGE_SIZE at a time and each board is read just before its line
+    is sent, so memory use doesn't grow with the fleet or the page.
+    """
+    def dump(conn, board_id):
+        # The revision and the rows come from the same snapshot
+        conn.execute("BEGIN")
+        board = find_board(conn, board_id)
+        if board is None:
+            return None
+        state = read_state(conn, board[0])
+        return json.dumps({"id": board_id, "rev": board[1], "state": state}, separators=(',', ':')).encode('utf-8') + b'\n'
+
+    if board_ids is not None:
+        for board_id in board_ids:
+            with store.connect(board_id) as conn:
+                line = dump(conn, board_id)
+            if line:
+                yield line
+        return
+    for path in store.files:
+        after = ''
+        while True:
+            with store.connect_path(path) as conn:
+                keys = [key for key, in conn.execute(
+                    "SELECT key FROM gamestate WHERE key > ? ORDER BY key LIMIT ?",
+                    (after, EXPORT_PAGE_SIZE))]
+            for key in keys:
+                with store.connect_path(path) as conn:
+                    line = dump(conn, key)
+                # Boards deleted since the page was listed are skipped
+                if line:
+                    yield line
+            if len(keys) < EXPORT_PAGE_SIZE:
+                break
+            after = keys[-1]
+
+def _gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def _body_chunks(stream, encoding, chunk_size=64 * 1024):
+    """Read a request body in chunks, inflating gzip or deflate as it goes."""
+    decoder = None
+    if encoding in ('gzip', 'deflate'):
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        if decoder is None:
+            yield chunk
+            continue
+        # Bounded output per call keeps a small bomb from exhausting memory
+        while chunk:
+            yield decoder.decompress(chunk, chunk_size)
+            chunk = decoder.unconsumed_tail
+    if decoder is not None and not decoder.eof:
+        raise ValueError(f"Truncated {encoding} body")
+
+def _lines(chunks, max_length=MAX_DECOMPRESSED_BODY):
+    """Split a stream of byte chunks into lines without joining the whole stream.
+
+    A line spread over many chunks is kept as a list of pieces and joined
+    once, and only each new chunk is searched, so long lines cost linear time.
+    """
+    pieces = []
+    size = 0
+    for chunk in chunks:
+        start = 0
+        end = chunk.find(b'\n')
+        while end != -1:
+            pieces.append(chunk[start:end])
+            yield b''.join(pieces)
+            pieces, size = [], 0
+            start = end + 1
+            end = chunk.find(b'\n', start)
+        if start < len(chunk):
+            pieces.append(chunk[start:])
+            size += len(chunk) - start
+            if size > max_length:
+                raise ValueError("Line too long")
+    if pieces:
+        yield b''.join(pieces)
+
+def import_batch(store, batch):
+    """Save (board_id, state) pairs, one transaction per shard.
+
+    Returns the number of boards that changed.
+    """
+    by_shard = {}
+    for board_id, state in batch:
+        by_shard.setdefault(store.shard_for(board_id), []).append((board_id, state))
+    written = []
+    for path, boards in by_shard.items():
+        with store.connect_path(path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for board_id, state in boards:
+                try:
+                    rev, delta = save_state(conn, board_id, state, canonical_hash(state))
+                except Unchanged:
+                    continue
+                written.append((board_id, rev, delta))
+    for board_id, rev, delta in written:
+        store.invalidate_cached_state(board_id, rev)
+        store.changes.publish(board_id, rev, delta)
+        count_write(board_id, 'import')
+    return len(written)
+
+# --- Static assets ---
+
+# The index template marks where the inline initial state goes
+INITIAL_STATE_SLOT = b'<!-- initial state -->'
+
+class StaticAssets(object):
+    """Content fingerprints of the files under static/, and the rendered index page.
+
+    Files are hashed once, on the first page or static request rather than
+    at import, so a ?v=<hash> URL always names the same bytes and browsers
+    can cache it for good. The debug server hashes again on every page load
+    to pick up edits.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._versions = None
+        self.index = None
+
+    @property
+    def versions(self):
+        if self._versions is None:
+            self._versions = self._fingerprint()
+        return self._versions
+
+    def _fingerprint(self):
+        versions = {}
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                path = os.path.join(root, name)
+                with open(path, 'rb') as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()[:12]
+                versions[os.path.relpath(path, self.folder).replace(os.sep, '/')] = digest
+        return versions
+
+    def url(self, filename):
+        return url_for('static', filename=filename, v=self.versions.get(filename))
+
+    def render_index(self):
+        """Return (head, tail, etag) of the index page, split at INITIAL_STATE_SLOT."""
+        if current_app.debug:
+            self._versions = self._fingerprint()
+            self.index = None
+        if self.index is None:
+            modules = sorted(name for name in self.versions if name.startswith('js/') and name.endswith('.js'))
+            # Modules import each other by plain path; the import map points those at the versioned URLs
+            import_map = {"imports": {url_for('static', filename=name): self.url(name) for name in modules}}
+            body = render_template('index.html', asset_url=self.url, import_map=import_map,
+                                   preload=[self.url(name) for name in modules]).encode('utf-8')
+            head, _, tail = body.partition(INITIAL_STATE_SLOT)
+            self.index = (head, tail, hashlib.sha1(body).hexdigest())
+        return self.index
+
+def get_assets():
+    return current_app.extensions['fleet_assets']
+
+def _initial_state_script(board_id):
+    """A JSON script element with the board's state, and an ETag part for it."""
+    entry = get_store().cached_state(board_id)
+    if entry is not None:
+        body, rev, etag = entry.body, entry.rev, entry.etag
+    else:
+        body, rev, etag = current_app.json.dumps(DEFAULT_STATE).encode('utf-8'), 0, 'default'
+    # '<' only occurs inside JSON strings, where \u003c means the same and can't close the element
+    script = (f'<script id="initial-state" type="application/json" data-rev="{rev}">'.encode('utf-8')
+              + body.replace(b'<', b'\\u003c') + b'</script>')
+    return script, etag
+
+@bp.after_app_request
+def cache_static_assets(response):
+    """Let browsers keep static files requested by their current fingerprint."""
+    if request.endpoint == 'static' and response.status_code in (200, 304):
+        version = request.args.get('v')
+        if version and version == get_assets().versions.get(request.view_args.get('filename')):
+            response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    return response
+
+@bp.route('/')
 def home():
-    return render_template('index.html')
-
-@app.route('/api/load', methods=['GET'])
-def load_game():
-    with sqlite3.connect(DB_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT data FROM gamestate WHERE id=1")
-        row = cursor.fetchone()
-        if row:
-            return jsonify(json.loads(row[0]))
-    return jsonify(DEFAULT_STATE)
-
-@app.route('/api/save', methods=['POST'])
-def save_game():
-    try:
-        state = request.json
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.execute("UPDATE gamestate SET data=? WHERE id=1", (json.dumps(state),))
-        return jsonify({"status": "success"})
+    """The app page, rendered once, with the board's state inlined if enabled."""
+    head, tail, etag = get_assets().render_index()
+    body = head + tail
+    board_id = request.args.get('board', DEFAULT_BOARD)
+    if current_app.config['INLINE_INITIAL_STATE'] and re.fullmatch(BoardIdConverter.regex, board_id):
+        script, state_etag = _initial_state_script(board_id)
+        body = head + script + tail
+        etag = f'{etag}-{state_etag}'
+    response = Response(body, mimetype='text/html')
+    response.set_etag(etag)
+    # The page names the current asset versions, so always revalidate it
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@bp.route('/api/load', methods=['GET'], defaults={'board_id': DEFAULT_BOARD})
+@bp.route('/api/boards/<board:board_id>/load', methods=['GET'])
+def load_game(board_id):
+    if 'rev' in request.args or 'at' in request.args:
+        return load_past_state(board_id)
+    entry = get_store().cached_state(board_id)
+    if entry is not None:
+        response = Response(entry.body, mimetype='application/json')
+        response.set_etag(entry.etag)
+        rev = entry.rev
+    else:
+        # Boards that were never saved start out as the demo fleet
+        response = jsonify(DEFAULT_STATE)
+        response.add_etag()
+        rev = 0
+    response.headers['X-Fleet-Revision'] = str(rev)
+    # Let browsers keep the body but revalidate it on every load
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@bp.route('/api/save', methods=['POST'], defaults={'board_id': DEFAULT_BOARD})
+@bp.route('/api/boards/<board:board_id>/save', methods=['POST'])
+@admission_controlled
+def save_game(board_id):
+    """Replace the board's state.
+
+    Sending X-Fleet-Base-Revision makes the save conditional: it is rejected
+    with 409 unless the board is still at that revision. A state identical
+    to the current one is not written; the response says "unchanged".
+    """
+    try:
+        base_rev = request.headers.get('X-Fleet-Base-Revision')
+        base_rev = int(base_rev) if base_rev is not None else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid X-Fleet-Base-Revision"}), 400
+    try:
+        with timed('parse'):
+            state = read_json_body(MAX_SAVE_BODY)
+        with timed('validate'):
+            validate_state(state)
+    except BodyTooLarge:
+        return jsonify({"status": "error", "message": "Request body too large"}), 413
+    except InvalidState as e:
+        return jsonify({"status": "error", "message": f"Invalid state: {e}"}), 400
+    except ValueError as e:
+        return jsonify({"status": "error", "message": f"Invalid JSON: {e}"}), 400
+    store = get_store()
+    try:
+        with timed('hash'):
+            content_hash = canonical_hash(state)
+        if current_app.config['WRITE_BEHIND']:
+            with timed('diff'):
+                rev, delta = store.write_behind.save(board_id, state, base_rev, content_hash)
+        else:
+            with store.connect(board_id) as conn:
+                with timed('db'):
+                    conn.execute("BEGIN IMMEDIATE")
+                try:
+                    rev, delta = save_state(conn, board_id, state, content_hash, base_rev)
+                except Unchanged:
+                    conn.commit()
+                    raise
+            store.invalidate_cached_state(board_id, rev)
+        store.changes.publish(board_id, rev, delta)
+        count_write(board_id, 'save')
+        return jsonify({"status": "success", "rev": rev})
+    except Unchanged as e:
+        return jsonify({"status": "success", "rev": e.rev, "unchanged": True})
+    except RevisionConflict as e:
+        return jsonify({"status": "conflict", "rev": e.rev}), 409
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@bp.route('/api/patch', methods=['POST'], defaults={'board_id': DEFAULT_BOARD})
+@bp.route('/api/boards/<board:board_id>/patch', methods=['POST'])
+@admission_controlled
+def patch_game(board_id):
+    """Apply JSON Patch operations to the stored state.
+
+    Expects {"baseRev": <rev the client last saw>, "ops": [...]}. Patches
+    against an older revision are rejected with 409 so the client can reload.
+    """
+    try:
+        with timed('parse'):
+            body = read_json_body(MAX_SAVE_BODY)
+    except BodyTooLarge:
+        return jsonify({"status": "error", "message": "Request body too large"}), 413
+    except ValueError:
+        body = None
+    # bool is an int subclass, but true is no revision
+    if not isinstance(body, dict) or type(body.get('baseRev')) is not int:
+        return jsonify({"status": "error", "message": "Expected {baseRev, ops}"}), 400
+    store = get_store()
+    if current_app.config['WRITE_BEHIND']:
+        try:
+            rev = store.write_behind.patch(board_id, body['baseRev'], body.get('ops'))
+        except LookupError:
+            return jsonify({"status": "error", "message": "Board not found"}), 404
+        except RevisionConflict as e:
+            return jsonify({"status": "conflict", "rev": e.rev}), 409
+        except StateTooLarge as e:
+            return jsonify({"status": "error", "message": str(e)}), 413
+        except PatchConflict as e:
+            return jsonify({"status": "conflict", "message": str(e)}), 409
+        except PatchError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        except InvalidState as e:
+            return jsonify({"status": "error", "message": f"Invalid state: {e}"}), 400
+        store.changes.publish(board_id, rev, body['ops'])
+        count_write(board_id, 'patch')
+        return jsonify({"status": "success", "rev": rev})
+
+    try:
+        with store.connect(board_id) as conn:
+            # Take the write lock up front so the read-modify-write is atomic
+            conn.execute("BEGIN IMMEDIATE")
+            board = find_board(conn, board_id)
+            if board is None:
+                conn.rollback()
+                return jsonify({"status": "error", "message": "Board not found"}), 404
+            state_id, rev = board
+            if rev != body['baseRev']:
+                conn.rollback()
+                return jsonify({"status": "conflict", "rev": rev}), 409
+            try:
+                patch_state(conn, state_id, rev, body.get('ops'))
+            except StateTooLarge as e:
+                conn.rollback()
+                return jsonify({"status": "error", "message": str(e)}), 413
+            except PatchConflict as e:
+                conn.rollback()
+                return jsonify({"status": "conflict", "rev": rev, "message": str(e)}), 409
+            except PatchError as e:
+                conn.rollback()
+                return jsonify({"status": "error", "message": str(e)}), 400
+            except InvalidState as e:
+                conn.rollback()
+                return jsonify({"status": "error", "message": f"Invalid state: {e}"}), 400
+        store.invalidate_cached_state(board_id, rev + 1)
+        store.changes.publish(board_id, rev + 1, body['ops'])
+        count_write(board_id, 'patch')
+        return jsonify({"status": "success", "rev": rev + 1})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@bp.route('/api/stream', methods=['GET'], defaults={'board_id': DEFAULT_BOARD})
+@bp.route('/api/boards/<board:board_id>/stream', methods=['GET'])
+def stream_changes(board_id):
+    """Server-Sent Events feed of the board's changes.
+
+    Each event carries the new revision and the JSON Patch ops that produced
+    it, or "reload": true when the client has to fetch the full state.
+    Clients pass the revision they loaded as ?since= (EventSource sends
+    Last-Event-ID on reconnect) so nothing between load and subscribe is lost.
+    Revisions saved by other workers are noticed on the next heartbeat and
+    sent as a reload. Past MAX_STREAMS open streams, new ones get 503.
+    """
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        after = int(since) if since is not None else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid revision"}), 400
+    store = get_store()
+    entry = store.cached_state(board_id)
+    current = entry.rev if entry is not None else 0
+    if after is None:
+        after = current
+
+    def generate(after):
+        yield "retry: 3000\n\n"
+        # Changes the channel never saw, or forgot when it was evicted, can't
+        # be replayed; the client has to reload
+        if current > after and (store.changes.channel(board_id).rev or 0) < current:
+            yield _format_event(board_id, ChangeEvent(current, None))
+            after = current
+        while True:
+            events = store.changes.wait(board_id, after, STREAM_HEARTBEAT)
+            if not events:
+                # Other workers' writes never reach this process's channel, so
+                # an idle stream checks the stored revision before going on
+                entry = store.cached_state(board_id)
+                if entry is not None and entry.rev > after:
+                    yield _format_event(board_id, ChangeEvent(entry.rev, None))
+                    after = entry.rev
+                    continue
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+                continue
+            for event in events:
+                yield _format_event(board_id, event)
+            after = events[-1].rev
+
+    if not store.changes.join(board_id):
+        response = jsonify({"status": "busy", "message": "Too many open streams"})
+        response.headers['Retry-After'] = str(int(STREAM_HEARTBEAT))
+        return response, 503
+    # The heartbeat's revision check may have to serialize the board
+    response = Response(stream_with_context(generate(after)), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    response.call_on_close(lambda: store.changes.leave(board_id))
+    return response
+
+@bp.route('/api/entities', methods=['GET'], defaults={'board_id': DEFAULT_BOARD})
+@bp.route('/api/boards/<board:board_id>/entities', methods=['GET'])
+def board_entities(board_id):
+    """Main goals and islands inside ?bbox=minx,miny,maxx,maxy.
+
+    Also returns the deployments to those islands, each tagged with its
+    teamId, so a client can draw just the visible part of a large map and
+    fetch more while panning. A truncated page carries next; pass it back
+    as ?after= (with the same bbox) for the rest. Positions shift when the
+    board changes, so a client should restart when X-Fleet-Revision does.
+    """
+    try:
+        bbox = [float(v) for v in request.args['bbox'].split(',')]
+        if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            raise ValueError
+    except (KeyError, ValueError):
+        return jsonify({"status": "error", "message": "Expected bbox=minx,miny,maxx,maxy"}), 400
+    limit = max(1, min(request.args.get('limit', ENTITY_PAGE_LIMIT, type=int), ENTITY_PAGE_LIMIT))
+    try:
+        after = [int(v) for v in request.args.get('after', '-1,-1').split(',')]
+        if len(after) != 2:
+            raise ValueError
+    except ValueError:
+        return jsonify({"status": "error", "message": "Expected after=<next> from the previous page"}), 400
+
+    store = get_store()
+    pending = store.write_behind.get(board_id)
+    if pending is not None:
+        rev, result = pending.rev, entities_in(pending.state, bbox, limit, after)
+    else:
+        with timed('db'), store.connect(board_id) as conn:
+            conn.execute("BEGIN")
+            board = find_board(conn, board_id)
+            if board is None:
+                # Same fallback as /api/load
+                rev, result = 0, entities_in(DEFAULT_STATE, bbox, limit, after)
+            else:
+                rev, result = board[1], read_entities(conn, board[0], bbox, limit, after)
+    response = jsonify(result)
+    response.headers['X-Fleet-Revision'] = str(rev)
+    return response
+
+@bp.route('/api/matrix', methods=['GET'], defaults={'board_id': DEFAULT_BOARD})
+@bp.route('/api/boards/<board:board_id>/matrix', methods=['GET'])
+def board_matrix(board_id):
+    """Ships per team and island, free ships, and KPI completion per island and main goal.
+
+    The numbers come from aggregate tables kept current by every save, so
+    dashboards can poll this without loading the board.
+    """
+    def respond(rev, matrix):
+        response = Response(mimetype='application/json')
+        response.headers['X-Fleet-Revision'] = str(rev)
+        response.headers['Cache-Control'] = 'no-cache'
+        # Every change bumps the revision, so it stands in for the numbers and
+        # an unchanged board revalidates without reading any of them. Revisions
+        # only count within a board, hence the shard and board in the tag.
+        response.set_etag(f'matrix-{shard}-{board_id}-{rev}')
+        response.make_conditional(request)
+        if response.status_code != 304:
+            response.set_data(current_app.json.dumps(matrix()))
+        return response
+
+    store = get_store()
+    shard = store.files.index(store.shard_for(board_id))
+    pending = store.write_behind.get(board_id)
+    if pending is not None:
+        return respond(pending.rev, lambda: matrix_of(pending.state))
+    with timed('db'), store.connect(board_id) as conn:
+        conn.execute("BEGIN")
+        board = find_board(conn, board_id)
+        if board is None:
+            return respond(0, lambda: matrix_of(DEFAULT_STATE))
+        return respond(board[1], lambda: read_matrix(conn, board[0]))
+
+@bp.route('/api/search', methods=['GET'], defaults={'board_id': None})
+@bp.route('/api/boards/<board:board_id>/search', methods=['GET'])
+def search(board_id):
+    """Main goals, islands and KPIs whose title or description match ?q=.
+
+    Every word in q matches as a prefix, so "mig leg" finds "Migrate legacy
+    users". /api/search looks across all boards, /api/boards/<id>/search
+    within one. Hits are ranked best first and reflect committed saves.
+    """
+    expression = search_expression(request.args.get('q', ''))
+    if not expression:
+        return jsonify({"status": "error", "message": "Expected q=<words>"}), 400
+    limit = max(1, min(request.args.get('limit', 20, type=int), SEARCH_PAGE_LIMIT))
+
+    store = get_store()
+    hits = []
+    with timed('db'):
+        if board_id is not None:
+            with store.connect(board_id) as conn:
+                board = find_board(conn, board_id)
+                if board is not None:
+                    hits = read_search(conn, expression, limit, board[0])
+        else:
+            for path in store.files:
+                with store.connect_path(path) as conn:
+                    hits.extend(read_search(conn, expression, limit))
+            hits.sort(key=lambda hit: hit[0])
+    results = []
+    for score, key, hit in hits[:limit]:
+        hit.update(board=key, score=round(-score, 4))
+        results.append(hit)
+    return jsonify({"results": results})
+
+@bp.route('/api/kpis', methods=['GET'], defaults={'board_id': None})
+@bp.route('/api/boards/<board:board_id>/kpis', methods=['GET'])
+def list_kpis(board_id):
+    """KPIs by deadline: ?status=overdue (the default), upcoming or completed.
+
+    upcoming covers open KPIs due within ?days= (UPCOMING_DAYS); completed
+    lists KPIs completed between the ?from= and ?to= dates (UTC), in the
+    order they were completed. ?today= sets the reference date (the
+    server's by default) and ?team= keeps KPIs that team is deployed on.
+    /api/kpis covers every board, /api/boards/<id>/kpis one.
+    """
+    status = request.args.get('status', 'overdue')
+    try:
+        today = date.fromisoformat(request.args['today']) if 'today' in request.args else date.today()
+        if status == 'overdue':
+            completed, start, end = False, '0001-01-01', today.isoformat()
+        elif status == 'upcoming':
+            days = int(request.args.get('days', UPCOMING_DAYS))
+            if days < 0:
+                raise ValueError
+            completed, start, end = False, today.isoformat(), (today + timedelta(days=days + 1)).isoformat()
+        elif status == 'completed':
+            start = date.fromisoformat(request.args['from']).isoformat() if 'from' in request.args else '0001-01-01'
+            # Completion times carry a time of day, so end just after the last day
+            end = ((date.fromisoformat(request.args['to']) + timedelta(days=1)).isoformat()
+                   if 'to' in request.args else '9999-99-99')
+            completed = True
+        else:
+            raise ValueError
+    except (ValueError, OverflowError):
+        # OverflowError: days or dates that run past the year 9999
+        return jsonify({"status": "error",
+                        "message": "Expected status=overdue|upcoming|completed with YYYY-MM-DD dates"}), 400
+    limit = max(1, min(request.args.get('limit', 100, type=int), KPI_PAGE_LIMIT))
+    team_id = request.args.get('team')
+
+    store = get_store()
+    rows = []
+    with timed('db'):
+        if board_id is not None:
+            with store.connect(board_id) as conn:
+                board = find_board(conn, board_id)
+                if board is not None:
+                    rows = read_kpis(conn, completed, start, end, limit, board[0], team_id)
+        else:
+            for path in store.files:
+                with store.connect_path(path) as conn:
+                    rows.extend(read_kpis(conn, completed, start, end, limit, team_id=team_id))
+            rows.sort(key=lambda row: row['completedAt'] if completed else row['deadline'])
+    return jsonify({"kpis": rows[:limit], "truncated": len(rows) > limit})
+
+@bp.route('/api/export', methods=['GET'])
+def export_boards():
+    """Stream boards as NDJSON, one {"id", "rev", "state"} object per line.
+
+    ?boards=a,b exports just those boards. The body is gzipped on the fly
+    for clients that accept it.
+    """
+    board_ids = request.args.get('boards')
+    board_ids = [b for b in board_ids.split(',') if b] if board_ids is not None else None
+    if board_ids and not all(re.fullmatch(BoardIdConverter.regex, b) for b in board_ids):
+        return jsonify({"status": "error", "message": "Invalid board id"}), 400
+    store = get_store()
+    # Buffered saves would otherwise be missing from the export
+    store.write_behind.flush()
+    body = export_lines(store, board_ids)
+    headers = {'Content-Disposition': 'attachment; filename="fleet.ndjson"'}
+    if COMPRESS_RESPONSES and request.accept_encodings.best_match(['gzip']) == 'gzip':
+        body = _gzip_stream(body)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(body, mimetype='application/x-ndjson', headers=headers)
+
+@bp.route('/api/import', methods=['POST'])
+def import_boards():
+    """Save boards from an NDJSON body as produced by /api/export.
+
+    Each line needs "id" and "state" ("rev" is ignored: imported states
+    become each board's next revision, or nothing if already stored). States
+    must have the saved shape, but may keep deployments whose island or KPI
+    is gone, as older boards can. Lines
+    are parsed as they arrive and committed ?batch= boards at a time, so a
+    bad line leaves every board before it imported.
+    """
+    batch_size = max(1, request.args.get('batch', IMPORT_BATCH_SIZE, type=int))
+    encoding = request.headers.get('Content-Encoding', 'identity').lower()
+    if encoding not in ('identity', 'gzip', 'deflate'):
+        return jsonify({"status": "error", "message": f"Unsupported Content-Encoding: {encoding}"}), 415
+    store = get_store()
+    # Pending saves must not be flushed over the imported states later
+    store.write_behind.flush()
+
+    imported = unchanged = 0
+    batch = []
+    error = None
+    try:
+        for line_no, line in enumerate(_lines(_body_chunks(get_input_stream(request.environ), encoding)), 1):
+            if not line.strip():
+                continue
+            try:
+                with timed('parse'):
+                    entry = _loads(line)
+            except ValueError as e:
+                raise ValueError(f"Line {line_no}: {e}")
+            if (not isinstance(entry, dict) or 'state' not in entry or not isinstance(entry.get('id'), str)
+                    or not re.fullmatch(BoardIdConverter.regex, entry['id'])):
+                raise ValueError(f'Line {line_no}: expected {{"id": <board id>, "state": {{...}}}}')
+            try:
+                with timed('validate'):
+                    validate_state(entry['state'], references=False)
+            except InvalidState as e:
+                raise ValueError(f"Line {line_no}: invalid state: {e}")
+            batch.append((entry['id'], entry['state']))
+            if len(batch) >= batch_size:
+                written = import_batch(store, batch)
+                imported, unchanged, batch = imported + written, unchanged + len(batch) - written, []
+    except (ValueError, zlib.error) as e:
+        error = str(e)
+    if batch:
+        written = import_batch(store, batch)
+        imported, unchanged = imported + written, unchanged + len(batch) - written
+    result = {"status": "success", "imported": imported, "unchanged": unchanged}
+    if error:
+        result.update(status="error", message=error)
+        return jsonify(result), 400
+    return jsonify(result)
+
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of the request and write metrics."""
+    if not current_app.config['METRICS']:
+        return jsonify({"status": "error", "message": "Metrics are disabled"}), 404
+    lines = []
+    for family in METRIC_FAMILIES:
+        lines.extend(family.render())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+@bp.route('/api/flush', methods=['POST'])
+def flush_writes():
+    """Commit pending write-behind saves now."""
+    return jsonify({"status": "success", "flushed": get_store().write_behind.flush()})
+
+@bp.route('/api/boards', methods=['GET'])
+def list_boards():
+    """List boards ordered by id, one page at a time.
+
+    Pass the previous page's `next` value as `after` to continue. Each shard
+    is read through the key index, so pages cost the same however many
+    boards exist.
+    """
+    limit = max(1, min(request.args.get('limit', 50, type=int), BOARD_PAGE_LIMIT))
+    after = request.args.get('after', '')
+    rows = []
+    store = get_store()
+    for path in store.files:
+        with store.connect_path(path) as conn:
+            rows.extend(conn.execute(
+                "SELECT key, title, rev, updated_at FROM gamestate WHERE key > ? ORDER BY key LIMIT ?",
+                (after, limit + 1)))
+    rows.sort()
+    page = rows[:limit]
+    return jsonify({
+        "boards": [{"id": key, "title": title, "rev": rev, "updatedAt": updated_at}
+                   for key, title, rev, updated_at in page],
+        "next": page[-1][0] if len(rows) > limit else None,
+    })
+
+def create_app(config=None):
+    """Build the Flask app.
+
+    config is applied on top of the module defaults. DB_FILE, DB_SHARDS,
+    DB_POOL_SIZE, DB_BUSY_TIMEOUT, DB_MMAP_SIZE, SEED_STATE,
+    STORAGE_COMPRESSION, WRITE_BEHIND_INTERVAL, MAX_STREAMS, the
+    CLIENT_/BOARD_WRITE_RATE and _BURST limits and MAX_PENDING_WRITES
+    configure the app's BoardStore; nothing touches the database until the
+    first request. WRITE_BEHIND, METRICS and INLINE_INITIAL_STATE are read
+    by the views.
+    """
+    app = Flask(__name__)
+    app.url_map.converters['board'] = BoardIdConverter
+    # Serve /api/boards/default/... directly instead of redirecting to /api/...
+    app.url_map.redirect_defaults = False
+    app.config.update(DB_FILE=DB_FILE, DB_SHARDS=DB_SHARDS, DB_POOL_SIZE=DB_POOL_SIZE,
+                      DB_BUSY_TIMEOUT=DB_BUSY_TIMEOUT, DB_MMAP_SIZE=DB_MMAP_SIZE, SEED_STATE=DEFAULT_STATE,
+                      STORAGE_COMPRESSION=STORAGE_COMPRESSION, WRITE_BEHIND=WRITE_BEHIND,
+                      WRITE_BEHIND_INTERVAL=WRITE_BEHIND_INTERVAL, METRICS=METRICS,
+                      CLIENT_WRITE_RATE=CLIENT_WRITE_RATE, CLIENT_WRITE_BURST=CLIENT_WRITE_BURST,
+                      BOARD_WRITE_RATE=BOARD_WRITE_RATE, BOARD_WRITE_BURST=BOARD_WRITE_BURST,
+                      MAX_PENDING_WRITES=MAX_PENDING_WRITES, MAX_STREAMS=MAX_STREAMS,
+                      INLINE_INITIAL_STATE=INLINE_INITIAL_STATE)
+    app.config.update(config or {})
+    app.extensions['fleet'] = BoardStore(
+        app.config['DB_FILE'], app.config['DB_SHARDS'], app.config['DB_POOL_SIZE'],
+        app.config['DB_BUSY_TIMEOUT'], app.config['DB_MMAP_SIZE'], app.config['SEED_STATE'],
+        app.config['STORAGE_COMPRESSION'], app.config['WRITE_BEHIND_INTERVAL'], app.config['MAX_STREAMS'],
+        {'client': (app.config['CLIENT_WRITE_RATE'], app.config['CLIENT_WRITE_BURST']),
+         'board': (app.config['BOARD_WRITE_RATE'], app.config['BOARD_WRITE_BURST'])},
+        app.config['MAX_PENDING_WRITES'])
+    app.extensions['fleet_assets'] = StaticAssets(app.static_folder)
+    app.register_blueprint(bp)
+    return app
+
+# For `gunicorn app:app` and friends
+app = create_app()
+
+def run_production(app, host, port, workers, threads, use_gevent=False):
+    """Serve the app with a production WSGI server.
+
+    A single worker runs on waitress with a thread pool; several workers
+    need gunicorn, which forks them and runs each with its own threads.
+    The write-behind buffer and change stream are per process, so use one
+    worker when relying on either. Both servers give each open change
+    stream a thread of its own (see MAX_STREAMS).
+
+    use_gevent serves every request from a greenlet instead, with gevent's
+    WSGI server or gunicorn's gevent workers, so idle change streams cost
+    no thread. The caller must have monkey-patched the standard library
+    before creating the app.
+
+    SIGTERM and SIGINT stop a single-process server cleanly, so the
+    write-behind buffer is flushed before exit; waitress and gevent would
+    otherwise die without running atexit handlers. gunicorn workers exit
+    through sys.exit, which runs them.
+    """
+    try:
+        _serve(app, host, port, workers, threads, use_gevent)
+    finally:
+        app.extensions['fleet'].write_behind.stop()
+
+def _exit_on_signal(signum, frame):
+    raise SystemExit(0)
+
+def _serve(app, host, port, workers, threads, use_gevent):
+    if use_gevent and workers == 1:
+        import gevent
+        from gevent.pywsgi import WSGIServer
+        server = WSGIServer((host, port), app, log=None)
+        # In a greenlet of their own, where stopping the server may block
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            gevent.signal_handler(signum, server.stop)
+        server.serve_forever()
+    elif workers > 1:
+        from gunicorn.app.base import BaseApplication
+
+        class FleetApplication(BaseApplication):
+            def load_config(self):
+                self.cfg.set('bind', f'{host}:{port}')
+                self.cfg.set('workers', workers)
+                if use_gevent:
+                    self.cfg.set('worker_class', 'gevent')
+                else:
+                    self.cfg.set('threads', threads)
+                    self.cfg.set('worker_class', 'gthread')
+
+            def load(self):
+                return app
+
+        FleetApplication().run()
+    else:
+        from waitress import serve
+        # waitress shuts down on SystemExit, as it does on KeyboardInterrupt
+        signal.signal(signal.SIGTERM, _exit_on_signal)
+        serve(app, host=host, port=port, threads=threads)
+
 import argparse
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Startup Fleet Server')
     parser.add_argument('--port', type=int, default=5000, help='Port to run the server on')
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on')
+    parser.add_argument('--production', action='store_true', help='Serve with waitress/gunicorn instead of the debug server')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes in production mode (more than one needs gunicorn)')
+    parser.add_argument('--threads', type=int, default=8, help='Threads per worker in production mode')
+    parser.add_argument('--gevent', action='store_true',
+                        help='Serve requests from greenlets in production mode, so open change streams hold no thread')
+    parser.add_argument('--pool-size', type=int, default=DB_POOL_SIZE, help='SQLite connections kept open per database file')
+    parser.add_argument('--compress-storage', action='store_true', help='Store new rows zlib-compressed')
+    parser.add_argument('--shards', nargs='+', metavar='DB', help='Spread boards across these SQLite files')
+    parser.add_argument('--write-behind', action='store_true', help='Buffer saves in memory and commit them in the background')
+    parser.add_argument('--flush-interval', type=float, default=WRITE_BEHIND_INTERVAL, help='Seconds between write-behind commits')
+    parser.add_argument('--no-metrics', action='store_true', help='Disable /metrics and Server-Timing headers')
+    parser.add_argument('--client-write-rate', type=float, default=CLIENT_WRITE_RATE,
+                        help='Saves/patches per second per client address, 0 for no limit')
+    parser.add_argument('--board-write-rate', type=float, default=BOARD_WRITE_RATE,
+                        help='Saves/patches per second per board, 0 for no limit')
+    parser.add_argument('--write-burst', type=int, default=CLIENT_WRITE_BURST,
+                        help='Writes a client or board may make at once before its rate applies')
+    parser.add_argument('--max-pending-writes', type=int, default=MAX_PENDING_WRITES,
+                        help='Writes allowed to wait for the database before answering 429, 0 for no limit')
+    parser.add_argument('--max-streams', type=int,
+                        help='Change streams open at once per worker, 0 for no limit '
+                             '(production default: half of --threads, none with --gevent)')
+    parser.add_argument('--inline-state', action='store_true',
+                        help="Embed the board's state in the page instead of fetching it after load")
     args = parser.parse_args()
-    
-    app.run(debug=True, port=args.port)
+    if args.write_behind and args.workers > 1:
+        # Each worker would buffer and flush its own copy of a board
+        parser.error("--write-behind needs a single worker")
+    if args.production and args.gevent:
+        try:
+            from gevent import monkey
+        except ImportError as e:
+            parser.error(f"--gevent needs {e.name}: pip install {e.name}")
+        # Before the app exists, so its locks, queues and threads are cooperative
+        monkey.patch_all()
+
+    config = {
+        'DB_POOL_SIZE': args.pool_size,
+        'STORAGE_COMPRESSION': args.compress_storage,
+        'WRITE_BEHIND': args.write_behind,
+        'WRITE_BEHIND_INTERVAL': args.flush_interval,
+        'METRICS': not args.no_metrics,
+        'CLIENT_WRITE_RATE': args.client_write_rate,
+        'CLIENT_WRITE_BURST': args.write_burst,
+        'BOARD_WRITE_RATE': args.board_write_rate,
+        'BOARD_WRITE_BURST': args.write_burst,
+        'MAX_PENDING_WRITES': args.max_pending_writes,
+        'INLINE_INITIAL_STATE': args.inline_state,
+    }
+    if args.max_streams is not None:
+        config['MAX_STREAMS'] = args.max_streams
+    elif args.production and not args.gevent:
+        # Leave threads for loads and saves
+        config['MAX_STREAMS'] = max(1, args.threads // 2)
+    if args.shards:
+        config['DB_SHARDS'] = args.shards
+    app = create_app(config)
+
+    if args.production:
+        try:
+            run_production(app, args.host, args.port, args.workers, args.threads, args.gevent)
+        except ImportError as e:
+            parser.error(f"--production needs {e.name}: pip install {e.name}")
+    else:
+        app.run(debug=True, host=args.host, port=args.port)
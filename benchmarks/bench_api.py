@@ -0,0 +1,280 @@
+"""Benchmark the board API against synthetic fleets of increasing size.
+
+Each fleet size gets a fresh database in a temporary directory. The script
+measures:
+
+- cold loads (cache invalidated) and warm loads,
+- full saves and single-field patches,
+- payload size, raw and gzipped,
+- database growth over the saves,
+- throughput with several concurrent clients doing mixed loads and patches.
+
+Requests go through Flask's test client, so the numbers cover routing,
+storage and serialization but not the network.
+
+Examples:
+    python benchmarks/bench_api.py --sizes default,small,medium
+    python benchmarks/bench_api.py --sizes large --output results.json
+    python benchmarks/bench_api.py --compare baseline.json --threshold 1.25
+"""
+import argparse
+import gzip
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app as app_module  # noqa: E402
+from fleetgen import PRESETS, generate_state  # noqa: E402
+
+BOARD = 'bench'
+
+
+def summarize(samples):
+    """Latency summary in milliseconds."""
+    ordered = sorted(samples)
+    n = len(ordered)
+
+    def pct(p):
+        return round(ordered[min(n - 1, int(p * n))] * 1000, 3)
+    return {
+        "n": n,
+        "mean": round(sum(ordered) / n * 1000, 3),
+        "p50": pct(0.50),
+        "p95": pct(0.95),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+def measure(fn, repeat, budget):
+    """Call fn up to repeat times, stopping early once budget seconds are spent."""
+    samples = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+        if len(samples) >= 3 and time.perf_counter() - started > budget:
+            break
+    return summarize(samples)
+
+
+def db_size(store, path):
+    """Bytes on disk after folding the WAL back into the main file.
+
+    Buffered write-behind saves are committed first, so they count too.
+    """
+    store.write_behind.flush()
+    with store.connect_path(path) as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+def check(response, *statuses):
+    if response.status_code not in (statuses or (200,)):
+        raise RuntimeError(f"{response.request.path}: HTTP {response.status_code} {response.data[:200]!r}")
+    return response
+
+
+def bench_size(name, shape, args):
+    teams, islands, kpis, deployments = shape
+    state = generate_state(teams, islands, kpis, deployments, seed=args.seed)
+    result = {"size": name, "teams": teams, "islands": islands,
+              "kpis": islands * kpis, "deployments": deployments}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, 'bench.db')
+        app = app_module.create_app({'DB_FILE': db_file, 'WRITE_BEHIND': args.write_behind,
+                                     'STORAGE_COMPRESSION': args.compress_storage})
+        store = app.extensions['fleet']
+        client = app.test_client()
+        load_url = f'/api/boards/{BOARD}/load'
+        save_url = f'/api/boards/{BOARD}/save'
+        patch_url = f'/api/boards/{BOARD}/patch'
+
+        size_empty = db_size(store, db_file)
+        body = json.dumps(state).encode('utf-8')
+        t0 = time.perf_counter()
+        rev = check(client.post(save_url, data=body, content_type='application/json')).get_json()['rev']
+        result["initial_save_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+        size_seeded = db_size(store, db_file)
+
+        raw = check(client.get(load_url)).data
+        result["payload"] = {"raw_bytes": len(raw), "gzip_bytes": len(gzip.compress(raw))}
+
+        def cold_load():
+            store.invalidate_cached_state(BOARD, rev)
+            check(client.get(load_url))
+        result["load_cold"] = measure(cold_load, args.repeat, args.budget)
+        result["load_warm"] = measure(lambda: check(client.get(load_url)), args.repeat, args.budget)
+
+        # Each save moves one island so only a single row actually changes
+        bodies = []
+        for i in range(args.repeat):
+            state["islands"][i % len(state["islands"])]["x"] += 1
+            bodies.append(json.dumps(state).encode('utf-8'))
+        pending = iter(bodies)
+
+        def save():
+            nonlocal rev
+            response = check(client.post(save_url, data=next(pending), content_type='application/json'))
+            rev = response.get_json()['rev']
+        result["save"] = measure(save, len(bodies), args.budget)
+
+        counter = iter(range(10 ** 9))
+
+        def patch():
+            nonlocal rev
+            ops = [{"op": "replace", "path": "/islands/0/x", "value": next(counter)}]
+            response = check(client.post(patch_url, json={"baseRev": rev, "ops": ops}))
+            rev = response.get_json()['rev']
+        result["patch"] = measure(patch, args.repeat, args.budget)
+
+        size_after = db_size(store, db_file)
+        result["db"] = {
+            "empty_bytes": size_empty,
+            "seeded_bytes": size_seeded,
+            "after_writes_bytes": size_after,
+            "writes": result["save"]["n"] + result["patch"]["n"],
+        }
+        result["concurrent"] = bench_concurrent(app, args)
+        store.write_behind.stop()
+        store.close()
+    return result
+
+
+def bench_concurrent(app, args):
+    """Run args.clients threads doing mixed loads and patches for args.duration seconds."""
+    stop = time.perf_counter() + args.duration
+    lock = threading.Lock()
+    latencies = {"load": [], "patch": []}
+    counts = {"load": 0, "patch": 0, "conflict": 0, "error": 0}
+
+    def worker(index):
+        client = app.test_client()
+        ops_done = 0
+        while time.perf_counter() < stop:
+            # One write for every args.write_every operations
+            kind = "patch" if ops_done % args.write_every == index % args.write_every else "load"
+            t0 = time.perf_counter()
+            if kind == "load":
+                response = client.get(f'/api/boards/{BOARD}/load')
+            else:
+                rev = int(client.get(f'/api/boards/{BOARD}/load').headers['X-Fleet-Revision'])
+                ops = [{"op": "replace", "path": "/islands/0/y", "value": ops_done}]
+                response = client.post(f'/api/boards/{BOARD}/patch', json={"baseRev": rev, "ops": ops})
+            elapsed = time.perf_counter() - t0
+            ops_done += 1
+            with lock:
+                if response.status_code == 409:
+                    counts["conflict"] += 1
+                elif response.status_code != 200:
+                    counts["error"] += 1
+                else:
+                    counts[kind] += 1
+                    latencies[kind].append(elapsed)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    result = {
+        "clients": args.clients,
+        "seconds": round(elapsed, 3),
+        "ops_per_sec": round(sum(counts.values()) / elapsed, 1),
+        "counts": counts,
+    }
+    for kind, samples in latencies.items():
+        if samples:
+            result[kind] = summarize(samples)
+    return result
+
+
+def compare(results, baseline_file, threshold):
+    """Return the (size, metric, baseline, current) tuples whose p50 regressed past threshold."""
+    with open(baseline_file) as f:
+        baseline = {r["size"]: r for r in json.load(f)["results"]}
+    regressions = []
+    for current in results:
+        before = baseline.get(current["size"])
+        if before is None:
+            continue
+        for metric in ("load_cold", "load_warm", "save", "patch"):
+            if metric in before and metric in current:
+                old, new = before[metric]["p50"], current[metric]["p50"]
+                if old > 0 and new / old > threshold:
+                    regressions.append((current["size"], metric, old, new))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='default,small,medium',
+                        help=f"comma-separated presets from {', '.join(PRESETS)}, or "
+                             "TEAMSxISLANDSxKPISxDEPLOYMENTS, e.g. 30x5000x4x8000")
+    parser.add_argument('--repeat', type=int, default=30, help='samples per latency metric')
+    parser.add_argument('--budget', type=float, default=10.0,
+                        help='seconds after which a metric stops sampling (after at least 3 samples)')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds of concurrent load')
+    parser.add_argument('--write-every', type=int, default=5,
+                        help='in the concurrent run, one request in N is a patch')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--write-behind', action='store_true', help='benchmark with write-behind enabled')
+    parser.add_argument('--compress-storage', action='store_true', help='benchmark with compressed rows')
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    parser.add_argument('--compare', metavar='BASELINE', help='JSON results from an earlier run')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='p50 slowdown ratio that counts as a regression')
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in args.sizes.split(','):
+        if size in PRESETS:
+            shape = PRESETS[size]
+        else:
+            shape = tuple(int(part) for part in size.split('x'))
+        print(f"benchmarking {size} ...", file=sys.stderr)
+        results.append(bench_size(size, shape, args))
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "write_behind": args.write_behind,
+            "compress_storage": args.compress_storage,
+            "repeat": args.repeat,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        for size, metric, old, new in regressions:
+            print(f"REGRESSION {size} {metric}: p50 {old}ms -> {new}ms", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""Synthetic fleet states for benchmarks and scale tests.
+
+generate_state() builds a board shaped like DEFAULT_STATE in app.py, with
+any number of teams, main goals, islands, KPIs and deployments. The same
+arguments, seed and reference date always give the same state.
+"""
+import random
+from datetime import date, timedelta
+
+# name: (teams, islands, kpis per island, deployments)
+PRESETS = {
+    'default': (7, 4, 3, 5),
+    'small': (20, 100, 3, 200),
+    'medium': (50, 1000, 4, 2000),
+    'large': (100, 10000, 5, 20000),
+}
+
+ICONS = ['🚀', '🩺', '💊', '🏭', '💰', '⚖️', '💡', '🧪', '📈', '🤝', '🏗️', '🎓', '🌍', '📢', '🛡️', '🎯']
+COLORS = ['#FF6B6B', '#4ECDC4', '#45B7D1', '#FFA07A', '#98D8C8', '#F7DC6F', '#BB8FCE', '#F1948A']
+WORDS = ['Platform', 'Growth', 'Expansion', 'Enterprise', 'Community', 'Brand', 'Compliance', 'Mobile',
+         'Analytics', 'Partner', 'Pricing', 'Onboarding', 'Retention', 'Security', 'Infra', 'Search']
+VERBS = ['Launch', 'Hire', 'Close', 'Ship', 'Migrate', 'Reach', 'Reduce', 'Open', 'Certify', 'Automate']
+
+
+def generate_state(teams=7, islands=4, kpis=3, deployments=5, main_goals=None, seed=0, today=None):
+    """Return a fleet state with the requested number of entities.
+
+    Islands are laid out on a grid below their main goals, KPI deadlines
+    spread over three years around today, and every deployment targets an
+    existing island and some of its KPIs.
+    """
+    rng = random.Random(seed)
+    if main_goals is None:
+        main_goals = max(2, islands // 50)
+    today = today or date.today()
+
+    goals = []
+    for g in range(main_goals):
+        goals.append({
+            "id": f"mg{g + 1}",
+            "title": f"{rng.choice(WORDS)} Leadership {g + 1}",
+            "x": (g - main_goals / 2) * 500,
+            "y": -600,
+            "icon": rng.choice(ICONS),
+            "desc": f"Main goal {g + 1}: win the {rng.choice(WORDS).lower()} market with strong unit economics.",
+        })
+
+    columns = max(1, int(islands ** 0.5))
+    island_list = []
+    for i in range(islands):
+        island_id = f"p{i + 1}"
+        island_list.append({
+            "id": island_id,
+            "mainGoalIds": [goals[i % main_goals]["id"]],
+            "x": (i % columns) * 250 - columns * 125,
+            "y": (i // columns) * 250,
+            "title": f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i + 1}",
+            "icon": rng.choice(ICONS),
+            "desc": f"Project {i + 1} to improve {rng.choice(WORDS).lower()} and {rng.choice(WORDS).lower()}.",
+            "kpis": [
+                {
+                    "id": f"k{i + 1}_{k + 1}",
+                    "desc": f"{rng.choice(VERBS)} {rng.randint(2, 500)} {rng.choice(WORDS).lower()} milestones",
+                    "deadline": (today + timedelta(days=rng.randint(-365, 730))).isoformat(),
+                    "completed": rng.random() < 0.3,
+                    "assigned": [],
+                }
+                for k in range(kpis)
+            ],
+            "expanded": False,
+        })
+
+    team_list = [
+        {
+            "id": f"t{t + 1}",
+            "name": f"{rng.choice(WORDS)} Team {t + 1}",
+            "icon": rng.choice(ICONS),
+            "color": rng.choice(COLORS),
+            "totalShips": 0,
+            "deployed": [],
+        }
+        for t in range(teams)
+    ]
+    if islands and teams:
+        for d in range(deployments):
+            team = team_list[rng.randrange(teams)]
+            island = island_list[rng.randrange(islands)]
+            kpi_ids = [k["id"] for k in island["kpis"] if rng.random() < 0.5]
+            team["deployed"].append({
+                "deploymentId": f"dep_{d + 1}",
+                "islandId": island["id"],
+                "kpiIds": kpi_ids,
+            })
+    for team in team_list:
+        # Leave some ships free in port
+        team["totalShips"] = len(team["deployed"]) + rng.randint(0, 5)
+
+    return {
+        "projectTitle": f"Synthetic Fleet ({teams} teams, {islands} islands)",
+        "teams": team_list,
+        "mainGoals": goals,
+        "islands": island_list,
+    }
+
+
+def preset_state(name, seed=0):
+    teams, islands, kpis, deployments = PRESETS[name]
+    return generate_state(teams, islands, kpis, deployments, seed=seed)
@@ -9,6 +9,13 @@ export class GameEngine {
         this.ctx = this.canvas.getContext('2d');
         
         this.state = { teams: [], islands: [], mainGoals: [] };
+        this.savedState = null; // Last state acknowledged by the server
+        this.rev = null;
+        this.saveChain = Promise.resolve();
+
+        // ?board=<id> opens a specific board; otherwise use the default one
+        const board = new URLSearchParams(window.location.search).get('board');
+        this.apiBase = board ? `/api/boards/${encodeURIComponent(board)}` : '/api';
         
         this.camera = new Camera2D(this.canvas);
         this.particles = new ParticleSystem();
@@ -60,9 +67,22 @@ export class GameEngine {
         this.canvas.addEventListener('drop', e => this.handleDrop(e));
         
         try {
-            const res = await fetch('/api/load');
-            const data = await res.json();
+            // The server may inline the state in the page, saving a round trip
+            const inline = document.getElementById('initial-state');
+            let data, rev;
+            if (inline) {
+                data = JSON.parse(inline.textContent);
+                rev = parseInt(inline.dataset.rev, 10);
+                inline.remove();
+            } else {
+                const res = await fetch(`${this.apiBase}/load`);
+                data = await res.json();
+                rev = parseInt(res.headers.get('X-Fleet-Revision'), 10);
+            }
+            this.rev = isNaN(rev) ? null : rev;
+            this.savedState = JSON.parse(JSON.stringify(data));
             this.loadState(data);
+            this.subscribe();
         } catch (e) {
             console.error("Failed to load initial state", e);
         }
@@ -70,7 +90,54 @@ export class GameEngine {
         this.loop();
     }
 
-    loadState(data) {
+    // Follow changes other clients make to this board
+    subscribe() {
+        if (typeof EventSource === 'undefined') return;
+        const since = this.rev === null ? 0 : this.rev;
+        this.stream = new EventSource(`${this.apiBase}/stream?since=${since}`);
+        this.stream.onmessage = e => {
+            const event = JSON.parse(e.data);
+            // Queue behind pending saves so our own revisions are acknowledged first
+            this.saveChain = this.saveChain.then(() => this.applyRemoteChange(event));
+        };
+        this.stream.onerror = () => {
+            // Turned away (the server caps open streams) or gone for good: poll instead
+            if (this.stream.readyState === EventSource.CLOSED) this.pollChanges();
+        };
+    }
+
+    pollChanges(seconds = 10) {
+        clearInterval(this.pollTimer);
+        this.pollTimer = setInterval(() => {
+            this.saveChain = this.saveChain.then(async () => {
+                try {
+                    const res = await fetch(`${this.apiBase}/load`, { method: 'HEAD' });
+                    const rev = parseInt(res.headers.get('X-Fleet-Revision'), 10);
+                    if (!isNaN(rev)) await this.applyRemoteChange({ rev, ops: null });
+                } catch (e) {
+                    console.error("Failed to poll for changes", e);
+                }
+            });
+        }, seconds * 1000);
+    }
+
+    async applyRemoteChange(event) {
+        if (this.rev !== null && event.rev <= this.rev) return; // Usually our own save
+        try {
+            if (event.ops && this.savedState && event.rev === this.rev + 1) {
+                this.savedState = Utils.applyPatch(this.savedState, event.ops);
+                this.rev = event.rev;
+            } else {
+                // Missed revisions in between: fetch the whole state
+                await this.reloadSaved();
+            }
+            this.loadState(JSON.parse(JSON.stringify(this.savedState)), true);
+        } catch (e) {
+            console.error("Failed to apply remote change", e);
+        }
+    }
+
+    loadState(data, quiet = false) {
         this.state = data;
         if (!this.state.mainGoals) this.state.mainGoals = [];
         if (!this.state.projectTitle) this.state.projectTitle = "Startup Fleet";
@@ -78,7 +145,7 @@ export class GameEngine {
         if(typeof window.ui !== 'undefined') {
             window.ui.renderTeams();
             window.ui.updateProjectTitle(this.state.projectTitle);
-            window.ui.checkTutorial();
+            if (!quiet) window.ui.checkTutorial();
         }
 
         this.state.islands.forEach(i => {
@@ -93,10 +160,30 @@ export class GameEngine {
                 i.mainGoalIds = [];
             }
         });
+        this.state.teams.forEach(t => {
+            t.totalShips = Math.max(0, parseInt(t.totalShips, 10) || 0);
+        });
+        this.pruneDeployments();
 
         this.rebuildShips();
         if(typeof window.ui !== 'undefined') window.ui.renderTeams(); 
-        Utils.showToast("Fleet Command Loaded", 'success');
+        if (!quiet) Utils.showToast("Fleet Command Loaded", 'success');
+    }
+
+    pruneDeployments() {
+        // The server rejects saves whose deployments point at missing islands or KPIs
+        const kpisByIsland = new Map(this.state.islands.map(i =>
+            [i.id, new Set((Array.isArray(i.kpis) ? i.kpis : []).map(k => k.id))]));
+        this.state.teams.forEach(team => {
+            if (!Array.isArray(team.deployed)) return;
+            team.deployed = team.deployed.filter(d => kpisByIsland.has(typeof d === 'string' ? d : d.islandId));
+            team.deployed.forEach(d => {
+                if (typeof d === 'string') return;
+                const kpis = kpisByIsland.get(d.islandId);
+                if (Array.isArray(d.kpiIds)) d.kpiIds = d.kpiIds.filter(id => kpis.has(id));
+                if (d.kpiId && !kpis.has(d.kpiId)) delete d.kpiId;
+            });
+        });
     }
 
     rebuildShips() {
@@ -982,18 +1069,85 @@ export class GameEngine {
         }
     }
 
-    async autoSave() {
+    autoSave() {
+        // Chain saves so each patch is computed against the last acknowledged state
+        this.saveChain = this.saveChain.then(() => this.pushChanges());
+        return this.saveChain;
+    }
+
+    async pushChanges() {
+        let current = JSON.parse(JSON.stringify(this.state));
         try {
-            await fetch('/api/save', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(this.state)
-            });
+            if (this.savedState && this.rev !== null) {
+                const changes = Utils.diff(this.savedState, current);
+                if (changes.length === 0) return;
+                // Paths are positional; the guards make sure they still name the same entities
+                const ops = Utils.guardPatch(this.savedState, changes);
+                let res = await this.sendPatch(ops);
+                if (res.status === 409) {
+                    // Another client saved first: replay our edits on its revision,
+                    // unless it moved or removed an entity they touch
+                    await this.reloadSaved();
+                    try {
+                        current = Utils.applyPatch(JSON.parse(JSON.stringify(this.savedState)), ops);
+                    } catch (e) {
+                        return this.discardChanges();
+                    }
+                    this.loadState(JSON.parse(JSON.stringify(current)), true);
+                    res = await this.sendPatch(ops);
+                }
+                if (res.ok) {
+                    this.rev = (await res.json()).rev;
+                    this.savedState = current;
+                    return;
+                }
+                if (res.status === 429) return this.retryLater(res);
+                if (res.status === 409) return this.discardChanges();
+            }
+            // No baseline yet, or the patch was rejected: send the whole state,
+            // still only over the revision it was edited from
+            const headers = this.rev !== null ? { 'X-Fleet-Base-Revision': String(this.rev) } : {};
+            const res = await fetch(`${this.apiBase}/save`, await Utils.jsonRequest(JSON.stringify(current), headers));
+            if (res.ok) {
+                this.rev = (await res.json()).rev;
+                this.savedState = current;
+            } else if (res.status === 409) {
+                await this.discardChanges();
+            } else if (res.status === 429) {
+                this.retryLater(res);
+            } else if (res.status === 400 || res.status === 413) {
+                console.error("Save rejected", (await res.json()).message);
+                Utils.showToast("Save rejected by the server", 'error');
+            }
         } catch (e) {
             console.error("Autosave failed", e);
         }
     }
 
+    async sendPatch(ops) {
+        return fetch(`${this.apiBase}/patch`, await Utils.jsonRequest(JSON.stringify({ baseRev: this.rev, ops })));
+    }
+
+    async reloadSaved() {
+        const res = await fetch(`${this.apiBase}/load`);
+        this.savedState = await res.json();
+        this.rev = parseInt(res.headers.get('X-Fleet-Revision'), 10);
+    }
+
+    async discardChanges() {
+        // Our edits don't apply to what others saved: show the board as stored
+        await this.reloadSaved();
+        this.loadState(JSON.parse(JSON.stringify(this.savedState)), true);
+        Utils.showToast("The board changed elsewhere; your last edit was not saved", 'error');
+    }
+
+    retryLater(res) {
+        // Throttled by the server: save again once it says there is room
+        const seconds = parseFloat(res.headers.get('Retry-After')) || 1;
+        clearTimeout(this.retryTimer);
+        this.retryTimer = setTimeout(() => this.autoSave(), seconds * 1000);
+    }
+
     saveToFile() {
         this.autoSave();
         const dataStr = JSON.stringify(this.state, null, 2);
@@ -482,7 +482,7 @@ export class UIController {
             const newTeam = {
                 id: teamId || Utils.generateId('t'),
                 name: document.getElementById('inp-name').value,
-                totalShips: parseInt(document.getElementById('inp-ships').value),
+                totalShips: Math.max(0, parseInt(document.getElementById('inp-ships').value, 10) || 0),
                 color: document.getElementById('inp-color').value,
                 icon: document.getElementById('inp-icon').value,
                 deployed: team.deployed || []
@@ -545,7 +545,7 @@ export class UIController {
         const island = existingIsland || { title: '', icon: '🏝️', x: x, y: y, kpis: [], desc: '', mainGoalIds: [] };
         
         const kpiHtml = island.kpis.map((k, idx) => `
-            <div class="kpi-item" id="kpi-row-${idx}">
+            <div class="kpi-item" id="kpi-row-${idx}" data-kpi-id="${k.id}">
                 <div style="flex-grow:1">
                     <input class="kpi-desc" value="${k.desc}" placeholder="KPI Description" style="margin-bottom:5px">
                     <div style="display:flex; gap:5px;">
@@ -605,7 +605,8 @@ export class UIController {
         this.showModal(existingIsland ? 'Edit Expedition' : 'New Expedition', html, () => {
             const kpiRows = document.querySelectorAll('.kpi-item');
             const newKpis = Array.from(kpiRows).map(row => ({
-                id: Utils.generateId('k'),
+                // Keep existing ids so deployments to these KPIs stay valid
+                id: row.dataset.kpiId || Utils.generateId('k'),
                 desc: row.querySelector('.kpi-desc').value,
                 deadline: row.querySelector('.kpi-date').value,
                 completed: row.querySelector('.kpi-done').checked,
@@ -629,6 +630,7 @@ export class UIController {
             if(existingIsland) {
                 const idx = window.game.state.islands.findIndex(i => i.id === data.id);
                 window.game.state.islands[idx] = data;
+                window.game.pruneDeployments();
             } else {
                 window.game.state.islands.push(data);
             }
@@ -701,9 +703,7 @@ export class UIController {
             window.game.ships.forEach(s => {
                 if(s.targetId === id) window.game.recallShip(s);
             });
-            window.game.state.teams.forEach(t => {
-                if(t.deployed) t.deployed = t.deployed.filter(d_id => d_id !== id);
-            });
+            window.game.pruneDeployments();
             this.renderTeams();
             this.closeModal();
         }
@@ -17,7 +17,108 @@ export class Utils {
     static clamp(val, min, max) {
         return Math.min(Math.max(val, min), max);
     }
+
+    // Build a JSON Patch (RFC 6902) that turns `before` into `after`
+    static diff(before, after, path = '', ops = []) {
+        if (before === after) return ops;
+        const isObj = v => v !== null && typeof v === 'object';
+        if (!isObj(before) || !isObj(after) || Array.isArray(before) !== Array.isArray(after)) {
+            ops.push({ op: 'replace', path, value: after });
+            return ops;
+        }
+        if (Array.isArray(after)) {
+            const common = Math.min(before.length, after.length);
+            for (let i = 0; i < common; i++) Utils.diff(before[i], after[i], `${path}/${i}`, ops);
+            for (let i = common; i < after.length; i++) ops.push({ op: 'add', path: `${path}/-`, value: after[i] });
+            for (let i = before.length - 1; i >= after.length; i--) ops.push({ op: 'remove', path: `${path}/${i}` });
+            return ops;
+        }
+        const escape = key => key.replace(/~/g, '~0').replace(/\//g, '~1');
+        Object.keys(before).forEach(key => {
+            if (!(key in after)) ops.push({ op: 'remove', path: `${path}/${escape(key)}` });
+            else Utils.diff(before[key], after[key], `${path}/${escape(key)}`, ops);
+        });
+        Object.keys(after).forEach(key => {
+            if (!(key in before)) ops.push({ op: 'add', path: `${path}/${escape(key)}`, value: after[key] });
+        });
+        return ops;
+    }
     
+    // Apply JSON Patch operations to `doc` in place and return the result
+    static applyPatch(doc, ops) {
+        const parse = path => path === '' ? [] : path.slice(1).split('/').map(t => t.replace(/~1/g, '/').replace(/~0/g, '~'));
+        const resolve = tokens => tokens.reduce((node, t) => node[t], doc);
+        const clone = v => JSON.parse(JSON.stringify(v));
+        const remove = tokens => {
+            const parent = resolve(tokens.slice(0, -1));
+            const key = tokens[tokens.length - 1];
+            const value = parent[key];
+            if (Array.isArray(parent)) parent.splice(Number(key), 1);
+            else delete parent[key];
+            return value;
+        };
+        const add = (tokens, value) => {
+            if (tokens.length === 0) { doc = value; return; }
+            const parent = resolve(tokens.slice(0, -1));
+            const key = tokens[tokens.length - 1];
+            if (Array.isArray(parent)) parent.splice(key === '-' ? parent.length : Number(key), 0, value);
+            else parent[key] = value;
+        };
+        ops.forEach(op => {
+            const tokens = parse(op.path);
+            if (op.op === 'add') add(tokens, clone(op.value));
+            else if (op.op === 'remove') remove(tokens);
+            else if (op.op === 'replace') { if (tokens.length) remove(tokens); add(tokens, clone(op.value)); }
+            else if (op.op === 'move') add(tokens, remove(parse(op.from)));
+            else if (op.op === 'copy') add(tokens, clone(resolve(parse(op.from))));
+            else if (op.op === 'test' && JSON.stringify(resolve(tokens)) !== JSON.stringify(op.value)) {
+                throw new Error(`Test failed at ${op.path}`);
+            }
+        });
+        return doc;
+    }
+
+    // Put a 'test' op in front of `ops` for every array element they go through,
+    // pinning its id (or, for strings and numbers, its value) in `before`. A patch
+    // replayed on a newer revision then fails instead of editing whatever entity
+    // has moved into that position.
+    static guardPatch(before, ops) {
+        const parse = path => path === '' ? [] : path.slice(1).split('/').map(t => t.replace(/~1/g, '/').replace(/~0/g, '~'));
+        const escape = key => key.replace(/~/g, '~0').replace(/\//g, '~1');
+        const guards = new Map();
+        ops.forEach(op => [op.path, op.from].forEach(path => {
+            if (path === undefined) return;
+            let node = before;
+            let prefix = '';
+            for (const token of parse(path)) {
+                if (node === null || typeof node !== 'object' || !Object.prototype.hasOwnProperty.call(node, token)) break;
+                const inArray = Array.isArray(node);
+                node = node[token];
+                prefix += `/${escape(token)}`;
+                if (!inArray) continue;
+                if (node === null || typeof node !== 'object') {
+                    guards.set(prefix, node);
+                } else {
+                    const key = ['id', 'deploymentId'].find(k => typeof node[k] === 'string');
+                    if (key) guards.set(`${prefix}/${escape(key)}`, node[key]);
+                }
+            }
+        }));
+        const tests = [...guards].map(([path, value]) => ({ op: 'test', path, value }));
+        return tests.concat(ops);
+    }
+
+    // POST options for a JSON body, gzipped when large and the browser can
+    static async jsonRequest(body, extraHeaders = {}) {
+        const headers = { 'Content-Type': 'application/json', ...extraHeaders };
+        if (body.length > 8192 && typeof CompressionStream !== 'undefined') {
+            const stream = new Blob([body]).stream().pipeThrough(new CompressionStream('gzip'));
+            body = await new Response(stream).arrayBuffer();
+            headers['Content-Encoding'] = 'gzip';
+        }
+        return { method: 'POST', headers, body };
+    }
+
     static showToast(message, type = 'info') {
         const container = document.getElementById('toast-container');
         if(!container) return;
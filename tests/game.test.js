@@ -73,7 +73,108 @@ class Utils {
     static clamp(val, min, max) {
         return Math.min(Math.max(val, min), max);
     }
+
+    // Build a JSON Patch (RFC 6902) that turns `before` into `after`
+    static diff(before, after, path = '', ops = []) {
+        if (before === after) return ops;
+        const isObj = v => v !== null && typeof v === 'object';
+        if (!isObj(before) || !isObj(after) || Array.isArray(before) !== Array.isArray(after)) {
+            ops.push({ op: 'replace', path, value: after });
+            return ops;
+        }
+        if (Array.isArray(after)) {
+            const common = Math.min(before.length, after.length);
+            for (let i = 0; i < common; i++) Utils.diff(before[i], after[i], `${path}/${i}`, ops);
+            for (let i = common; i < after.length; i++) ops.push({ op: 'add', path: `${path}/-`, value: after[i] });
+            for (let i = before.length - 1; i >= after.length; i--) ops.push({ op: 'remove', path: `${path}/${i}` });
+            return ops;
+        }
+        const escape = key => key.replace(/~/g, '~0').replace(/\//g, '~1');
+        Object.keys(before).forEach(key => {
+            if (!(key in after)) ops.push({ op: 'remove', path: `${path}/${escape(key)}` });
+            else Utils.diff(before[key], after[key], `${path}/${escape(key)}`, ops);
+        });
+        Object.keys(after).forEach(key => {
+            if (!(key in before)) ops.push({ op: 'add', path: `${path}/${escape(key)}`, value: after[key] });
+        });
+        return ops;
+    }
     
+    // Apply JSON Patch operations to `doc` in place and return the result
+    static applyPatch(doc, ops) {
+        const parse = path => path === '' ? [] : path.slice(1).split('/').map(t => t.replace(/~1/g, '/').replace(/~0/g, '~'));
+        const resolve = tokens => tokens.reduce((node, t) => node[t], doc);
+        const clone = v => JSON.parse(JSON.stringify(v));
+        const remove = tokens => {
+            const parent = resolve(tokens.slice(0, -1));
+            const key = tokens[tokens.length - 1];
+            const value = parent[key];
+            if (Array.isArray(parent)) parent.splice(Number(key), 1);
+            else delete parent[key];
+            return value;
+        };
+        const add = (tokens, value) => {
+            if (tokens.length === 0) { doc = value; return; }
+            const parent = resolve(tokens.slice(0, -1));
+            const key = tokens[tokens.length - 1];
+            if (Array.isArray(parent)) parent.splice(key === '-' ? parent.length : Number(key), 0, value);
+            else parent[key] = value;
+        };
+        ops.forEach(op => {
+            const tokens = parse(op.path);
+            if (op.op === 'add') add(tokens, clone(op.value));
+            else if (op.op === 'remove') remove(tokens);
+            else if (op.op === 'replace') { if (tokens.length) remove(tokens); add(tokens, clone(op.value)); }
+            else if (op.op === 'move') add(tokens, remove(parse(op.from)));
+            else if (op.op === 'copy') add(tokens, clone(resolve(parse(op.from))));
+            else if (op.op === 'test' && JSON.stringify(resolve(tokens)) !== JSON.stringify(op.value)) {
+                throw new Error(`Test failed at ${op.path}`);
+            }
+        });
+        return doc;
+    }
+
+    // Put a 'test' op in front of `ops` for every array element they go through,
+    // pinning its id (or, for strings and numbers, its value) in `before`. A patch
+    // replayed on a newer revision then fails instead of editing whatever entity
+    // has moved into that position.
+    static guardPatch(before, ops) {
+        const parse = path => path === '' ? [] : path.slice(1).split('/').map(t => t.replace(/~1/g, '/').replace(/~0/g, '~'));
+        const escape = key => key.replace(/~/g, '~0').replace(/\//g, '~1');
+        const guards = new Map();
+        ops.forEach(op => [op.path, op.from].forEach(path => {
+            if (path === undefined) return;
+            let node = before;
+            let prefix = '';
+            for (const token of parse(path)) {
+                if (node === null || typeof node !== 'object' || !Object.prototype.hasOwnProperty.call(node, token)) break;
+                const inArray = Array.isArray(node);
+                node = node[token];
+                prefix += `/${escape(token)}`;
+                if (!inArray) continue;
+                if (node === null || typeof node !== 'object') {
+                    guards.set(prefix, node);
+                } else {
+                    const key = ['id', 'deploymentId'].find(k => typeof node[k] === 'string');
+                    if (key) guards.set(`${prefix}/${escape(key)}`, node[key]);
+                }
+            }
+        }));
+        const tests = [...guards].map(([path, value]) => ({ op: 'test', path, value }));
+        return tests.concat(ops);
+    }
+
+    // POST options for a JSON body, gzipped when large and the browser can
+    static async jsonRequest(body, extraHeaders = {}) {
+        const headers = { 'Content-Type': 'application/json', ...extraHeaders };
+        if (body.length > 8192 && typeof CompressionStream !== 'undefined') {
+            const stream = new Blob([body]).stream().pipeThrough(new CompressionStream('gzip'));
+            body = await new Response(stream).arrayBuffer();
+            headers['Content-Encoding'] = 'gzip';
+        }
+        return { method: 'POST', headers, body };
+    }
+
     static showToast(message, type = 'info') {
         // Mock implementation for testing
     }
@@ -169,6 +270,96 @@ describe('Utils Helper Functions', () => {
         expect(Utils.clamp(5, 0, 5)).toBe(5);   // At max
     });
 
+    test('diff builds replace, add and remove ops', () => {
+        const before = { title: 'a', islands: [{ id: 'p1', x: 1 }, { id: 'p2', x: 2 }], 'a/b': 1 };
+        const after = { title: 'b', islands: [{ id: 'p1', x: 5 }], extra: true };
+        expect(Utils.diff(before, after)).toEqual([
+            { op: 'replace', path: '/title', value: 'b' },
+            { op: 'replace', path: '/islands/0/x', value: 5 },
+            { op: 'remove', path: '/islands/1' },
+            { op: 'remove', path: '/a~1b' },
+            { op: 'add', path: '/extra', value: true }
+        ]);
+        expect(Utils.diff(before, JSON.parse(JSON.stringify(before)))).toEqual([]);
+    });
+
+    test('applyPatch round-trips diff output', () => {
+        const before = { teams: [{ id: 't1', deployed: ['p1'] }], islands: [{ id: 'p1' }, { id: 'p2' }] };
+        const after = { teams: [{ id: 't1', deployed: ['p1', 'p2'] }, { id: 't2', deployed: [] }], islands: [{ id: 'p2' }] };
+        const ops = Utils.diff(before, after);
+        expect(Utils.applyPatch(JSON.parse(JSON.stringify(before)), ops)).toEqual(after);
+    });
+
+    test('applyPatch supports move, copy and test', () => {
+        const doc = { a: [1, 2, 3], b: {} };
+        Utils.applyPatch(doc, [
+            { op: 'test', path: '/a/0', value: 1 },
+            { op: 'move', from: '/a/0', path: '/b/first' },
+            { op: 'copy', from: '/a', path: '/b/rest' }
+        ]);
+        expect(doc).toEqual({ a: [2, 3], b: { first: 1, rest: [2, 3] } });
+        expect(() => Utils.applyPatch(doc, [{ op: 'test', path: '/a/0', value: 9 }])).toThrow('/a/0');
+    });
+
+    test('guardPatch pins the ids of the entities a patch touches', () => {
+        const before = {
+            teams: [{ id: 't1', deployed: [{ deploymentId: 'd1', islandId: 'p1' }, 'p2'] }],
+            islands: [{ id: 'p1', x: 1 }, { id: 'p2', x: 2 }]
+        };
+        const ops = [
+            { op: 'replace', path: '/islands/1/x', value: 3 },
+            { op: 'replace', path: '/teams/0/deployed/0/islandId', value: 'p2' },
+            { op: 'remove', path: '/teams/0/deployed/1' },
+            { op: 'add', path: '/islands/-', value: { id: 'p3' } }
+        ];
+        expect(Utils.guardPatch(before, ops)).toEqual([
+            { op: 'test', path: '/islands/1/id', value: 'p2' },
+            { op: 'test', path: '/teams/0/id', value: 't1' },
+            { op: 'test', path: '/teams/0/deployed/0/deploymentId', value: 'd1' },
+            { op: 'test', path: '/teams/0/deployed/1', value: 'p2' },
+            ...ops
+        ]);
+    });
+
+    test('guarded patch fails once another client shifts the entities', () => {
+        const before = { islands: [{ id: 'p1', x: 1 }, { id: 'p2', x: 2 }, { id: 'p3', x: 3 }] };
+        const ops = Utils.guardPatch(before, [{ op: 'replace', path: '/islands/2/x', value: 9 }]);
+        const same = Utils.applyPatch(JSON.parse(JSON.stringify(before)), ops);
+        expect(same.islands[2]).toEqual({ id: 'p3', x: 9 });
+        // Someone else removed p1, so index 2 no longer exists / names another island
+        const shifted = { islands: [{ id: 'p2', x: 2 }, { id: 'p3', x: 3 }, { id: 'p4', x: 4 }] };
+        expect(() => Utils.applyPatch(shifted, ops)).toThrow('/islands/2/id');
+        expect(shifted.islands[2].x).toBe(4);
+    });
+
+    test('jsonRequest builds a JSON POST and keeps extra headers', async () => {
+        const options = await Utils.jsonRequest('{"a":1}', { 'X-Fleet-Base-Revision': '3' });
+        expect(options).toEqual({
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json', 'X-Fleet-Base-Revision': '3' },
+            body: '{"a":1}'
+        });
+    });
+
+    test('jsonRequest gzips large bodies when the browser can', async () => {
+        const body = JSON.stringify({ text: 'x'.repeat(10000) });
+        const saved = { CompressionStream: global.CompressionStream, Blob: global.Blob, Response: global.Response };
+        try {
+            delete global.CompressionStream;
+            expect((await Utils.jsonRequest(body)).headers['Content-Encoding']).toBeUndefined();
+
+            global.CompressionStream = class { constructor(format) { this.format = format; } };
+            global.Blob = class { constructor(parts) { this.parts = parts; } stream() { return { pipeThrough: s => s }; } };
+            global.Response = class { constructor(stream) { this.stream = stream; } async arrayBuffer() { return this.stream.format; } };
+            const options = await Utils.jsonRequest(body);
+            expect(options.headers['Content-Encoding']).toBe('gzip');
+            expect(options.body).toBe('gzip');
+            expect((await Utils.jsonRequest('{}')).headers['Content-Encoding']).toBeUndefined();
+        } finally {
+            Object.assign(global, saved);
+        }
+    });
+
     test('ICONS array contains expected icons', () => {
         expect(ICONS).toContain('🚀');
         expect(ICONS).toContain('🎯');
@@ -3,34 +3,39 @@ import json
 import os
 import sqlite3
 import tempfile
+import gzip
+import io
+import zlib
+import threading
+import time
 import copy
-from app import app, DEFAULT_STATE
+import hashlib
+import importlib.util
+import signal
+import socket
+import subprocess
+import sys
+import urllib.error
+import urllib.request
+from unittest import mock
+from flask import render_template
+from app import create_app, read_kpis, DEFAULT_STATE
+
+class AppTestCase(unittest.TestCase):
+    """An app on a fresh database file, with its store and a test client"""
 
-class NorthStarTestCase(unittest.TestCase):
     def setUp(self):
-        # Create a temp file for DB
-        self.db_fd, self.db_path = tempfile.mkstemp()
-        
-        # Configure app
-        app.config['TESTING'] = True
-        
-        # Patch the DB_FILE in the app module
-        import app as app_module
-        self.original_db_file = app_module.DB_FILE
-        app_module.DB_FILE = self.db_path
-        
-        # Initialize DB
-        app_module.init_db()
-        
-        self.client = app.test_client()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'game.db')
+        self.app = create_app({'TESTING': True, 'DB_FILE': self.db_path})
+        self.store = self.app.extensions['fleet']
+        self.client = self.app.test_client()
 
     def tearDown(self):
-        os.close(self.db_fd)
-        os.unlink(self.db_path)
-        # Restore DB path
-        import app as app_module
-        app_module.DB_FILE = self.original_db_file
+        self.store.close()
+        self.tmp_dir.cleanup()
 
+class NorthStarTestCase(AppTestCase):
     def test_home(self):
         """Test home page loads"""
         rv = self.client.get('/')
@@ -38,13 +43,43 @@ class NorthStarTestCase(unittest.TestCase):
         self.assertIn(b'Fleet', rv.data)
 
     def test_db_initialization(self):
-        """Test DB creates default row on init"""
+        """Test DB creates default row on first use"""
+        self.client.get('/api/load')
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT count(*) FROM gamestate")
             count = cursor.fetchone()[0]
             self.assertEqual(count, 1)
 
+    def test_create_app_is_lazy(self):
+        """Test building an app doesn't touch the database"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'lazy.db')
+            seed = {"projectTitle": "Seeded", "teams": []}
+            app = create_app({'TESTING': True, 'DB_FILE': path, 'SEED_STATE': seed})
+            self.assertFalse(os.path.exists(path))
+            data = json.loads(app.test_client().get('/api/load').data)
+            self.assertEqual(data, seed)
+            self.assertTrue(os.path.exists(path))
+            app.extensions['fleet'].close()
+
+    def test_create_app_reads_settings(self):
+        """Test server settings can be passed as config instead of module globals"""
+        app = create_app({'TESTING': True, 'DB_FILE': self.db_path, 'WRITE_BEHIND': True,
+                          'WRITE_BEHIND_INTERVAL': 60, 'CLIENT_WRITE_RATE': 0.1, 'CLIENT_WRITE_BURST': 1,
+                          'MAX_STREAMS': 1, 'METRICS': False})
+        store = app.extensions['fleet']
+        client = app.test_client()
+        state = dict(DEFAULT_STATE, projectTitle="Configured")
+        for status in (200, 429):
+            rv = client.post('/api/save', data=json.dumps(state), content_type='application/json')
+            self.assertEqual(rv.status_code, status)
+        self.assertIn('default', store.write_behind.pending)
+        self.assertEqual(store.changes.max_streams, 1)
+        self.assertEqual(client.get('/metrics').status_code, 404)
+        store.write_behind.stop()
+        store.close()
+
     def test_load_initial_state(self):
         """Test loading returns the default state initially"""
         rv = self.client.get('/api/load')
@@ -69,10 +104,8 @@ class NorthStarTestCase(unittest.TestCase):
         # Verify persistence
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT data FROM gamestate WHERE id=1")
-            saved_json = cursor.fetchone()[0]
-            saved_data = json.loads(saved_json)
-            self.assertEqual(saved_data['teams'][0]['name'], "Renamed Team")
+            cursor.execute("SELECT name FROM teams WHERE state_id=1 AND pos=0")
+            self.assertEqual(cursor.fetchone()[0], "Renamed Team")
 
     def test_load_after_save(self):
         """Test loading retrieves the updated state"""
@@ -117,9 +150,9 @@ class NorthStarTestCase(unittest.TestCase):
         
         # Add multiple deployments to same island with unique IDs
         state['teams'][0]['deployed'] = [
-            {"deploymentId": "dep_1", "islandId": "e1", "kpiIds": ["k1"]},
-            {"deploymentId": "dep_2", "islandId": "e1", "kpiIds": ["k1"]},
-            {"deploymentId": "dep_3", "islandId": "e1", "kpiIds": ["k2"]}
+            {"deploymentId": "dep_1", "islandId": "p1", "kpiIds": ["k1_1"]},
+            {"deploymentId": "dep_2", "islandId": "p1", "kpiIds": ["k1_1"]},
+            {"deploymentId": "dep_3", "islandId": "p1", "kpiIds": ["k1_2"]}
         ]
         
         rv = self.client.post('/api/save',
@@ -142,8 +175,8 @@ class NorthStarTestCase(unittest.TestCase):
         """Test saving island with multiple KPIs"""
         state = copy.deepcopy(DEFAULT_STATE)
         
-        # Add KPIs to first island
-        state['islands'][0]['kpis'] = [
+        # Replace the KPIs of an island no team is deployed to
+        state['islands'][1]['kpis'] = [
             {"id": "k1", "desc": "First KPI", "deadline": "2025-06-01", "completed": False},
             {"id": "k2", "desc": "Second KPI", "deadline": "2025-12-01", "completed": True}
         ]
@@ -155,8 +188,8 @@ class NorthStarTestCase(unittest.TestCase):
         
         rv = self.client.get('/api/load')
         data = json.loads(rv.data)
-        self.assertEqual(len(data['islands'][0]['kpis']), 2)
-        self.assertEqual(data['islands'][0]['kpis'][1]['completed'], True)
+        self.assertEqual(len(data['islands'][1]['kpis']), 2)
+        self.assertEqual(data['islands'][1]['kpis'][1]['completed'], True)
 
     def test_save_island_with_multiple_main_goals(self):
         """Test saving island linked to multiple main goals"""
@@ -289,35 +322,20 @@ class NorthStarTestCase(unittest.TestCase):
         self.assertEqual(len(data['islands']), len(DEFAULT_STATE['islands']) + 30)
 
 
-class DeploymentLogicTestCase(unittest.TestCase):
+class DeploymentLogicTestCase(AppTestCase):
     """Test cases specifically for multiple deployment feature"""
     
-    def setUp(self):
-        self.db_fd, self.db_path = tempfile.mkstemp()
-        app.config['TESTING'] = True
-        import app as app_module
-        self.original_db_file = app_module.DB_FILE
-        app_module.DB_FILE = self.db_path
-        app_module.init_db()
-        self.client = app.test_client()
-
-    def tearDown(self):
-        os.close(self.db_fd)
-        os.unlink(self.db_path)
-        import app as app_module
-        app_module.DB_FILE = self.original_db_file
-
     def test_multiple_identical_deployments(self):
         """Test that multiple identical deployments are preserved"""
         state = copy.deepcopy(DEFAULT_STATE)
         
         # Same team, same island, same KPIs - different deployment IDs
         state['teams'][0]['deployed'] = [
-            {"deploymentId": "dep_a1", "islandId": "e1", "kpiIds": ["k1"]},
-            {"deploymentId": "dep_a2", "islandId": "e1", "kpiIds": ["k1"]},
-            {"deploymentId": "dep_a3", "islandId": "e1", "kpiIds": ["k1"]},
-            {"deploymentId": "dep_a4", "islandId": "e1", "kpiIds": ["k1"]},
-            {"deploymentId": "dep_a5", "islandId": "e1", "kpiIds": ["k1"]}
+            {"deploymentId": "dep_a1", "islandId": "p1", "kpiIds": ["k1_1"]},
+            {"deploymentId": "dep_a2", "islandId": "p1", "kpiIds": ["k1_1"]},
+            {"deploymentId": "dep_a3", "islandId": "p1", "kpiIds": ["k1_1"]},
+            {"deploymentId": "dep_a4", "islandId": "p1", "kpiIds": ["k1_1"]},
+            {"deploymentId": "dep_a5", "islandId": "p1", "kpiIds": ["k1_1"]}
         ]
         
         rv = self.client.post('/api/save',
@@ -339,9 +357,9 @@ class DeploymentLogicTestCase(unittest.TestCase):
         """Test removing one deployment from multiple identical ones"""
         state = copy.deepcopy(DEFAULT_STATE)
         state['teams'][0]['deployed'] = [
-            {"deploymentId": "dep_keep1", "islandId": "e1", "kpiIds": ["k1"]},
-            {"deploymentId": "dep_remove", "islandId": "e1", "kpiIds": ["k1"]},
-            {"deploymentId": "dep_keep2", "islandId": "e1", "kpiIds": ["k1"]}
+            {"deploymentId": "dep_keep1", "islandId": "p1", "kpiIds": ["k1_1"]},
+            {"deploymentId": "dep_remove", "islandId": "p1", "kpiIds": ["k1_1"]},
+            {"deploymentId": "dep_keep2", "islandId": "p1", "kpiIds": ["k1_1"]}
         ]
         
         # Save initial state
@@ -375,9 +393,9 @@ class DeploymentLogicTestCase(unittest.TestCase):
         """Test deployments to different KPIs on same island"""
         state = copy.deepcopy(DEFAULT_STATE)
         state['teams'][0]['deployed'] = [
-            {"deploymentId": "dep_1", "islandId": "e1", "kpiIds": ["k1"]},
-            {"deploymentId": "dep_2", "islandId": "e1", "kpiIds": ["k2"]},
-            {"deploymentId": "dep_3", "islandId": "e1", "kpiIds": ["k1", "k2"]}
+            {"deploymentId": "dep_1", "islandId": "p1", "kpiIds": ["k1_1"]},
+            {"deploymentId": "dep_2", "islandId": "p1", "kpiIds": ["k1_2"]},
+            {"deploymentId": "dep_3", "islandId": "p1", "kpiIds": ["k1_1", "k1_2"]}
         ]
         
         rv = self.client.post('/api/save',
@@ -393,9 +411,1990 @@ class DeploymentLogicTestCase(unittest.TestCase):
         
         # Verify KPI assignments are preserved
         kpi_sets = [set(d['kpiIds']) for d in deployments]
-        self.assertIn({'k1'}, kpi_sets)
-        self.assertIn({'k2'}, kpi_sets)
-        self.assertIn({'k1', 'k2'}, kpi_sets)
+        self.assertIn({'k1_1'}, kpi_sets)
+        self.assertIn({'k1_2'}, kpi_sets)
+        self.assertIn({'k1_1', 'k1_2'}, kpi_sets)
+
+
+class NormalizedStorageTestCase(AppTestCase):
+    """Test cases for the per-entity tables behind the state document"""
+
+    def init_db(self):
+        # The schema and seed board are created on first use
+        with self.store.connect('default'):
+            pass
+
+    def count(self, table):
+        with sqlite3.connect(self.db_path) as conn:
+            return conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+
+    def test_entities_stored_in_tables(self):
+        """Test init splits the default state into entity tables"""
+        self.init_db()
+        self.assertEqual(self.count('teams'), len(DEFAULT_STATE['teams']))
+        self.assertEqual(self.count('islands'), len(DEFAULT_STATE['islands']))
+        self.assertEqual(self.count('main_goals'), len(DEFAULT_STATE['mainGoals']))
+        self.assertEqual(self.count('kpis'), sum(len(i['kpis']) for i in DEFAULT_STATE['islands']))
+        self.assertEqual(self.count('deployments'), sum(len(t['deployed']) for t in DEFAULT_STATE['teams']))
+
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute("SELECT team_id, island_id FROM deployments WHERE deployment_id='dep_t4_1'").fetchone()
+        self.assertEqual(row, ('t4', 'p4'))
+
+    def test_roundtrip_is_exact(self):
+        """Test odd and legacy shapes come back exactly as saved"""
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['teams'][0]['deployed'].append('p2')  # legacy bare island id
+        state['teams'].append({"id": "t99", "name": "No Deployments"})
+        state['islands'][1]['kpis'] = "Legacy free-text KPI"
+        state['islands'][2]['mainGoalIds'] = ['mg1', 'mg2']
+        state['customField'] = {"nested": [1, 2, 3]}
+
+        self.client.post('/api/save', data=json.dumps(state), content_type='application/json')
+        data = json.loads(self.client.get('/api/load').data)
+        self.assertEqual(data, state)
+
+    def test_save_only_writes_changed_rows(self):
+        """Test a single-entity change leaves other rows untouched"""
+        import app as app_module
+        self.init_db()
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['islands'][2]['kpis'][0]['completed'] = True
+
+        with sqlite3.connect(self.db_path) as conn:
+            app_module.write_state(conn, 1, DEFAULT_STATE)
+            before = conn.total_changes
+            app_module.write_state(conn, 1, state)
+            # One KPI row, its island's and main goal's aggregate rows, its
+            # completion time and the gamestate skeleton
+            self.assertEqual(conn.total_changes - before, 5)
+            row = conn.execute("SELECT completed FROM kpis WHERE id='k3_1'").fetchone()
+        self.assertEqual(row[0], 1)
+
+    def test_legacy_blob_migrated_on_startup(self):
+        """Test a pre-normalization database is migrated on first use"""
+        legacy = copy.deepcopy(DEFAULT_STATE)
+        legacy['projectTitle'] = "Legacy Fleet"
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("CREATE TABLE gamestate (id INTEGER PRIMARY KEY, data TEXT)")
+            conn.execute("INSERT INTO gamestate (id, data) VALUES (1, ?)", (json.dumps(legacy),))
+
+        data = json.loads(self.client.get('/api/load').data)
+        self.assertEqual(data, legacy)
+        self.assertEqual(self.count('islands'), len(legacy['islands']))
+        # The derived tables are filled as the rows are stored
+        from app import matrix_of
+        self.assertEqual(json.loads(self.client.get('/api/matrix').data), matrix_of(legacy))
+        self.assertEqual(self.count('islands_rtree'), len(legacy['islands']))
+
+        # Opening the database again must not duplicate anything
+        other = create_app({'TESTING': True, 'DB_FILE': self.db_path})
+        other.test_client().get('/api/load')
+        other.extensions['fleet'].close()
+        self.assertEqual(self.count('islands'), len(legacy['islands']))
+
+        # The pre-upgrade state stays reachable once the board moves on
+        state = dict(legacy, projectTitle="Upgraded")
+        self.client.post('/api/save', data=json.dumps(state), content_type='application/json')
+        self.assertEqual(json.loads(self.client.get('/api/load?rev=0').data), legacy)
+        self.assertEqual(self.count('history'), 2)
+
+    def test_shifts_only_renumber_rows(self):
+        """Test removing the first island renumbers the others without rewriting them"""
+        import app as app_module
+        self.init_db()
+        state = copy.deepcopy(DEFAULT_STATE)
+        del state['islands'][0]
+        with sqlite3.connect(self.db_path) as conn:
+            statements = []
+            conn.set_trace_callback(statements.append)
+            app_module.write_state(conn, 1, state)
+            conn.set_trace_callback(None)
+            self.assertEqual(conn.execute("SELECT key FROM islands ORDER BY pos").fetchall(),
+                             [(island['id'],) for island in state['islands']])
+        updates = [sql for sql in statements if sql.startswith('UPDATE islands')]
+        self.assertEqual(len(updates), len(state['islands']))
+        self.assertTrue(all(sql.startswith('UPDATE islands SET pos=') for sql in updates))
+        self.assertFalse([sql for sql in statements if sql.startswith('UPDATE kpis')])
+
+    def test_patch_writes_only_reached_rows(self):
+        """Test a patch loads and rewrites just the entities it reaches and shifts the rest in bulk"""
+        import app as app_module
+        self.init_db()
+        ops = [{"op": "add", "path": "/islands/0", "value": {"id": "p0", "title": "New", "x": 1, "y": 2, "kpis": []}},
+               {"op": "replace", "path": "/islands/3/x", "value": 7}]
+        expected = app_module.apply_patch(copy.deepcopy(DEFAULT_STATE), ops)
+        with sqlite3.connect(self.db_path) as conn:
+            statements = []
+            conn.set_trace_callback(statements.append)
+            app_module.patch_state(conn, 1, 0, ops)
+            conn.set_trace_callback(None)
+            self.assertEqual(app_module.read_state(conn, 1), expected)
+            self.assertEqual(conn.execute("SELECT size FROM gamestate WHERE id=1").fetchone()[0],
+                             len(app_module.canonical_json(expected)))
+        writes = [sql.split(' (')[0].split(' SET')[0].split(' WHERE')[0] for sql in statements
+                  if sql.startswith(('INSERT', 'UPDATE', 'DELETE'))]
+        self.assertFalse([sql for sql in writes if sql.endswith((' teams', ' deployments', ' main_goals', ' kpis'))])
+        self.assertFalse([sql for sql in statements if sql.startswith('SELECT * FROM') and 'json_each' not in sql])
+        loaded = [sql for sql in statements if sql.startswith('SELECT pos, key, data FROM islands')]
+        self.assertEqual(len(loaded), 1)
+        # Two islands before and one after the changed one move along, one statement each side
+        renumbered = [sql for sql in statements if sql.startswith('UPDATE islands SET pos = ')]
+        self.assertEqual(len(renumbered), 3)
+
+    def test_patch_duplicating_ids_rewrites_board(self):
+        """Test a patch that repeats an island id is stored like a save, keyed by position"""
+        self.init_db()
+        rv = self.client.post('/api/patch', data=json.dumps({"baseRev": 0, "ops": [
+            {"op": "copy", "from": "/islands/3", "path": "/islands/-"}]}), content_type='application/json')
+        self.assertEqual(rv.status_code, 200)
+        with sqlite3.connect(self.db_path) as conn:
+            keys = [key for key, in conn.execute("SELECT key FROM islands ORDER BY pos")]
+            size = conn.execute("SELECT size FROM gamestate WHERE id=1").fetchone()[0]
+        self.assertEqual(keys, ['p1', 'p2', 'p3', 'p4', '#4'])
+        state = json.loads(self.client.get('/api/load').data)
+        self.assertEqual(size, len(json.dumps(state, sort_keys=True, separators=(',', ':'))))
+
+    def test_entities_without_ids(self):
+        """Test entities lacking a unique id are keyed by position"""
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['islands'].insert(0, {"title": "No id", "kpis": [{"desc": "x"}, {"desc": "y"}]})
+        state['islands'].append(copy.deepcopy(state['islands'][1]))
+        state['islands'].append({"id": "#1", "kpis": []})
+        import app as app_module
+        self.init_db()
+        with sqlite3.connect(self.db_path) as conn:
+            app_module.write_state(conn, 1, state)
+            self.assertEqual(app_module.read_state(conn, 1), state)
+            keys = [key for key, in conn.execute("SELECT key FROM islands ORDER BY pos")]
+        self.assertEqual(keys, ['#0', 'p1', 'p2', 'p3', 'p4', '#5', '#6'])
+
+
+class BoardsTestCase(AppTestCase):
+    """Test cases for multiple boards and sharded storage"""
+
+    def save(self, board_id, state):
+        return self.client.post(f'/api/boards/{board_id}/save',
+                                data=json.dumps(state),
+                                content_type='application/json')
+
+    def test_boards_are_isolated(self):
+        """Test each board keeps its own state"""
+        for name in ('sales', 'engineering'):
+            state = copy.deepcopy(DEFAULT_STATE)
+            state['projectTitle'] = name
+            self.assertEqual(self.save(name, state).status_code, 200)
+
+        for name in ('sales', 'engineering'):
+            data = json.loads(self.client.get(f'/api/boards/{name}/load').data)
+            self.assertEqual(data['projectTitle'], name)
+        # The legacy endpoints keep serving the default board
+        data = json.loads(self.client.get('/api/load').data)
+        self.assertEqual(data['projectTitle'], DEFAULT_STATE['projectTitle'])
+        data = json.loads(self.client.get('/api/boards/default/load').data)
+        self.assertEqual(data['projectTitle'], DEFAULT_STATE['projectTitle'])
+
+    def test_unknown_board_starts_from_default(self):
+        """Test loading a board that was never saved"""
+        rv = self.client.get('/api/boards/new-board/load')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['X-Fleet-Revision'], '0')
+        self.assertEqual(json.loads(rv.data)['teams'], DEFAULT_STATE['teams'])
+
+        rv = self.client.post('/api/boards/new-board/patch',
+                              data=json.dumps({"baseRev": 0, "ops": []}),
+                              content_type='application/json')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_invalid_board_id(self):
+        """Test board ids outside the allowed charset are not routed"""
+        rv = self.client.get('/api/boards/bad.id/load')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_list_boards_paginates(self):
+        """Test the board listing pages through every board once"""
+        for i in range(7):
+            self.save(f'board-{i}', {"projectTitle": f"Board {i}", "teams": [], "islands": []})
+
+        seen = []
+        after = None
+        while True:
+            url = '/api/boards?limit=3' + (f'&after={after}' if after else '')
+            data = json.loads(self.client.get(url).data)
+            self.assertLessEqual(len(data['boards']), 3)
+            seen.extend(b['id'] for b in data['boards'])
+            after = data['next']
+            if after is None:
+                break
+        self.assertEqual(seen, sorted([f'board-{i}' for i in range(7)] + ['default']))
+
+        data = json.loads(self.client.get('/api/boards?limit=1').data)
+        self.assertEqual(data['boards'][0]['title'], 'Board 0')
+        self.assertEqual(data['boards'][0]['rev'], 1)
+
+    def test_sharded_storage(self):
+        """Test boards are spread across shard files and still found"""
+        shards = [os.path.join(self.tmp_dir.name, f'shard{i}.db') for i in range(3)]
+        self.store.close()
+        self.app = create_app({'TESTING': True, 'DB_SHARDS': shards})
+        self.store = self.app.extensions['fleet']
+        self.client = self.app.test_client()
+
+        names = [f'dept-{i}' for i in range(12)]
+        for name in names:
+            self.save(name, {"projectTitle": name, "teams": [], "islands": []})
+        for name in names:
+            data = json.loads(self.client.get(f'/api/boards/{name}/load').data)
+            self.assertEqual(data['projectTitle'], name)
+
+        data = json.loads(self.client.get('/api/boards?limit=100').data)
+        self.assertEqual([b['id'] for b in data['boards']], sorted(names + ['default']))
+
+        used = set()
+        for path in shards:
+            with sqlite3.connect(path) as conn:
+                keys = [row[0] for row in conn.execute("SELECT key FROM gamestate")]
+            for key in keys:
+                self.assertEqual(self.store.shard_for(key), path)
+            if keys:
+                used.add(path)
+        self.assertGreater(len(used), 1)
+
+    def test_board_lookup_uses_index(self):
+        """Test board lookups don't scan the gamestate table"""
+        self.client.get('/api/load')
+        with sqlite3.connect(self.db_path) as conn:
+            plan = conn.execute("EXPLAIN QUERY PLAN SELECT id, rev FROM gamestate WHERE key=?",
+                                ('default',)).fetchall()
+        self.assertIn('idx_gamestate_key', plan[0][-1])
+
+
+class ConditionalLoadTestCase(AppTestCase):
+    """Test cases for ETags and the serialized state cache on /api/load"""
+
+    def test_if_none_match_returns_304(self):
+        """Test a matching ETag gets an empty 304"""
+        rv = self.client.get('/api/load')
+        etag = rv.headers['ETag']
+        self.assertTrue(etag.startswith('"'))  # strong validator
+        self.assertEqual(rv.headers['Cache-Control'], 'no-cache')
+
+        rv = self.client.get('/api/load', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, b'')
+        self.assertEqual(rv.headers['X-Fleet-Revision'], '0')
+
+    def test_etag_changes_after_save(self):
+        """Test saves invalidate both the cache and the ETag"""
+        etag = self.client.get('/api/load').headers['ETag']
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['projectTitle'] = "Changed"
+        self.client.post('/api/save', data=json.dumps(state), content_type='application/json')
+
+        rv = self.client.get('/api/load', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+        self.assertEqual(json.loads(rv.data)['projectTitle'], "Changed")
+
+    def test_hot_reads_skip_sqlite(self):
+        """Test cached loads are served without opening the database"""
+        first = self.client.get('/api/load')
+        with mock.patch.object(self.store, 'connect', side_effect=AssertionError("hit SQLite")):
+            second = self.client.get('/api/load')
+        self.assertEqual(second.data, first.data)
+
+    def test_stale_cache_revalidated(self):
+        """Test writes from another process are picked up once the TTL expires"""
+        import app as app_module
+        self.client.get('/api/load')
+        with sqlite3.connect(self.db_path) as conn:
+            app_module.write_state(conn, 1, {"projectTitle": "Elsewhere", "teams": []})
+            conn.execute("UPDATE gamestate SET rev=rev+1 WHERE id=1")
+
+        with mock.patch.object(app_module, 'STATE_CACHE_TTL', 0):
+            rv = self.client.get('/api/load')
+        self.assertEqual(json.loads(rv.data)['projectTitle'], "Elsewhere")
+        self.assertEqual(rv.headers['X-Fleet-Revision'], '1')
+
+    def cached_boards(self):
+        return [board for _, board in self.store.state_cache]
+
+    def save_boards(self, *boards):
+        for board in boards:
+            self.client.post(f'/api/boards/{board}/save', data=json.dumps(DEFAULT_STATE),
+                             content_type='application/json')
+        self.store.state_cache.clear()
+        self.store.state_cache_bytes = 0
+
+    def test_cache_evicts_least_recently_used(self):
+        """Test the cache drops the least recently loaded board past STATE_CACHE_SIZE"""
+        import app as app_module
+        self.save_boards('one', 'two', 'three')
+        with mock.patch.object(app_module, 'STATE_CACHE_SIZE', 2):
+            self.client.get('/api/boards/one/load')
+            self.client.get('/api/boards/two/load')
+            self.client.get('/api/boards/one/load')
+            self.client.get('/api/boards/three/load')
+        self.assertEqual(self.cached_boards(), ['one', 'three'])
+
+    def test_cache_bounded_by_bytes(self):
+        """Test the cache keeps its bodies under STATE_CACHE_BYTES"""
+        import app as app_module
+        self.save_boards('one', 'two', 'three', 'four')
+        body = len(self.client.get('/api/boards/one/load').data)
+        with mock.patch.object(app_module, 'STATE_CACHE_BYTES', body * 2):
+            for board in ('two', 'three', 'four'):
+                self.client.get(f'/api/boards/{board}/load')
+        self.assertEqual(self.cached_boards(), ['three', 'four'])
+        self.assertEqual(self.store.state_cache_bytes,
+                         sum(len(e.body) for e in self.store.state_cache.values()))
+
+
+class HistoryTestCase(AppTestCase):
+    """Test cases for the revision log and time-travel loads"""
+
+    def save_titles(self, count):
+        states = []
+        for i in range(count):
+            state = copy.deepcopy(DEFAULT_STATE)
+            state['projectTitle'] = f"Rev {i + 1}"
+            state['islands'][0]['x'] = i
+            if i % 2:
+                state['teams'][0]['deployed'].append({"deploymentId": f"dep_{i}", "islandId": "p2", "kpiIds": []})
+            self.client.post('/api/save', data=json.dumps(state), content_type='application/json')
+            states.append(state)
+        return states
+
+    def history_kinds(self):
+        with sqlite3.connect(self.db_path) as conn:
+            return dict(conn.execute("SELECT rev, kind FROM history ORDER BY rev"))
+
+    def test_load_past_revisions(self):
+        """Test every logged revision can be rebuilt"""
+        import app as app_module
+        with mock.patch.object(app_module, 'HISTORY_SNAPSHOT_INTERVAL', 4):
+            states = self.save_titles(10)
+        kinds = self.history_kinds()
+        # The seeded revision 0 is logged, so the first save is a delta
+        self.assertEqual([kinds[rev] for rev in (0, 1, 2, 8)], ['snapshot', 'delta', 'delta', 'snapshot'])
+
+        for rev, state in enumerate(states, start=1):
+            rv = self.client.get(f'/api/load?rev={rev}')
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.headers['X-Fleet-Revision'], str(rev))
+            self.assertEqual(json.loads(rv.data), state)
+
+    def test_patches_are_logged(self):
+        """Test revisions made through /api/patch are replayed from their ops"""
+        self.save_titles(1)
+        ops = [{"op": "replace", "path": "/islands/1/y", "value": 999}]
+        self.client.post('/api/patch', data=json.dumps({"baseRev": 1, "ops": ops}),
+                         content_type='application/json')
+        data = json.loads(self.client.get('/api/load?rev=2').data)
+        self.assertEqual(data['islands'][1]['y'], 999)
+        data = json.loads(self.client.get('/api/load?rev=1').data)
+        self.assertEqual(data['islands'][1]['y'], DEFAULT_STATE['islands'][1]['y'])
+
+    def test_load_at_timestamp(self):
+        """Test ?at= picks the revision current at that time"""
+        with mock.patch('app.time.time', return_value=500.0):
+            self.client.get('/api/load')
+        with mock.patch('app.time.time', side_effect=[1000.0, 2000.0, 3000.0]):
+            self.save_titles(3)
+        data = json.loads(self.client.get('/api/load?at=2500').data)
+        self.assertEqual(data['projectTitle'], "Rev 2")
+        data = json.loads(self.client.get('/api/load?at=1970-01-01T00:50:00Z').data)
+        self.assertEqual(data['projectTitle'], "Rev 3")
+        # Before the first save, the seeded revision 0
+        data = json.loads(self.client.get('/api/load?at=700').data)
+        self.assertEqual(data, DEFAULT_STATE)
+        self.assertEqual(self.client.get('/api/load?at=10').status_code, 404)
+        self.assertEqual(self.client.get('/api/load?at=yesterday').status_code, 400)
+
+    def test_unknown_revision(self):
+        """Test revisions that were never logged return 404"""
+        self.save_titles(2)
+        self.assertEqual(self.client.get('/api/load?rev=5').status_code, 404)
+        self.assertEqual(self.client.get('/api/load?rev=-1').status_code, 404)
+        self.assertEqual(self.client.get('/api/load?rev=abc').status_code, 400)
+
+    def test_compaction_keeps_log_bounded(self):
+        """Test old history is dropped but recent revisions stay readable"""
+        import app as app_module
+        with mock.patch.object(app_module, 'HISTORY_SNAPSHOT_INTERVAL', 5), \
+                mock.patch.object(app_module, 'HISTORY_KEEP', 8):
+            states = self.save_titles(40)
+        kinds = self.history_kinds()
+        self.assertLessEqual(len(kinds), 8 + 5)
+        self.assertEqual(kinds[min(kinds)], 'snapshot')
+        self.assertEqual(self.client.get('/api/load?rev=1').status_code, 404)
+        for rev in range(33, 41):
+            data = json.loads(self.client.get(f'/api/load?rev={rev}').data)
+            self.assertEqual(data, states[rev - 1])
+
+
+class WriteBehindTestCase(AppTestCase):
+    """Test cases for coalesced background saves"""
+
+    def setUp(self):
+        super().setUp()
+        import app as app_module
+        self.app_module = app_module
+        self.patches = [
+            mock.patch.dict(self.app.config, WRITE_BEHIND=True),
+            # Keep the timer out of the way; tests flush explicitly
+            mock.patch.object(self.store.write_behind, 'interval', 60),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        self.store.write_behind.stop()
+        for patcher in self.patches:
+            patcher.stop()
+        super().tearDown()
+
+    def stored(self):
+        with sqlite3.connect(self.db_path) as conn:
+            return (conn.execute("SELECT rev, title FROM gamestate WHERE key='default'").fetchone(),
+                    # Revision 0 is the seeded board's snapshot
+                    conn.execute("SELECT count(*) FROM history WHERE rev > 0").fetchone()[0])
+
+    def save_title(self, title, board='default'):
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['projectTitle'] = title
+        return self.client.post(f'/api/boards/{board}/save', data=json.dumps(state),
+                                content_type='application/json')
+
+    def test_repeated_save_is_unchanged(self):
+        """Test resaving the pending or stored state is a no-op"""
+        self.assertEqual(json.loads(self.save_title("Same").data)['rev'], 1)
+        data = json.loads(self.save_title("Same").data)
+        self.assertEqual((data['rev'], data.get('unchanged')), (1, True))
+        self.store.write_behind.flush()
+        data = json.loads(self.save_title("Same").data)
+        self.assertEqual((data['rev'], data.get('unchanged')), (1, True))
+        self.assertEqual(self.store.write_behind.pending, {})
+
+    def test_saves_are_coalesced(self):
+        """Test a burst of saves becomes a single commit of the last one"""
+        for i in range(5):
+            rv = self.save_title(f"Burst {i}")
+            self.assertEqual(json.loads(rv.data)['rev'], i + 1)
+        # Nothing has reached SQLite yet, but loads see the latest state
+        self.assertEqual(self.stored(), ((0, DEFAULT_STATE['projectTitle']), 0))
+        rv = self.client.get('/api/load')
+        self.assertEqual(json.loads(rv.data)['projectTitle'], "Burst 4")
+        self.assertEqual(rv.headers['X-Fleet-Revision'], '5')
+
+        rv = self.client.post('/api/flush')
+        self.assertEqual(json.loads(rv.data)['flushed'], 1)
+        self.assertEqual(self.stored(), ((5, "Burst 4"), 1))
+        self.assertEqual(json.loads(self.client.get('/api/load').data)['projectTitle'], "Burst 4")
+        self.assertEqual(json.loads(self.client.post('/api/flush').data)['flushed'], 0)
+
+    def test_patch_against_pending_state(self):
+        """Test patches apply to and check revisions of the in-memory copy"""
+        self.save_title("Pending")
+        ops = [{"op": "replace", "path": "/islands/0/x", "value": 42}]
+        rv = self.client.post('/api/patch', data=json.dumps({"baseRev": 0, "ops": ops}),
+                              content_type='application/json')
+        self.assertEqual(rv.status_code, 409)
+        rv = self.client.post('/api/patch', data=json.dumps({"baseRev": 1, "ops": ops}),
+                              content_type='application/json')
+        self.assertEqual(json.loads(rv.data)['rev'], 2)
+
+        self.client.post('/api/flush')
+        data = json.loads(self.client.get('/api/load').data)
+        self.assertEqual((data['projectTitle'], data['islands'][0]['x']), ("Pending", 42))
+
+    def test_coalesced_history_replays(self):
+        """Test the flushed delta spans the revisions coalesced in memory"""
+        self.save_title("First")
+        self.client.post('/api/flush')
+        self.save_title("Second")
+        self.save_title("Third")
+        self.client.post('/api/flush')
+        data = json.loads(self.client.get('/api/load?rev=3').data)
+        self.assertEqual(data['projectTitle'], "Third")
+        self.assertEqual(self.client.get('/api/load?rev=2').status_code, 404)
+
+    def test_save_after_flush_sends_delta(self):
+        """Test the first save after a flush is diffed against the stored state"""
+        self.save_title("First")
+        self.client.post('/api/flush')
+        self.save_title("Second")
+        event = self.store.changes.channel('default').events[-1]
+        self.assertEqual((event.rev, event.ops), (2, [{"op": "replace", "path": "/projectTitle", "value": "Second"}]))
+
+    def test_racing_save_rechecks_revision(self):
+        """Test a save whose base changed while it read SQLite starts over"""
+        buffer = self.store.write_behind
+        base = buffer._base
+        racer = copy.deepcopy(DEFAULT_STATE)
+        racer['projectTitle'] = "Racer"
+        def racing_base(board_id):
+            seen = base(board_id)
+            if buffer.pending.get(board_id) is None:
+                # Another request saves while this one reads SQLite
+                buffer.pending[board_id] = self.app_module.PendingWrite(racer, 1, None, None, 0)
+            return seen
+        with mock.patch.object(buffer, '_base', racing_base):
+            state = copy.deepcopy(DEFAULT_STATE)
+            state['projectTitle'] = "Loser"
+            rv = self.client.post('/api/save', data=json.dumps(state), content_type='application/json',
+                                  headers={'X-Fleet-Base-Revision': '0'})
+        self.assertEqual((rv.status_code, json.loads(rv.data)['rev']), (409, 1))
+        self.assertEqual(buffer.pending['default'].state['projectTitle'], "Racer")
+
+    def test_dirty_threshold_wakes_flusher(self):
+        """Test enough dirty boards trigger a flush without waiting"""
+        with mock.patch.object(self.app_module, 'WRITE_BEHIND_MAX_DIRTY', 3):
+            for i in range(3):
+                self.save_title("Busy", board=f'busy-{i}')
+            deadline = time.time() + 5
+            while self.store.write_behind.pending and time.time() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(self.store.write_behind.pending, {})
+        data = json.loads(self.client.get('/api/boards?limit=10').data)
+        self.assertEqual(len(data['boards']), 4)
+
+    def test_stop_flushes(self):
+        """Test shutdown commits what is still pending"""
+        self.save_title("Shutdown")
+        self.store.write_behind.stop()
+        self.assertEqual(self.stored()[0], (1, "Shutdown"))
+
+    def test_flush_refuses_to_overwrite_other_writer(self):
+        """Test a buffered save is dropped if another process wrote the board meanwhile"""
+        self.save_title("Buffered")
+        other = create_app({'TESTING': True, 'DB_FILE': self.db_path}).extensions['fleet']
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['projectTitle'] = "Elsewhere"
+        with other.connect('default') as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self.app_module.save_state(conn, 'default', state, self.app_module.canonical_hash(state))
+        other.close()
+        with self.assertLogs('app', 'ERROR'):
+            self.assertEqual(self.store.write_behind.flush(), 0)
+        self.assertEqual(self.stored(), ((1, "Elsewhere"), 1))
+        self.assertEqual(json.loads(self.client.get('/api/load').data)['projectTitle'], "Elsewhere")
+
+    @unittest.skipUnless(importlib.util.find_spec('waitress'), "needs waitress")
+    def test_sigterm_flushes(self):
+        """Test a production server killed with SIGTERM commits what is still pending"""
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+        server = subprocess.Popen(
+            [sys.executable, script, '--production', '--write-behind', '--flush-interval', '60',
+             '--port', str(port)],
+            cwd=self.tmp_dir.name, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            state = copy.deepcopy(DEFAULT_STATE)
+            state['projectTitle'] = "Terminated"
+            save = urllib.request.Request(f'http://127.0.0.1:{port}/api/save', data=json.dumps(state).encode(),
+                                          headers={'Content-Type': 'application/json'})
+            deadline = time.time() + 20
+            while True:
+                try:
+                    with urllib.request.urlopen(save, timeout=5) as rv:
+                        self.assertEqual(json.loads(rv.read())['rev'], 1)
+                    break
+                except urllib.error.URLError:
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(0.1)
+            server.send_signal(signal.SIGTERM)
+            self.assertEqual(server.wait(timeout=20), 0)
+        finally:
+            if server.poll() is None:
+                server.kill()
+                server.wait()
+        self.assertEqual(self.stored()[0], (1, "Terminated"))
+
+
+class UnchangedSaveTestCase(AppTestCase):
+    """Test cases for skipping saves that don't change anything"""
+
+    def save(self, body):
+        rv = self.client.post('/api/save', data=body, content_type='application/json')
+        self.assertEqual(rv.status_code, 200)
+        return json.loads(rv.data)
+
+    def stored(self):
+        with sqlite3.connect(self.db_path) as conn:
+            return (conn.execute("SELECT rev, updated_at, content_hash FROM gamestate WHERE key='default'").fetchone(),
+                    # Revision 0 is the seeded board's snapshot
+                    conn.execute("SELECT count(*) FROM history WHERE rev > 0").fetchone()[0])
+
+    def test_identical_save_is_skipped(self):
+        """Test a repeated save reports unchanged and writes nothing"""
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['projectTitle'] = "Once"
+        self.assertEqual(self.save(json.dumps(state)), {"status": "success", "rev": 1})
+        before = self.stored()
+        self.assertIsNotNone(before[0][2])
+
+        # Key order and whitespace don't matter
+        reordered = json.dumps(dict(reversed(list(state.items()))), indent=2)
+        self.assertEqual(self.save(reordered), {"status": "success", "rev": 1, "unchanged": True})
+        self.assertEqual(self.stored(), before)
+
+        state['projectTitle'] = "Twice"
+        self.assertEqual(self.save(json.dumps(state)), {"status": "success", "rev": 2})
+
+    def test_unchanged_after_patch(self):
+        """Test resaving a patched state is detected without a stored hash"""
+        ops = [{"op": "replace", "path": "/projectTitle", "value": "Patched"}]
+        self.client.post('/api/patch', data=json.dumps({"baseRev": 0, "ops": ops}),
+                         content_type='application/json')
+        self.assertIsNone(self.stored()[0][2])
+
+        state = json.loads(self.client.get('/api/load').data)
+        self.assertEqual(self.save(json.dumps(state)), {"status": "success", "rev": 1, "unchanged": True})
+        (rev, _, content_hash), history = self.stored()
+        self.assertEqual((rev, history), (1, 1))
+        self.assertIsNotNone(content_hash)
+
+    def test_unchanged_save_respects_base_revision(self):
+        """Test a stale conditional save is still a conflict"""
+        rv = self.client.post('/api/save', data=json.dumps(DEFAULT_STATE), content_type='application/json',
+                              headers={'X-Fleet-Base-Revision': '5'})
+        self.assertEqual(rv.status_code, 409)
+
+
+class EntitiesTestCase(AppTestCase):
+    """Test cases for viewport queries on /api/entities"""
+
+    def entities(self, bbox, board='default'):
+        rv = self.client.get(f'/api/boards/{board}/entities?bbox=' + ','.join(map(str, bbox)))
+        self.assertEqual(rv.status_code, 200)
+        return json.loads(rv.data)
+
+    def test_bbox_filters_entities(self):
+        """Test only entities inside the box come back, with their KPIs and deployments"""
+        # p1 (-400, -100) and p4 (400, -100) but not p2/p3 further down
+        data = self.entities((-500, -200, 500, 0))
+        self.assertEqual([i['id'] for i in data['islands']], ['p1', 'p4'])
+        self.assertEqual(data['islands'][0]['kpis'], DEFAULT_STATE['islands'][0]['kpis'])
+        self.assertEqual(data['mainGoals'], [])
+        self.assertEqual([d['deploymentId'] for d in data['deployments']], ['dep_t1_1', 'dep_t2_1', 'dep_t4_1'])
+        self.assertEqual([d['teamId'] for d in data['deployments']], ['t1', 't2', 't4'])
+        self.assertFalse(data['truncated'])
+
+        data = self.entities((-1000, -1000, 1000, -500))
+        self.assertEqual([g['id'] for g in data['mainGoals']], ['mg1', 'mg2'])
+        self.assertEqual(data['islands'], [])
+
+    def test_index_follows_saves(self):
+        """Test moved, added and removed islands are reflected"""
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['islands'][0]['x'], state['islands'][0]['y'] = 5000, 5000
+        state['islands'].pop(1)
+        state['islands'].append({"id": "p9", "title": "New", "x": 5100, "y": 5100, "kpis": []})
+        self.client.post('/api/save', data=json.dumps(state), content_type='application/json')
+        data = self.entities((4900, 4900, 5200, 5200))
+        self.assertEqual([i['id'] for i in data['islands']], ['p1', 'p9'])
+        self.assertEqual([i['id'] for i in self.entities((-500, -200, 500, 0))['islands']], ['p4'])
+
+        ops = [{"op": "replace", "path": "/islands/0/x", "value": -5000}]
+        self.client.post('/api/patch', data=json.dumps({"baseRev": 1, "ops": ops}),
+                         content_type='application/json')
+        self.assertEqual([i['id'] for i in self.entities((4900, 4900, 5200, 5200))['islands']], ['p9'])
+
+    def test_boards_and_limits(self):
+        """Test other boards' entities are excluded and limit truncates"""
+        other = {"projectTitle": "Other", "teams": [],
+                 "islands": [{"id": f"o{i}", "x": i, "y": i, "kpis": []} for i in range(5)]}
+        self.client.post('/api/boards/other/save', data=json.dumps(other), content_type='application/json')
+        self.assertEqual(self.entities((0, 0, 10, 10))['islands'], [])
+        data = self.entities((0, 0, 10, 10), board='other')
+        self.assertEqual(len(data['islands']), 5)
+        rv = self.client.get('/api/boards/other/entities?bbox=0,0,10,10&limit=2')
+        data = json.loads(rv.data)
+        self.assertEqual(([i['id'] for i in data['islands']], data['truncated']), (['o0', 'o1'], True))
+
+    def test_pages_follow_next(self):
+        """Test passing next back as after walks every entity once"""
+        from app import entities_in
+        box = (-2000, -2000, 2000, 2000)
+        goals, islands, deployments, after = [], [], [], None
+        while True:
+            query = {'bbox': ','.join(map(str, box)), 'limit': 1}
+            if after:
+                query['after'] = after
+            rv = self.client.get('/api/entities', query_string=query)
+            self.assertEqual(rv.status_code, 200)
+            data = json.loads(rv.data)
+            self.assertEqual(data, entities_in(DEFAULT_STATE, box, 1, [int(v) for v in (after or '-1,-1').split(',')]))
+            goals += [g['id'] for g in data['mainGoals']]
+            islands += [i['id'] for i in data['islands']]
+            deployments += [d['deploymentId'] for d in data['deployments']]
+            after = data['next']
+            self.assertEqual(after is not None, data['truncated'])
+            if after is None:
+                break
+        self.assertEqual(goals, [g['id'] for g in DEFAULT_STATE['mainGoals']])
+        self.assertEqual(islands, ['p1', 'p2', 'p3', 'p4'])
+        self.assertEqual(sorted(deployments), sorted(d['deploymentId'] for d in self.entities(box)['deployments']))
+        self.assertEqual(self.client.get('/api/entities?bbox=0,0,1,1&after=3').status_code, 400)
+
+    def test_large_board_ids(self):
+        """Test boards stay apart once their ids no longer fit the R-tree's 32-bit floats"""
+        self.client.get('/api/load')
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("INSERT INTO gamestate (id, key, data, layout) VALUES (?, 'pad', '{}', 1)", (2 ** 24,))
+        for board in ('near', 'far'):
+            state = {"teams": [], "islands": [{"id": board, "x": 0, "y": 0, "kpis": []}]}
+            self.client.post(f'/api/boards/{board}/save', data=json.dumps(state), content_type='application/json')
+        self.assertEqual([i['id'] for i in self.entities((-1, -1, 1, 1), board='far')['islands']], ['far'])
+        self.assertEqual([i['id'] for i in self.entities((-1, -1, 1, 1), board='near')['islands']], ['near'])
+
+    def test_pending_write_behind_state(self):
+        """Test buffered saves are visible before they are flushed"""
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['islands'][0]['y'] = 9000
+        with mock.patch.dict(self.app.config, WRITE_BEHIND=True), \
+                mock.patch.object(self.store.write_behind, 'interval', 60):
+            self.client.post('/api/save', data=json.dumps(state), content_type='application/json')
+            data = self.entities((-500, 8000, 500, 10000))
+            self.store.write_behind.stop()
+        self.assertEqual([i['id'] for i in data['islands']], ['p1'])
+        self.assertEqual(self.entities((-500, 8000, 500, 10000)), data)
+
+    def test_invalid_bbox(self):
+        """Test malformed boxes are rejected"""
+        for query in ('', '?bbox=1,2,3', '?bbox=a,b,c,d', '?bbox=10,0,0,10'):
+            self.assertEqual(self.client.get('/api/entities' + query).status_code, 400)
+
+
+class MatrixTestCase(AppTestCase):
+    """Test cases for the precomputed /api/matrix aggregates"""
+
+    def matrix(self, board='default'):
+        rv = self.client.get(f'/api/boards/{board}/matrix')
+        self.assertEqual(rv.status_code, 200)
+        return json.loads(rv.data)
+
+    def save(self, state, board='default'):
+        rv = self.client.post(f'/api/boards/{board}/save', data=json.dumps(state), content_type='application/json')
+        self.assertEqual(rv.status_code, 200)
+
+    def test_default_board(self):
+        """Test allocation, free ships and completion ratios for the default fleet"""
+        data = self.matrix()
+        self.assertEqual(data['teams'][0], {"id": "t1", "totalShips": 12, "deployed": 1, "free": 11})
+        self.assertEqual(data['cells'][:2], [{"teamId": "t1", "islandId": "p1", "ships": 1},
+                                             {"teamId": "t2", "islandId": "p1", "ships": 1}])
+        self.assertEqual(data['islands'][0], {"id": "p1", "kpis": 3, "completed": 1, "ratio": 0.3333, "ships": 2})
+        # mg2 covers p1 and p4 through the legacy mainGoalId field
+        self.assertEqual(data['mainGoals'][1], {"id": "mg2", "kpis": 6, "completed": 2, "ratio": 0.3333, "ships": 3})
+
+    def test_aggregates_follow_saves_and_patches(self):
+        """Test incremental updates match a from-scratch computation"""
+        from app import matrix_of
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['teams'][0]['deployed'].append({"deploymentId": "dep_t1_2", "islandId": "p2", "kpiIds": []})
+        state['teams'][1]['id'] = 't2b'
+        state['islands'][1]['kpis'][0]['completed'] = True
+        state['islands'][2]['mainGoalIds'] = ['mg1', 'mg2']
+        del state['islands'][3]
+        state['teams'][3]['deployed'] = []
+        self.save(state)
+        self.assertEqual(self.matrix(), matrix_of(state))
+        self.assertEqual(self.matrix()['teams'][1]['id'], 't2b')
+
+        ops = [{"op": "remove", "path": "/teams/0/deployed/0"},
+               {"op": "replace", "path": "/islands/0/kpis/1/completed", "value": True}]
+        rv = self.client.post('/api/patch', data=json.dumps({"baseRev": 1, "ops": ops}),
+                              content_type='application/json')
+        self.assertEqual(rv.status_code, 200)
+        state = json.loads(self.client.get('/api/load').data)
+        self.assertEqual(self.matrix(), matrix_of(state))
+
+    def test_boards_are_separate(self):
+        """Test other boards' deployments are not counted"""
+        other = {"projectTitle": "Other", "mainGoals": [],
+                 "teams": [{"id": "t1", "totalShips": 3, "deployed": ["x1", "x1"]}],
+                 "islands": [{"id": "x1", "kpis": []}]}
+        self.save(other, board='other')
+        data = self.matrix(board='other')
+        self.assertEqual(data['teams'], [{"id": "t1", "totalShips": 3, "deployed": 2, "free": 1}])
+        self.assertEqual(data['islands'], [{"id": "x1", "kpis": 0, "completed": 0, "ratio": None, "ships": 2}])
+        self.assertEqual(self.matrix()['teams'][0]['deployed'], 1)
+
+    def test_pending_write_behind_state(self):
+        """Test buffered saves are counted before they are flushed"""
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['teams'][2]['deployed'] = [{"deploymentId": "dep_t3_1", "islandId": "p2", "kpiIds": []}]
+        with mock.patch.dict(self.app.config, WRITE_BEHIND=True), \
+                mock.patch.object(self.store.write_behind, 'interval', 60):
+            self.save(state)
+            data = self.matrix()
+            self.store.write_behind.stop()
+        self.assertEqual(data['teams'][2]['deployed'], 1)
+        self.assertEqual(self.matrix(), data)
+
+    def test_goal_totals_follow_island_changes(self):
+        """Test per-goal totals track islands renamed, regrouped, added and removed"""
+        from app import matrix_of
+        def rename(old, new):
+            state['islands'][0]['id'] = new
+            for team in state['teams']:
+                for dep in team['deployed']:
+                    if isinstance(dep, dict) and dep['islandId'] == old:
+                        dep['islandId'] = new
+
+        state = copy.deepcopy(DEFAULT_STATE)
+        rename('p1', 'p1b')
+        state['islands'][1]['mainGoalIds'] = ['mg2', 'mg2']
+        state['islands'].append({"id": "p5", "mainGoalIds": ["mg1"], "kpis": [{"id": "x", "completed": True}]})
+        self.save(state)
+        self.assertEqual(self.matrix(), matrix_of(state))
+        rename('p1b', 'p1')
+        state['teams'][1]['deployed'].append({"deploymentId": "dep_x", "islandId": "p5", "kpiIds": []})
+        self.save(state)
+        self.assertEqual(self.matrix(), matrix_of(state))
+        del state['islands'][4]
+        state['teams'][1]['deployed'].pop()
+        self.save(state)
+        self.assertEqual(self.matrix(), matrix_of(state))
+        state['islands'], state['teams'] = [], []
+        self.save(state)
+        with sqlite3.connect(self.db_path) as conn:
+            self.assertEqual(conn.execute("SELECT count(*) FROM main_goal_stats").fetchone()[0], 0)
+
+    def test_conditional_poll(self):
+        """Test unchanged aggregates revalidate with 304 without being read"""
+        rv = self.client.get('/api/matrix')
+        self.assertEqual(rv.headers['ETag'], '"matrix-0-default-0"')
+        with mock.patch('app.read_matrix') as read_matrix:
+            rv = self.client.get('/api/matrix', headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+        read_matrix.assert_not_called()
+        self.save(DEFAULT_STATE | {"projectTitle": "Renamed"})
+        rv = self.client.get('/api/matrix', headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual((rv.status_code, rv.headers['ETag']), (200, '"matrix-0-default-1"'))
+
+    def test_gzip_bodies_are_per_board(self):
+        """Test boards at the same revision never share a compressed body"""
+        from app import matrix_of
+        other = copy.deepcopy(DEFAULT_STATE)
+        other['teams'][0]['name'] = 'Other'
+        other['teams'][0]['deployed'] = []
+        self.save(DEFAULT_STATE | {"projectTitle": "Renamed"})
+        self.save(other, board='other')
+        for board, state in (('default', DEFAULT_STATE), ('other', other)):
+            with mock.patch('app.COMPRESS_MIN_SIZE', 16):
+                rv = self.client.get(f'/api/boards/{board}/matrix', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(rv.headers['ETag'], f'W/"matrix-0-{board}-1"')
+            self.assertEqual(json.loads(gzip.decompress(rv.data)), matrix_of(state))
+
+class SearchTestCase(AppTestCase):
+    """Test cases for full-text search on /api/search"""
+
+    def search(self, query, board=None):
+        url = f'/api/boards/{board}/search' if board else '/api/search'
+        rv = self.client.get(url, query_string={'q': query})
+        self.assertEqual(rv.status_code, 200)
+        return [(hit['board'], hit['kind'], hit['id']) for hit in json.loads(rv.data)['results']]
+
+    def test_prefix_terms(self):
+        """Test every word matches as a prefix of title or description"""
+        self.assertEqual(self.search('mig leg'), [('default', 'kpi', 'k1_3')])
+        rv = self.client.get('/api/search?q=soc')
+        hit = json.loads(rv.data)['results'][0]
+        self.assertEqual((hit['id'], hit['islandId'], hit['desc']), ('k3_2', 'p3', 'SOC2 Type II Compliance'))
+        self.assertEqual(self.search('nonexistentword'), [])
+
+    def test_title_ranks_first(self):
+        """Test title matches outrank description matches"""
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['islands'][0]['desc'] = 'Work with the Orbit team'
+        state['islands'][3]['title'] = 'Orbit'
+        self.client.post('/api/save', data=json.dumps(state), content_type='application/json')
+        self.assertEqual(self.search('orbit'), [('default', 'island', 'p4'), ('default', 'island', 'p1')])
+
+    def test_index_follows_saves(self):
+        """Test renamed, removed and added entities are reflected"""
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['islands'][1]['title'] = 'Moonshot'
+        state['islands'][0]['kpis'].pop(2)
+        state['teams'][1]['deployed'][0]['kpiIds'] = []
+        state['mainGoals'].append({"id": "mg3", "title": "Moonbase", "x": 0, "y": 0})
+        self.client.post('/api/save', data=json.dumps(state), content_type='application/json')
+        self.assertCountEqual(self.search('moon'), [('default', 'island', 'p2'), ('default', 'mainGoal', 'mg3')])
+        self.assertEqual(self.search('expansion'), [])
+        self.assertEqual(self.search('legacy'), [])
+
+        ops = [{"op": "replace", "path": "/mainGoals/2/title", "value": "Sunbase"}]
+        self.client.post('/api/patch', data=json.dumps({"baseRev": 1, "ops": ops}),
+                         content_type='application/json')
+        self.assertEqual(self.search('moon'), [('default', 'island', 'p2')])
+
+    def test_boards_and_limit(self):
+        """Test board-scoped search, cross-board search and limits"""
+        other = {"projectTitle": "Other", "teams": [], "mainGoals": [],
+                 "islands": [{"id": f"o{i}", "title": f"Hiring plan {i}", "kpis": []} for i in range(5)]}
+        self.client.post('/api/boards/other/save', data=json.dumps(other), content_type='application/json')
+        self.assertEqual(self.search('hir', board='default'), [('default', 'kpi', 'k2_1')])
+        self.assertEqual(len(self.search('hir', board='other')), 5)
+        self.assertEqual(len(self.search('hir')), 6)
+        self.assertEqual(self.search('hir', board='missing'), [])
+        rv = self.client.get('/api/search?q=hir&limit=2')
+        self.assertEqual(len(json.loads(rv.data)['results']), 2)
+
+    def test_invalid_query(self):
+        """Test queries without words are rejected and FTS syntax is not interpreted"""
+        for query in ('', '?q=', '?q=%22%2A%28'):
+            self.assertEqual(self.client.get('/api/search' + query).status_code, 400)
+        self.assertEqual(self.search('title: NEAR('), [])
+
+class KpiDeadlineTestCase(AppTestCase):
+    """Test cases for deadline queries on /api/kpis"""
+
+    def kpis(self, url='/api/kpis', **params):
+        rv = self.client.get(url, query_string=params)
+        self.assertEqual(rv.status_code, 200)
+        return json.loads(rv.data)
+
+    def ids(self, url='/api/kpis', **params):
+        return [kpi['id'] for kpi in self.kpis(url, **params)['kpis']]
+
+    def test_overdue(self):
+        """Test open KPIs past their deadline come back oldest first with context"""
+        self.assertEqual(self.ids(today='2026-01-01'), ['k2_1'])
+        self.assertEqual(self.ids(today='2026-07-01'), ['k2_1', 'k4_3', 'k4_1', 'k1_2', 'k2_3', 'k3_1'])
+        kpi = self.kpis(today='2026-01-01')['kpis'][0]
+        self.assertEqual(kpi, {"board": "default", "id": "k2_1", "desc": "Hire EMEA Sales VP",
+                               "deadline": "2025-09-01", "completed": False, "completedAt": None,
+                               "island": {"id": "p2", "title": "Global Expansion"},
+                               "mainGoals": [{"id": "mg1", "title": "$100M ARR (Unicorn)"}], "teams": []})
+
+    def test_upcoming_and_completed(self):
+        """Test due-within-N-days and completed-in-range windows"""
+        self.assertEqual(self.ids(status='upcoming', today='2026-05-01', days=31), ['k4_1', 'k1_2', 'k2_3', 'k3_1'])
+        self.assertEqual(self.ids(status='upcoming', today='2026-05-01', days=0), ['k4_1'])
+        with sqlite3.connect(self.db_path) as conn:
+            for kpi_id, completed_at in (('k1_1', '2025-12-20 12:00:00'), ('k2_2', '2026-03-02 09:00:00'),
+                                         ('k3_2', '2026-02-10 18:30:00'), ('k4_2', '2026-03-31 23:59:59')):
+                conn.execute("UPDATE kpi_completions SET completed_at=? WHERE kpi_id=?", (completed_at, kpi_id))
+        self.assertEqual(self.ids(status='completed'), ['k1_1', 'k3_2', 'k2_2', 'k4_2'])
+        self.assertEqual(self.ids(status='completed', **{'from': '2026-03-01', 'to': '2026-03-31'}), ['k2_2', 'k4_2'])
+        self.assertEqual(self.ids(status='completed', to='2026-03-30'), ['k1_1', 'k3_2', 'k2_2'])
+        kpi = self.kpis(status='completed', **{'from': '2026-02-10', 'to': '2026-02-10'})['kpis'][0]
+        self.assertEqual(kpi['completedAt'], '2026-02-10 18:30:00')
+
+    def test_completion_times(self):
+        """Test completion times follow the KPI through saves, not its position"""
+        def completed_at():
+            with sqlite3.connect(self.db_path) as conn:
+                return dict(conn.execute("SELECT kpi_id, completed_at FROM kpi_completions"))
+
+        state = copy.deepcopy(DEFAULT_STATE)
+        with self.store.connect('default') as conn:
+            conn.execute("UPDATE kpi_completions SET completed_at='2026-01-01 00:00:00'")
+        # Removing the island's first KPI moves k2_2 to another row
+        del state['islands'][1]['kpis'][0]
+        state['islands'][2]['kpis'][0]['completed'] = True
+        state['islands'][3]['kpis'][1]['completed'] = False
+        self.client.post('/api/save', data=json.dumps(state), content_type='application/json')
+        times = completed_at()
+        self.assertEqual(sorted(times), ['k1_1', 'k2_2', 'k3_1', 'k3_2'])
+        self.assertEqual((times['k2_2'], times['k3_2']), ('2026-01-01 00:00:00', '2026-01-01 00:00:00'))
+        self.assertGreater(times['k3_1'], '2026-01-01 00:00:00')
+
+        # Reopening and completing again records a new time
+        state['islands'][1]['kpis'][0]['completed'] = False
+        self.client.post('/api/save', data=json.dumps(state), content_type='application/json')
+        state['islands'][1]['kpis'][0]['completed'] = True
+        self.client.post('/api/save', data=json.dumps(state), content_type='application/json')
+        self.assertGreater(completed_at()['k2_2'], '2026-01-01 00:00:00')
+
+    def test_completion_cleanup_only_for_changed_kpis(self):
+        """Test saves only look up completion times of KPIs they reopened or removed"""
+        import app as app_module
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['islands'][2]['kpis'][0]['desc'] = 'Reworded'
+        with self.store.connect('default') as conn:
+            statements = []
+            conn.set_trace_callback(statements.append)
+            app_module.write_state(conn, 1, state)
+            self.assertFalse([sql for sql in statements if 'DELETE FROM kpi_completions' in sql])
+            state['islands'][0]['kpis'][0]['completed'] = False
+            app_module.write_state(conn, 1, state)
+            conn.set_trace_callback(None)
+            cleanup = [sql for sql in statements if 'DELETE FROM kpi_completions' in sql]
+            self.assertEqual(len(cleanup), 1)
+            self.assertIn('["k1_1"]', cleanup[0])
+
+    def test_team_and_board_filters(self):
+        """Test filtering by assigned team and by board"""
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['teams'][0]['deployed'] = [{"deploymentId": "d1", "islandId": "p2", "kpiIds": ["k2_1", "k2_3"]}]
+        state['teams'][1]['deployed'] = [{"deploymentId": "d2", "islandId": "p2", "kpiId": "k2_1"}]
+        self.client.post('/api/boards/other/save', data=json.dumps(state), content_type='application/json')
+
+        self.assertEqual(self.ids('/api/boards/other/kpis', today='2026-07-01', team='t1'), ['k2_1', 'k2_3'])
+        kpi = self.kpis('/api/boards/other/kpis', today='2026-01-01')['kpis'][0]
+        self.assertEqual(kpi['teams'], [{"id": "t1", "name": "Engineering"}, {"id": "t2", "name": "Product"}])
+        both = self.kpis(today='2026-01-01')['kpis']
+        self.assertEqual(sorted(kpi['board'] for kpi in both), ['default', 'other'])
+        self.assertEqual(self.ids('/api/boards/missing/kpis'), [])
+
+        # Reassigning a team updates its KPIs
+        state['teams'][0]['deployed'][0]['kpiIds'] = ["k2_3"]
+        self.client.post('/api/boards/other/save', data=json.dumps(state), content_type='application/json')
+        self.assertEqual(self.ids('/api/boards/other/kpis', today='2026-07-01', team='t1'), ['k2_3'])
+
+    def test_limit_and_invalid_arguments(self):
+        """Test truncation and rejected arguments"""
+        data = self.kpis(today='2026-07-01', limit=2)
+        self.assertEqual((len(data['kpis']), data['truncated']), (2, True))
+        for query in ('?status=late', '?today=soon', '?status=upcoming&days=-1', '?status=completed&from=x',
+                      '?status=upcoming&days=99999999', '?status=upcoming&today=9999-12-31',
+                      '?status=completed&to=9999-12-31'):
+            self.assertEqual(self.client.get('/api/kpis' + query).status_code, 400)
+
+    def test_completed_range_uses_index(self):
+        """Test completed KPIs are read off the completion time indexes, not all of kpis"""
+        self.client.get('/api/load')
+        with sqlite3.connect(self.db_path) as conn:
+            queries = []
+            conn.set_trace_callback(queries.append)
+            read_kpis(conn, True, '2026-01-01', '2026-04-01', 10)
+            read_kpis(conn, True, '2026-01-01', '2026-04-01', 10, state_id=1)
+            conn.set_trace_callback(None)
+            plans = [[row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)] for sql in queries]
+        self.assertIn('idx_kpi_completions_at', plans[0][0])
+        self.assertIn('idx_kpi_completions_board_at', ' '.join(plans[1]))
+        for plan in plans:
+            self.assertIn('SEARCH k USING INDEX idx_kpis_id', ' '.join(plan))
+
+class ExportImportTestCase(AppTestCase):
+    """Test cases for NDJSON bulk export and import"""
+
+    def save(self, board, title):
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['projectTitle'] = title
+        self.client.post(f'/api/boards/{board}/save', data=json.dumps(state), content_type='application/json')
+        return state
+
+    def export(self, query=''):
+        rv = self.client.get('/api/export' + query)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, 'application/x-ndjson')
+        return [json.loads(line) for line in rv.data.splitlines()]
+
+    def test_export_all_and_selected(self):
+        """Test every board is exported in id order, or just the requested ones"""
+        with mock.patch('app.EXPORT_PAGE_SIZE', 2):
+            for board in ('c', 'a', 'b'):
+                self.save(board, f'Board {board}')
+            lines = self.export()
+        self.assertEqual([line['id'] for line in lines], ['a', 'b', 'c', 'default'])
+        self.assertEqual(lines[0]['state']['projectTitle'], 'Board a')
+        self.assertEqual(lines[0]['rev'], 1)
+        self.assertEqual([line['id'] for line in self.export('?boards=c,missing,a')], ['c', 'a'])
+        self.assertEqual(self.client.get('/api/export?boards=../x').status_code, 400)
+
+    def test_export_reads_one_board_at_a_time(self):
+        """Test each board's rows are read only when its line is due"""
+        import app as app_module
+        for board in ('a', 'b'):
+            self.save(board, f'Board {board}')
+        read_state = app_module.read_state
+        with mock.patch.object(app_module, 'read_state', side_effect=read_state) as reads:
+            lines = app_module.export_lines(self.store)
+            self.assertEqual(json.loads(next(lines))['id'], 'a')
+            self.assertEqual(reads.call_count, 1)
+            self.assertEqual([json.loads(line)['id'] for line in lines], ['b', 'default'])
+            self.assertEqual(reads.call_count, 3)
+
+    def test_export_gzip(self):
+        """Test the stream is gzipped for clients that accept it"""
+        self.save('a', 'Board a')
+        rv = self.client.get('/api/export', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(gzip.decompress(rv.data).splitlines()), 2)
+
+    def test_round_trip(self):
+        """Test an export imported into another database reproduces every board"""
+        states = {board: self.save(board, f'Board {board}') for board in ('a', 'b', 'c')}
+        body = self.client.get('/api/export').data
+
+        fd, path = tempfile.mkstemp()
+        other = create_app({'TESTING': True, 'DB_FILE': path})
+        try:
+            client = other.test_client()
+            rv = client.post('/api/import?batch=2', data=gzip.compress(body), content_type='application/x-ndjson',
+                             headers={'Content-Encoding': 'gzip'})
+            # The default board is already seeded with the same state
+            self.assertEqual(json.loads(rv.data), {"status": "success", "imported": 3, "unchanged": 1})
+            for board, state in states.items():
+                self.assertEqual(json.loads(client.get(f'/api/boards/{board}/load').data), state)
+            rv = client.post('/api/import', data=body, content_type='application/x-ndjson')
+            self.assertEqual(json.loads(rv.data)['unchanged'], 4)
+        finally:
+            other.extensions['fleet'].close()
+            os.close(fd)
+            os.unlink(path)
+
+    def test_import_updates_existing_boards(self):
+        """Test imported states become new revisions with history"""
+        self.save('a', 'Before')
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['projectTitle'] = 'After'
+        body = json.dumps({"id": "a", "rev": 99, "state": state}) + '\n'
+        self.client.post('/api/import', data=body, content_type='application/x-ndjson')
+        rv = self.client.get('/api/boards/a/load')
+        self.assertEqual((rv.headers['X-Fleet-Revision'], json.loads(rv.data)['projectTitle']), ('2', 'After'))
+        rv = self.client.get('/api/boards/a/load?rev=1')
+        self.assertEqual(json.loads(rv.data)['projectTitle'], 'Before')
+
+    def test_import_checks_shape_only(self):
+        """Test malformed states stop the import while dangling deployments are kept"""
+        legacy = {"teams": [{"id": "t1", "deployed": ["gone"]}], "islands": []}
+        rv = self.client.post('/api/import', data=json.dumps({"id": "old", "state": legacy}) + '\n',
+                              content_type='application/x-ndjson')
+        self.assertEqual(json.loads(rv.data)['imported'], 1)
+        self.assertEqual(json.loads(self.client.get('/api/boards/old/load').data), legacy)
+
+        for state in ([1, 2], "str", {"teams": 5, "islands": []}):
+            rv = self.client.post('/api/import', data=json.dumps({"id": "bad", "state": state}) + '\n',
+                                  content_type='application/x-ndjson')
+            self.assertEqual(rv.status_code, 400)
+            self.assertTrue(json.loads(rv.data)['message'].startswith('Line 1: invalid state:'))
+        self.assertEqual(self.client.get('/api/boards/bad/load').headers['X-Fleet-Revision'], '0')
+
+    def test_line_splitting(self):
+        """Test lines are reassembled across chunks and overlong ones are refused"""
+        from app import _lines
+        chunks = [b'{"a"', b':1}\n{"b', b'":2}\n\n{"c":3}', b'', b'\n', b'{"d":4}']
+        self.assertEqual(list(_lines(chunks)), [b'{"a":1}', b'{"b":2}', b'', b'{"c":3}', b'{"d":4}'])
+        self.assertEqual(list(_lines([b'abc\n'] * 3, max_length=3)), [b'abc'] * 3)
+        with self.assertRaises(ValueError):
+            list(_lines([b'ab', b'cd', b'\n'], max_length=3))
+
+    def test_batch_is_one_transaction(self):
+        """Test an unchanged board saved without a hash doesn't commit its batch early"""
+        import app as app_module
+        state = self.save('a', 'A')
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("UPDATE gamestate SET content_hash=NULL WHERE key='a'")
+        lines = [{"id": "x1", "state": dict(state, projectTitle='New')}, {"id": "a", "state": state},
+                 {"id": "x2", "state": dict(state, projectTitle='Boom')}]
+        commit_revision = app_module.commit_revision
+
+        def failing(conn, state_id, rev, state, *args, **kwargs):
+            if state['projectTitle'] == 'Boom':
+                raise sqlite3.OperationalError('disk I/O error')
+            return commit_revision(conn, state_id, rev, state, *args, **kwargs)
+        with mock.patch('app.commit_revision', failing), self.assertRaises(sqlite3.OperationalError):
+            self.client.post('/api/import', data=''.join(json.dumps(line) + '\n' for line in lines),
+                             content_type='application/x-ndjson')
+        self.assertEqual(self.client.get('/api/boards/x1/load').headers['X-Fleet-Revision'], '0')
+
+    def test_bad_line_keeps_earlier_boards(self):
+        """Test a malformed line stops the import after committing the lines before it"""
+        body = (json.dumps({"id": "x1", "state": {"teams": [], "islands": []}}) + '\n\n' + 'not json\n'
+                + json.dumps({"id": "x2", "state": {}}) + '\n')
+        rv = self.client.post('/api/import', data=body, content_type='application/x-ndjson')
+        self.assertEqual(rv.status_code, 400)
+        data = json.loads(rv.data)
+        self.assertEqual(data['imported'], 1)
+        self.assertTrue(data['message'].startswith('Line 3:'))
+        self.assertEqual(self.client.get('/api/boards/x1/load').headers['X-Fleet-Revision'], '1')
+        self.assertEqual(self.client.get('/api/boards/x2/load').headers['X-Fleet-Revision'], '0')
+
+        rv = self.client.post('/api/import', data=json.dumps({"id": "bad id!", "state": {}}))
+        self.assertEqual(rv.status_code, 400)
+        rv = self.client.post('/api/import', data=gzip.compress(b'{"id": "x3", "state": {}}\n')[:-4],
+                              headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(rv.status_code, 400)
+
+class AdmissionControlTestCase(AppTestCase):
+    """Test cases for save/patch rate limits and the pending-write cap"""
+
+    def save(self, board='default', client='10.0.0.1', title='Fleet'):
+        state = dict(DEFAULT_STATE, projectTitle=title)
+        return self.client.post(f'/api/boards/{board}/save', data=json.dumps(state),
+                                content_type='application/json', environ_base={'REMOTE_ADDR': client})
+
+    def test_client_limit(self):
+        """Test a client over its burst gets 429 with Retry-After while others still write"""
+        with mock.patch.dict(self.store.admission.limits, client=(0.5, 2)):
+            self.assertEqual(self.save(title='a').status_code, 200)
+            self.assertEqual(self.save(board='other', title='b').status_code, 200)
+            rv = self.save(title='c')
+            self.assertEqual(rv.status_code, 429)
+            self.assertEqual(rv.headers['Retry-After'], '2')
+            data = json.loads(rv.data)
+            self.assertEqual((data['status'], data['reason']), ('throttled', 'client'))
+            self.assertEqual(self.save(client='10.0.0.2', title='d').status_code, 200)
+            # Reads are never throttled
+            self.assertEqual(self.client.get('/api/load', environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code, 200)
+        self.assertEqual(self.client.get('/api/load').headers['X-Fleet-Revision'], '2')
+
+    def test_board_limit_and_refill(self):
+        """Test one board's bucket spans clients and refills over time"""
+        with mock.patch.dict(self.store.admission.limits, board=(20, 1)):
+            self.assertEqual(self.save(client='10.0.0.1', title='a').status_code, 200)
+            rv = self.save(client='10.0.0.2', title='b')
+            self.assertEqual((rv.status_code, json.loads(rv.data)['reason']), (429, 'board'))
+            self.assertEqual(rv.headers['Retry-After'], '1')
+            self.assertEqual(self.save(board='other', title='c').status_code, 200)
+            time.sleep(0.1)
+            self.assertEqual(self.save(client='10.0.0.2', title='b').status_code, 200)
+
+    def test_patch_is_limited(self):
+        """Test patches draw from the same buckets as saves"""
+        ops = [{"op": "replace", "path": "/projectTitle", "value": "Patched"}]
+        with mock.patch.dict(self.store.admission.limits, client=(0.1, 1)):
+            self.assertEqual(self.save(client='127.0.0.1', title='a').status_code, 200)
+            rv = self.client.post('/api/patch', data=json.dumps({"baseRev": 1, "ops": ops}),
+                                  content_type='application/json')
+            self.assertEqual(rv.status_code, 429)
+
+    def test_pending_write_cap(self):
+        """Test writes beyond MAX_PENDING_WRITES are turned away and slots are released"""
+        with mock.patch.object(self.store.admission, 'max_pending', 1):
+            self.assertIsNone(self.store.admission.admit('10.0.0.9', 'default'))
+            rv = self.save()
+            self.assertEqual((rv.status_code, json.loads(rv.data)['reason']), (429, 'queue'))
+            self.store.admission.release()
+            self.assertEqual(self.save().status_code, 200)
+            self.assertEqual(self.save(title='again').status_code, 200)
+        self.assertEqual(self.store.admission.pending, 0)
+
+    def test_rejected_before_inflating(self):
+        """Test a throttled write is turned away before its compressed body is read"""
+        with mock.patch.object(self.store.admission, 'max_pending', 1):
+            self.assertIsNone(self.store.admission.admit('10.0.0.9', 'default'))
+            rv = self.client.post('/api/save', data=b'not gzip', content_type='application/json',
+                                  headers={'Content-Encoding': 'gzip'})
+            self.assertEqual(rv.status_code, 429)
+            self.store.admission.release()
+        # A refused body still releases its admission slot
+        rv = self.client.post('/api/save', data=b'not gzip', content_type='application/json',
+                              headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(self.store.admission.pending, 0)
+
+    def test_counters(self):
+        """Test admitted and rejected writes are counted by reason"""
+        with mock.patch.dict(self.app.config, METRICS=True), \
+                mock.patch.dict(self.store.admission.limits, client=(0.1, 1)):
+            self.save(client='10.9.9.9', title='a')
+            self.save(client='10.9.9.9', title='b')
+            body = self.client.get('/metrics').data.decode()
+        self.assertIn('fleet_write_admissions_total{result="client"}', body)
+        self.assertIn('fleet_write_admissions_total{result="admitted"}', body)
+
+class ValidationTestCase(AppTestCase):
+    """Test cases for save payload validation and body size limits"""
+
+    def save(self, state, **kwargs):
+        return self.client.post('/api/save', data=json.dumps(state), content_type='application/json', **kwargs)
+
+    def assertUntouched(self):
+        rv = self.client.get('/api/load')
+        self.assertEqual(rv.headers['X-Fleet-Revision'], '0')
+        self.assertEqual(json.loads(rv.data), DEFAULT_STATE)
+
+    def test_rejects_bad_shapes(self):
+        """Test malformed states get 400 with the offending path and leave the board alone"""
+        cases = [
+            (lambda s: s['teams'][0].update(totalShips='12'), '/teams/0/totalShips must be a non-negative integer'),
+            (lambda s: s['islands'][1]['kpis'][0].update(completed=1), '/islands/1/kpis/0/completed must be true'),
+            (lambda s: s['islands'][2].pop('id'), '/islands/2/id is required'),
+            (lambda s: s['mainGoals'][0].update(x=True), '/mainGoals/0/x must be a finite number'),
+            (lambda s: s['mainGoals'][1].update(y=float('nan')), 'Invalid JSON: NaN is not valid JSON'),
+            (lambda s: s['teams'][1]['deployed'].append(7), '/teams/1/deployed/1 must be an object or a string'),
+            (lambda s: s.update(islands={}), '/islands must be an array'),
+        ]
+        for mutate, message in cases:
+            state = copy.deepcopy(DEFAULT_STATE)
+            mutate(state)
+            rv = self.save(state)
+            self.assertEqual(rv.status_code, 400)
+            self.assertIn(message, json.loads(rv.data)['message'])
+        self.assertEqual(self.save([DEFAULT_STATE]).status_code, 400)
+        self.assertUntouched()
+
+    def test_rejects_dangling_references(self):
+        """Test deployments must point at existing islands and KPIs of their island"""
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['teams'][2]['deployed'] = [{"deploymentId": "dep_x", "islandId": "p9", "kpiIds": []}]
+        rv = self.save(state)
+        self.assertEqual(rv.status_code, 400)
+        self.assertIn("/teams/2/deployed/0/islandId refers to unknown island 'p9'", json.loads(rv.data)['message'])
+
+        state['teams'][2]['deployed'] = [{"deploymentId": "dep_x", "islandId": "p1", "kpiIds": ["k2_1"]}]
+        rv = self.save(state)
+        self.assertEqual(rv.status_code, 400)
+        self.assertIn("KPI 'k2_1'", json.loads(rv.data)['message'])
+
+        state['teams'][2]['deployed'] = ['p2', 'p5']
+        self.assertEqual(self.save(state).status_code, 400)
+        self.assertUntouched()
+
+    def test_patch_keeps_existing_dangling_references(self):
+        """Test boards stored with broken references accept patches that add no new ones"""
+        import app as app_module
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['teams'][2]['deployed'] = [{"deploymentId": "dep_x", "islandId": "p9", "kpiIds": []}]
+        self.client.get('/api/load')
+        with self.store.connect('default') as conn:
+            app_module.write_state(conn, 1, state)
+
+        def patch(ops, base_rev=0):
+            return self.client.post('/api/patch', data=json.dumps({"baseRev": base_rev, "ops": ops}),
+                                    content_type='application/json')
+        rv = patch([{"op": "replace", "path": "/teams/0/name", "value": "Renamed"}])
+        self.assertEqual(rv.status_code, 200)
+        rv = patch([{"op": "add", "path": "/teams/1/deployed/-", "value": "p9"}], base_rev=1)
+        self.assertEqual(rv.status_code, 400)
+        self.assertIn("refers to unknown island 'p9'", json.loads(rv.data)['message'])
+        with mock.patch.dict(self.app.config, WRITE_BEHIND=True), \
+                mock.patch.object(self.store.write_behind, 'interval', 60):
+            rv = patch([{"op": "replace", "path": "/teams/1/name", "value": "Renamed"}], base_rev=1)
+            self.store.write_behind.stop()
+        self.assertEqual(rv.status_code, 200)
+
+    def test_accepts_legacy_shapes(self):
+        """Test bare island ids, kpiId, free-text KPIs and extra keys still save"""
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['teams'][2]['deployed'] = ['p2', {"islandId": "p3", "kpiId": "k3_2"}]
+        state['teams'].append({"id": "t99"})
+        state['islands'][3]['kpis'] = "Legacy free-text KPI"
+        state['teams'][3]['deployed'] = ['p4']
+        state['islands'][0]['mainGoalIds'] = ['mg1', 'mg2']
+        state['islands'][0]['color'] = '#123456'
+        state['customField'] = {"nested": [1, 2, 3]}
+        self.assertEqual(self.save(state).status_code, 200)
+        self.assertEqual(self.save({"teams": [], "islands": []}).status_code, 200)
+
+    def test_rejects_missing_collections(self):
+        """Test a state without teams or islands is refused rather than stored"""
+        for state in ({}, {"projectTitle": "x"}, {"teams": []}, {"islands": []}):
+            rv = self.save(state)
+            self.assertEqual(rv.status_code, 400)
+            self.assertIn('is required', json.loads(rv.data)['message'])
+        self.assertIn('/teams is required', json.loads(self.save({}).data)['message'])
+        self.assertUntouched()
+
+    def test_body_size_limit(self):
+        """Test oversized bodies get 413, whether or not they declare a length"""
+        body = json.dumps(DEFAULT_STATE).encode('utf-8')
+        with mock.patch('app.MAX_SAVE_BODY', len(body) - 1):
+            rv = self.client.post('/api/save', data=body, content_type='application/json')
+            self.assertEqual(rv.status_code, 413)
+            rv = self.client.post('/api/save', input_stream=io.BytesIO(body), content_type='application/json',
+                                  environ_overrides={'wsgi.input_terminated': True})
+            self.assertEqual(rv.status_code, 413)
+            ops = [{"op": "replace", "path": "/projectTitle", "value": "x" * len(body)}]
+            rv = self.client.post('/api/patch', data=json.dumps({"baseRev": 0, "ops": ops}),
+                                  content_type='application/json')
+            self.assertEqual(rv.status_code, 413)
+        with mock.patch('app.MAX_SAVE_BODY', len(body)):
+            rv = self.client.post('/api/save', input_stream=io.BytesIO(body), content_type='application/json',
+                                  environ_overrides={'wsgi.input_terminated': True})
+            self.assertEqual((rv.status_code, json.loads(rv.data).get('unchanged')), (200, True))
+        self.assertUntouched()
+
+    def test_deep_nesting_is_rejected(self):
+        """Test bodies nested past the parser's recursion limit get 400, not a 500"""
+        body = '[' * 100000 + ']' * 100000
+        rv = self.client.post('/api/save', data=body, content_type='application/json')
+        self.assertEqual((rv.status_code, json.loads(rv.data)['status']), (400, 'error'))
+        rv = self.client.post('/api/patch', data=body, content_type='application/json')
+        self.assertEqual(rv.status_code, 400)
+        rv = self.client.post('/api/import', data=body, content_type='application/x-ndjson')
+        self.assertEqual(rv.status_code, 400)
+        self.assertUntouched()
+
+    def test_non_finite_numbers_are_rejected(self):
+        """Test NaN, Infinity and out-of-range numbers get 400 wherever they appear"""
+        body = json.dumps(DEFAULT_STATE)[:-1]
+        for value in ('NaN', 'Infinity', '-Infinity', '1e999'):
+            rv = self.client.post('/api/save', data=f'{body}, "extra": {value}}}', content_type='application/json')
+            self.assertEqual(rv.status_code, 400, value)
+        ops = [{"op": "add", "path": "/islands/0/kpis/0/assigned/-", "value": "NaN"}]
+        rv = self.client.post('/api/patch', data=json.dumps({"baseRev": 0, "ops": ops}).replace('"NaN"', 'NaN'),
+                              content_type='application/json')
+        self.assertEqual(rv.status_code, 400)
+        self.assertUntouched()
+
+    def test_patch_results_are_validated(self):
+        """Test a patch that would leave dangling deployments is rejected, buffered or not"""
+        ops = [{"op": "remove", "path": "/islands/0"}]
+        for write_behind in (False, True):
+            with mock.patch.dict(self.app.config, WRITE_BEHIND=write_behind):
+                rv = self.client.post('/api/patch', data=json.dumps({"baseRev": 0, "ops": ops}),
+                                      content_type='application/json')
+                self.assertEqual(rv.status_code, 400)
+                self.assertIn('/teams/0/deployed/0/islandId', json.loads(rv.data)['message'])
+        self.assertUntouched()
+
+
+class StaticAssetsTestCase(AppTestCase):
+    """Test cases for fingerprinted static files and the cached index page"""
+
+    def test_versioned_urls_are_immutable(self):
+        """Test the page links every module by content hash and those URLs cache for good"""
+        versions = self.app.extensions['fleet_assets'].versions
+        digest = hashlib.sha256(open(os.path.join(self.app.static_folder, 'js/modules/main.js'), 'rb').read())
+        self.assertEqual(versions['js/modules/main.js'], digest.hexdigest()[:12])
+
+        html = self.client.get('/').data.decode('utf-8')
+        import_map = json.loads(html.split('<script type="importmap">')[1].split('</script>')[0])
+        for name in ('main.js', 'GameEngine.js', 'Utils.js'):
+            url = f"/static/js/modules/{name}?v={versions['js/modules/' + name]}"
+            self.assertEqual(import_map['imports'][f'/static/js/modules/{name}'], url)
+            self.assertIn(f'<link rel="modulepreload" href="{url}">', html)
+        self.assertIn(f'/static/css/style.css?v={versions["css/style.css"]}', html)
+
+        rv = self.client.get(f"/static/js/modules/main.js?v={versions['js/modules/main.js']}")
+        self.assertEqual(rv.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        rv.close()
+        # Stale or missing versions fall back to revalidation
+        for url in ('/static/js/modules/main.js?v=0123456789ab', '/static/js/modules/main.js'):
+            rv = self.client.get(url)
+            self.assertEqual(rv.status_code, 200)
+            self.assertNotIn('immutable', rv.headers.get('Cache-Control', ''))
+            rv.close()
+
+    def test_fingerprints_on_first_use(self):
+        """Test creating the app reads nothing under static/ until a page or asset is served"""
+        with mock.patch('app.os.walk', wraps=os.walk) as walk:
+            app = create_app({'TESTING': True, 'DB_FILE': self.db_path})
+            self.assertEqual(walk.call_count, 0)
+            client = app.test_client()
+            client.get('/')
+            client.get('/static/css/style.css').close()
+            self.assertEqual(walk.call_count, 1)
+        app.extensions['fleet'].close()
+
+    def test_index_is_rendered_once(self):
+        """Test the index page is cached, revalidated by ETag and carries no state by default"""
+        with mock.patch('app.render_template', wraps=render_template) as render:
+            first = self.client.get('/')
+            second = self.client.get('/', headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(first.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(second.status_code, 304)
+        self.assertNotIn(b'initial-state', first.data)
+
+    def test_inline_initial_state(self):
+        """Test the page can carry the board's state and revision, escaped for a script element"""
+        state = dict(DEFAULT_STATE, projectTitle='</script><b>Fleet</b>')
+        self.client.post('/api/boards/inline/save', data=json.dumps(state), content_type='application/json')
+        with mock.patch.dict(self.app.config, INLINE_INITIAL_STATE=True):
+            html = self.client.get('/?board=inline').data.decode('utf-8')
+            etag = self.client.get('/?board=inline').headers['ETag']
+            self.assertNotIn('</script><b>', html)
+            script = html.split('<script id="initial-state" type="application/json" data-rev="1">')[1]
+            self.assertEqual(json.loads(script.split('</script>')[0]), state)
+            self.assertLess(html.index('initial-state'), html.index('<script type="module"'))
+
+            # Boards that don't exist yet start out as the demo fleet
+            html = self.client.get('/?board=new').data.decode('utf-8')
+            self.assertIn('data-rev="0">', html)
+            self.assertNotIn('initial-state', self.client.get('/?board=bad%20id').data.decode('utf-8'))
+
+            self.client.post('/api/boards/inline/save', data=json.dumps(DEFAULT_STATE), content_type='application/json')
+            self.assertNotEqual(self.client.get('/?board=inline').headers['ETag'], etag)
+
+
+class ChangeStreamTestCase(AppTestCase):
+    """Test cases for /api/stream and conditional saves"""
+
+    def setUp(self):
+        super().setUp()
+        self.board = 'stream'
+
+    def save(self, state, base_rev=None):
+        headers = {} if base_rev is None else {'X-Fleet-Base-Revision': str(base_rev)}
+        return self.client.post(f'/api/boards/{self.board}/save', data=json.dumps(state),
+                                content_type='application/json', headers=headers)
+
+    def open_stream(self, since=None):
+        url = f'/api/boards/{self.board}/stream' + ('' if since is None else f'?since={since}')
+        rv = self.client.get(url, buffered=False)
+        self.assertEqual(rv.mimetype, 'text/event-stream')
+        chunks = iter(rv.response)
+        self.assertTrue(next(chunks).startswith(b'retry:'))
+        return rv, chunks
+
+    def read_event(self, chunks):
+        chunk = next(chunks).decode('utf-8')
+        lines = dict(line.split(': ', 1) for line in chunk.strip().split('\n'))
+        return int(lines['id']), json.loads(lines['data'])
+
+    def test_stream_replays_since_revision(self):
+        """Test a client catches up on changes made after its load"""
+        state = copy.deepcopy(DEFAULT_STATE)
+        self.save(state)
+        state['islands'][0]['x'] = 77
+        self.save(state)
+
+        rv, chunks = self.open_stream(since=1)
+        rev, event = self.read_event(chunks)
+        rv.close()
+        self.assertEqual(rev, 2)
+        self.assertEqual(event['ops'], [{"op": "replace", "path": "/islands/0/x", "value": 77}])
+
+    def test_stream_pushes_live_changes(self):
+        """Test subscribers are woken by saves and patches"""
+        self.save(DEFAULT_STATE)
+        rv, chunks = self.open_stream()
+
+        def patch_later():
+            time.sleep(0.05)
+            ops = [{"op": "replace", "path": "/projectTitle", "value": "Live"}]
+            self.client.post(f'/api/boards/{self.board}/patch',
+                             data=json.dumps({"baseRev": 1, "ops": ops}),
+                             content_type='application/json')
+
+        writer = threading.Thread(target=patch_later)
+        writer.start()
+        rev, event = self.read_event(chunks)
+        writer.join()
+        rv.close()
+        self.assertEqual(rev, 2)
+        self.assertEqual(event['board'], self.board)
+        self.assertEqual(event['ops'][0]['value'], "Live")
+
+    def test_stream_requests_reload_after_gap(self):
+        """Test clients that fell too far behind are told to reload"""
+        import app as app_module
+        with mock.patch.object(app_module, 'STREAM_BACKLOG', 2):
+            for i in range(4):
+                self.save({"projectTitle": f"v{i}", "teams": [], "islands": []})
+        rv, chunks = self.open_stream(since=0)
+        rev, event = self.read_event(chunks)
+        rv.close()
+        self.assertEqual((rev, event.get('reload')), (4, True))
+
+    def test_stream_notices_other_workers(self):
+        """Test idle streams reload once another process stores a newer revision"""
+        import app as app_module
+        self.save(DEFAULT_STATE)
+        with mock.patch.object(app_module, 'STREAM_HEARTBEAT', 0.01):
+            rv, chunks = self.open_stream()
+            self.assertEqual(next(chunks), b': keep-alive\n\n')
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("UPDATE gamestate SET rev=rev+1 WHERE key=?", (self.board,))
+            with mock.patch.object(app_module, 'STATE_CACHE_TTL', 0):
+                rev, event = self.read_event(chunks)
+                self.assertEqual(next(chunks), b': keep-alive\n\n')
+            rv.close()
+        self.assertEqual((rev, event.get('reload')), (2, True))
+
+    def test_stream_limit(self):
+        """Test streams past MAX_STREAMS get 503 and closed streams free their slot"""
+        with mock.patch.object(self.store.changes, 'max_streams', 1):
+            rv, chunks = self.open_stream(since=0)
+            busy = self.client.get(f'/api/boards/{self.board}/stream')
+            self.assertEqual((busy.status_code, busy.headers['Retry-After']), (503, '15'))
+            rv.close()
+            rv, chunks = self.open_stream(since=0)
+            rv.close()
+        self.assertEqual(self.store.changes.subscribers, 0)
+
+    def test_idle_channels_are_evicted(self):
+        """Test boards nobody subscribes to are forgotten and their clients told to reload"""
+        rv, chunks = self.open_stream(since=0)
+        with mock.patch('app.STREAM_CHANNELS', 2):
+            for board in ('a', 'b', 'c'):
+                self.store.changes.publish(board, 1, [])
+            self.assertEqual(list(self.store.changes.channels), ['stream', 'c'])
+            rv.close()
+            self.store.changes.publish('d', 1, [])
+            self.assertEqual(list(self.store.changes.channels), ['stream', 'd'])
+
+            self.save(DEFAULT_STATE)
+            self.store.changes.channels.clear()
+            rv, chunks = self.open_stream(since=0)
+            rev, event = self.read_event(chunks)
+            rv.close()
+        self.assertEqual((rev, event.get('reload')), (1, True))
+
+    def test_conditional_save(self):
+        """Test saves with a stale base revision are rejected"""
+        self.assertEqual(self.save(DEFAULT_STATE, base_rev=0).status_code, 200)
+        rv = self.save({"projectTitle": "Stale", "teams": [], "islands": []}, base_rev=0)
+        self.assertEqual(rv.status_code, 409)
+        self.assertEqual(json.loads(rv.data)['rev'], 1)
+        self.assertEqual(self.save(DEFAULT_STATE, base_rev=1).status_code, 200)
+        self.assertEqual(self.save(DEFAULT_STATE, base_rev='x').status_code, 400)
+        # Without the header saves stay unconditional
+        self.assertEqual(self.save(DEFAULT_STATE).status_code, 200)
+
+
+class ConnectionPoolTestCase(AppTestCase):
+    """Test cases for pooled WAL connections"""
+
+    def setUp(self):
+        super().setUp()
+        import app as app_module
+        self.app_module = app_module
+
+    def test_connections_use_wal(self):
+        """Test pooled connections get the performance pragmas"""
+        with self.store.connect('default') as conn:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+            self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 1)  # NORMAL
+            self.assertEqual(conn.execute("PRAGMA busy_timeout").fetchone()[0], 5000)
+
+    def test_connections_are_reused(self):
+        """Test returned connections are handed out again"""
+        with self.store.connect('default') as first:
+            pass
+        with self.store.connect('default') as second:
+            pass
+        self.assertIs(first, second)
+
+    def test_pool_size_is_bounded(self):
+        """Test checkouts beyond the pool size wait and then fail"""
+        pool = self.app_module.ConnectionPool(self.db_path, 2, busy_timeout=0.01)
+        held = [pool.acquire(), pool.acquire()]
+        with self.assertRaises(sqlite3.OperationalError):
+            pool.acquire()
+        pool.release(held.pop())
+        self.assertIsNotNone(pool.acquire())
+
+    def test_failed_block_rolls_back(self):
+        """Test an exception inside connect() rolls back and frees the connection"""
+        with self.assertRaises(RuntimeError):
+            with self.store.connect('default') as conn:
+                conn.execute("UPDATE gamestate SET title='oops'")
+                raise RuntimeError()
+        with self.store.connect('default') as conn:
+            self.assertFalse(conn.in_transaction)
+            title = conn.execute("SELECT title FROM gamestate").fetchone()[0]
+        self.assertEqual(title, DEFAULT_STATE['projectTitle'])
+
+    def test_readers_not_blocked_by_writer(self):
+        """Test loads proceed while another connection holds the write lock"""
+        client = self.app.test_client()
+        client.get('/api/load')
+        writer = sqlite3.connect(self.db_path)
+        writer.execute("BEGIN IMMEDIATE")
+        writer.execute("UPDATE gamestate SET title='uncommitted'")
+        try:
+            with mock.patch.object(self.app_module, 'STATE_CACHE_TTL', 0):
+                rv = client.get('/api/load')
+            self.assertEqual(rv.status_code, 200)
+        finally:
+            writer.rollback()
+            writer.close()
+
+
+class CompressionTestCase(AppTestCase):
+    """Test cases for compressed transport and storage"""
+
+    def setUp(self):
+        super().setUp()
+        import app as app_module
+        self.app_module = app_module
+
+    def test_gzip_response(self):
+        """Test loads are gzipped for clients that accept it"""
+        plain = self.client.get('/api/load')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        rv = self.client.get('/api/load', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertLess(len(rv.data), len(plain.data))
+        self.assertEqual(gzip.decompress(rv.data), plain.data)
+        # The compressed variant gets a weak validator that still matches
+        self.assertTrue(rv.headers['ETag'].startswith('W/'))
+        rv = self.client.get('/api/load', headers={'Accept-Encoding': 'gzip',
+                                                   'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+
+    def test_deflate_response(self):
+        """Test deflate is used when gzip isn't accepted"""
+        rv = self.client.get('/api/load', headers={'Accept-Encoding': 'deflate'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(json.loads(zlib.decompress(rv.data))['projectTitle'], DEFAULT_STATE['projectTitle'])
+
+    def test_small_responses_not_compressed(self):
+        """Test tiny bodies are sent as-is"""
+        rv = self.client.post('/api/flush', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', rv.headers)
+
+    def test_gzip_request_body(self):
+        """Test saves accept gzip-encoded bodies"""
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['projectTitle'] = "Compressed Upload"
+        rv = self.client.post('/api/save', data=gzip.compress(json.dumps(state).encode('utf-8')),
+                              content_type='application/json',
+                              headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(self.client.get('/api/load').data)
+        self.assertEqual(data['projectTitle'], "Compressed Upload")
+
+    def test_bad_request_encodings(self):
+        """Test corrupt, unknown and oversized encoded bodies are refused"""
+        rv = self.client.post('/api/save', data=b'not gzip', content_type='application/json',
+                              headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(rv.status_code, 400)
+        rv = self.client.post('/api/save', data=b'{}', content_type='application/json',
+                              headers={'Content-Encoding': 'br'})
+        self.assertEqual(rv.status_code, 415)
+        bomb = gzip.compress(b'[' + b' ' * 100000 + b']')
+        with mock.patch.object(self.app_module, 'MAX_DECOMPRESSED_BODY', 1000):
+            rv = self.client.post('/api/save', data=bomb, content_type='application/json',
+                                  headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(rv.status_code, 413)
+
+    def test_encoded_writes_capped_at_save_limit(self):
+        """Test encoded saves and patches stop inflating past MAX_SAVE_BODY"""
+        bomb = gzip.compress(b'{"baseRev": 0, "ops": [' + b' ' * 100000 + b']}')
+        # Refused while inflating, so the views never read the body
+        with mock.patch.object(self.app_module, 'MAX_SAVE_BODY', 1000), \
+                mock.patch.object(self.app_module, 'read_json_body', side_effect=AssertionError("inflated")):
+            for endpoint in ('/api/save', '/api/patch'):
+                rv = self.client.post(endpoint, data=bomb, content_type='application/json',
+                                      headers={'Content-Encoding': 'gzip'})
+                self.assertEqual(rv.status_code, 413)
+        rv = self.client.post('/api/patch', data=gzip.compress(b'{"baseRev": 0, "ops": []}'),
+                              content_type='application/json', headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(rv.status_code, 200)
+
+    def test_compressed_storage(self):
+        """Test compressed rows are smaller and mix with plain ones"""
+        compressing = create_app({'TESTING': True, 'DB_FILE': self.db_path, 'STORAGE_COMPRESSION': True})
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['islands'][0]['title'] = "Stored Compressed"
+        compressing.test_client().post('/api/save', data=json.dumps(state), content_type='application/json')
+        compressing.extensions['fleet'].close()
+        with sqlite3.connect(self.db_path) as conn:
+            rows = dict(conn.execute("SELECT id, data FROM islands WHERE state_id=1"))
+        self.assertIsInstance(rows['p1'], bytes)
+        shell = dict(state['islands'][0], kpis=[])
+        self.assertLess(len(rows['p1']), len(json.dumps(shell)) * 0.8)
+
+        # An app with compression off reads them
+        with mock.patch.object(self.app_module, 'STATE_CACHE_TTL', 0):
+            data = json.loads(self.client.get('/api/load').data)
+        self.assertEqual(data, state)
+        data = json.loads(self.client.get('/api/load?rev=1').data)
+        self.assertEqual(data, state)
+
+
+class PatchTestCase(AppTestCase):
+    """Test cases for delta saves via /api/patch"""
+
+    def patch(self, base_rev, ops):
+        return self.client.post('/api/patch',
+                                data=json.dumps({"baseRev": base_rev, "ops": ops}),
+                                content_type='application/json')
+
+    def test_load_reports_revision(self):
+        """Test load exposes the revision patches must be based on"""
+        rv = self.client.get('/api/load')
+        self.assertEqual(rv.headers['X-Fleet-Revision'], '0')
+
+    def test_patch_applies_operations(self):
+        """Test patch ops are applied and persisted"""
+        rv = self.patch(0, [
+            {"op": "replace", "path": "/islands/0/x", "value": 123},
+            {"op": "add", "path": "/teams/0/deployed/-",
+             "value": {"deploymentId": "dep_new", "islandId": "p2", "kpiIds": []}},
+            {"op": "remove", "path": "/teams/1/deployed/0"}
+        ])
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data)['rev'], 1)
+
+        rv = self.client.get('/api/load')
+        data = json.loads(rv.data)
+        self.assertEqual(rv.headers['X-Fleet-Revision'], '1')
+        self.assertEqual(data['islands'][0]['x'], 123)
+        self.assertEqual(data['teams'][0]['deployed'][-1]['deploymentId'], 'dep_new')
+        self.assertEqual(data['teams'][1]['deployed'], [])
+
+    def test_patch_move_and_copy(self):
+        """Test move and copy operations"""
+        rv = self.patch(0, [
+            {"op": "copy", "from": "/projectTitle", "path": "/subtitle"},
+            {"op": "move", "from": "/islands/0", "path": "/islands/-"}
+        ])
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(self.client.get('/api/load').data)
+        self.assertEqual(data['subtitle'], DEFAULT_STATE['projectTitle'])
+        self.assertEqual(data['islands'][-1]['id'], DEFAULT_STATE['islands'][0]['id'])
+
+    def test_stale_patch_rejected(self):
+        """Test patches against an old revision are rejected"""
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['projectTitle'] = "Saved"
+        self.client.post('/api/save', data=json.dumps(state),
+                         content_type='application/json')
+        rv = self.patch(0, [{"op": "replace", "path": "/projectTitle", "value": "Stale"}])
+        self.assertEqual(rv.status_code, 409)
+        self.assertEqual(json.loads(rv.data)['rev'], 1)
+
+        data = json.loads(self.client.get('/api/load').data)
+        self.assertEqual(data['projectTitle'], "Saved")
+
+    def test_failed_test_op_is_conflict(self):
+        """Test a failing 'test' op aborts the whole patch"""
+        rv = self.patch(0, [
+            {"op": "replace", "path": "/projectTitle", "value": "Changed"},
+            {"op": "test", "path": "/teams/0/name", "value": "Not Engineering"}
+        ])
+        self.assertEqual(rv.status_code, 409)
+        data = json.loads(self.client.get('/api/load').data)
+        self.assertEqual(data['projectTitle'], DEFAULT_STATE['projectTitle'])
+
+    def test_invalid_patch(self):
+        """Test malformed patches return 400 and leave the state untouched"""
+        for ops in ([{"op": "remove", "path": "/missing"}],
+                    [{"op": "replace", "path": "/teams/99", "value": {}}],
+                    [{"op": "explode", "path": "/teams"}],
+                    "not a list"):
+            rv = self.patch(0, ops)
+            self.assertEqual(rv.status_code, 400)
+        rv = self.client.post('/api/patch', data="not a json", content_type='application/json')
+        self.assertEqual(rv.status_code, 400)
+        for base_rev in (True, False, 0.0, "0"):
+            rv = self.patch(base_rev, [])
+            self.assertEqual((rv.status_code, json.loads(rv.data)['message']), (400, "Expected {baseRev, ops}"))
+        self.assertEqual(self.client.get('/api/load').headers['X-Fleet-Revision'], '0')
+
+    def test_copies_cannot_amplify(self):
+        """Test copy ops that keep doubling the state are cut off with 413"""
+        ops = [{"op": "copy", "from": "", "path": f"/copy{i}"} for i in range(30)]
+        with mock.patch('app.MAX_SAVE_BODY', 64 * 1024):
+            rv = self.patch(0, ops)
+        self.assertEqual(rv.status_code, 413)
+        self.assertEqual(self.client.get('/api/load').headers['X-Fleet-Revision'], '0')
+
+    def test_patched_state_size_is_capped(self):
+        """Test a patch that pushes the whole state past the save limit is refused"""
+        size = len(json.dumps(DEFAULT_STATE, sort_keys=True, separators=(',', ':')))
+        for rev, write_behind in enumerate((False, True)):
+            with mock.patch('app.MAX_SAVE_BODY', size + 100), mock.patch.dict(self.app.config, WRITE_BEHIND=write_behind):
+                rv = self.patch(rev, [{"op": "add", "path": "/notes", "value": "x" * 200}])
+                self.assertEqual(rv.status_code, 413)
+                rv = self.patch(rev, [{"op": "add", "path": "/notes", "value": "x" * (20 + rev)}])
+                self.assertEqual(json.loads(rv.data)['rev'], rev + 1)
+        self.store.write_behind.stop()
+        self.assertEqual(json.loads(self.client.get('/api/load').data)['notes'], "x" * 21)
+
+
+class MetricsTestCase(AppTestCase):
+    """Test cases for /metrics and Server-Timing"""
+
+    def setUp(self):
+        super().setUp()
+        import app as app_module
+        self.app_module = app_module
+
+    def test_server_timing_header(self):
+        """Test API responses break down where the time went"""
+        self.client.post('/api/boards/timing/save', data=json.dumps(DEFAULT_STATE),
+                         content_type='application/json')
+        rv = self.client.get('/api/boards/timing/load')
+        phases = [part.split(';')[0] for part in rv.headers['Server-Timing'].split(', ')]
+        self.assertIn('db', phases)
+        self.assertIn('serialize', phases)
+        self.assertEqual(phases[-1], 'total')
+
+        state = copy.deepcopy(DEFAULT_STATE)
+        state['projectTitle'] = "Timed"
+        rv = self.client.post('/api/boards/timing/save', data=json.dumps(state),
+                              content_type='application/json')
+        phases = [part.split(';')[0] for part in rv.headers['Server-Timing'].split(', ')]
+        for phase in ('parse', 'hash', 'db', 'diff', 'total'):
+            self.assertIn(phase, phases)
+        self.assertNotIn('Server-Timing', self.client.get('/').headers)
+
+    def test_metrics_exposition(self):
+        """Test /metrics reports latency, sizes and writes per board"""
+        for title in ('first', 'second'):
+            self.client.post('/api/boards/metered/save', data=json.dumps({"projectTitle": title, "teams": [], "islands": []}),
+                             content_type='application/json')
+        self.client.get('/api/boards/metered/load')
+        rv = self.client.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.content_type.startswith('text/plain'))
+        text = rv.get_data(as_text=True)
+        self.assertIn('# TYPE fleet_http_request_duration_seconds histogram', text)
+        self.assertIn('fleet_board_writes_total{board="metered",kind="save"} 2', text)
+        self.assertIn('fleet_http_request_duration_seconds_bucket{route="/api/boards/<board:board_id>/load",'
+                      'method="GET",status="200",le="+Inf"}', text)
+        self.assertIn('fleet_request_phase_duration_seconds_count{route="/api/boards/<board:board_id>/save",'
+                      'phase="diff"}', text)
+        self.assertIn('fleet_http_request_size_bytes_sum{route="/api/boards/<board:board_id>/save"}', text)
+
+    def test_request_size_is_wire_size(self):
+        """Test compressed uploads are measured as sent, not as inflated"""
+        def total():
+            # Metrics are process-wide, so compare before and after
+            prefix = 'fleet_http_request_size_bytes_sum{route="/api/boards/<board:board_id>/save"} '
+            lines = self.client.get('/metrics').get_data(as_text=True).splitlines()
+            return sum(float(line[len(prefix):]) for line in lines if line.startswith(prefix))
+
+        body = gzip.compress(json.dumps(DEFAULT_STATE).encode('utf-8'))
+        before = total()
+        self.client.post('/api/boards/zipped/save', data=body, content_type='application/json',
+                         headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(total() - before, len(body))
+
+    def test_metrics_can_be_disabled(self):
+        """Test turning metrics off removes the endpoint and headers"""
+        self.app.config['METRICS'] = False
+        rv = self.client.get('/api/load')
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotIn('Server-Timing', rv.headers)
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+    def test_histogram_buckets_are_cumulative(self):
+        """Test rendered buckets follow the Prometheus format"""
+        histogram = self.app_module.Histogram('h', 'test', (1, 2))
+        for value in (0.5, 1.5, 1.5, 5):
+            histogram.observe((('a', 'x"y'),), value)
+        self.assertEqual(histogram.render()[2:], [
+            'h_bucket{a="x\\"y",le="1"} 1',
+            'h_bucket{a="x\\"y",le="2"} 3',
+            'h_bucket{a="x\\"y",le="+Inf"} 4',
+            'h_sum{a="x\\"y"} 8.5',
+            'h_count{a="x\\"y"} 4',
+        ])
+
+
+class SyntheticFleetTestCase(AppTestCase):
+    """Test cases for the benchmark fleet generator"""
+
+    def test_generated_state_is_consistent(self):
+        """Test deployments point at existing islands and KPIs"""
+        from benchmarks.fleetgen import generate_state
+        state = generate_state(teams=5, islands=40, kpis=3, deployments=60, seed=1)
+        self.assertEqual(len(state['islands']), 40)
+        self.assertEqual(sum(len(t['deployed']) for t in state['teams']), 60)
+        kpis = {i['id']: {k['id'] for k in i['kpis']} for i in state['islands']}
+        for team in state['teams']:
+            self.assertGreaterEqual(team['totalShips'], len(team['deployed']))
+            for dep in team['deployed']:
+                self.assertTrue(set(dep['kpiIds']) <= kpis[dep['islandId']])
+        self.assertEqual(state, generate_state(teams=5, islands=40, kpis=3, deployments=60, seed=1))
+
+    def test_generated_state_round_trips(self):
+        """Test a large generated fleet saves and loads unchanged"""
+        from benchmarks.fleetgen import generate_state
+        state = generate_state(teams=20, islands=500, kpis=4, deployments=800)
+        rv = self.client.post('/api/save', data=json.dumps(state), content_type='application/json')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(self.client.get('/api/load').data), state)
 
 
 if __name__ == '__main__':